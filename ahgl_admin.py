@@ -6,25 +6,89 @@ import collections
 import re
 import hashlib
 import os
+import time
+import threading
 import errno
-import zipfile
+import shutil
+import fcntl
 import cStringIO
-import cgi
 import flask
+import jinja2
+import sqlite3
+import broadcast
+import cache
+import compress
+import event_log
+import history
+import ratings
+import refdata
+import replay_zip
+import sql_profile
+import time_budget
+import validation
 
 
 def open_db(path):
-  import sqlite3
   driver = sqlite3
   if driver.paramstyle != "qmark":
     raise Exception("Require qmark paramstyle")
+  if app.config.get("SQL_PROFILE"):
+    return sql_profile.connect(path, get_sql_profiler())
   conn = driver.connect(path)
   return conn
 
 
+_sql_profiler = None
+
+def get_sql_profiler():
+  global _sql_profiler
+  if _sql_profiler is None:
+    log_path = app.config.get("SQL_PROFILE_LOG") or os.path.join(
+        app.config["DATA_DIR"], "sql_profile.log")
+    logger = sql_profile.make_logger(log_path,
+        app.config.get("SQL_PROFILE_LOG_BYTES", 10 << 20),
+        app.config.get("SQL_PROFILE_LOG_COUNT", 5))
+    _sql_profiler = sql_profile.Profiler(logger,
+        app.config.get("SQL_PROFILE_SLOW_MS", 20),
+        lambda: flask.request.endpoint if flask.has_request_context() else None)
+  return _sql_profiler
+
+
 app = flask.Flask(__name__)
 g = flask.g
 
+week_blocks = cache.LRUCache(256)
+
+app.wsgi_app = compress.CompressMiddleware(app.wsgi_app, week_blocks)
+
+live_events = broadcast.Broadcaster()
+event_feed_lock = threading.Lock()
+event_feed_wakeup = threading.Event()
+event_feed_thread = None
+
+archive_lock = threading.Lock()
+archive_wakeup = threading.Event()
+archive_thread = None
+
+# Only what the public pages already show; a lineup stays hidden until both
+# teams have entered theirs.
+LIVE_EVENT_FIELDS = {
+    "maps": [],
+    "lineup": ["team"],
+    "result": ["match"],
+    }
+
+metrics_lock = threading.Lock()
+metrics = {}
+
+def set_metric(name, value):
+  with metrics_lock:
+    metrics[name] = value
+
+def incr_metric(name, amount=1):
+  with metrics_lock:
+    metrics[name] = metrics.get(name, 0) + amount
+
 
 def content_type(ctype):
   def decorator(func):
@@ -38,6 +102,23 @@ def content_type(ctype):
   return decorator
 
 
+# Public pages that never write.  They run against a read-only connection,
+# and against the read snapshot when READ_SNAPSHOT_MAX_AGE is set.
+read_only_endpoints = set()
+
+def read_only(func):
+  read_only_endpoints.add(func.__name__)
+  return func
+
+
+# Endpoints that only send a file from DATA_DIR, and get no database.
+file_endpoints = set()
+
+def file_only(func):
+  file_endpoints.add(func.__name__)
+  return func
+
+
 def require_auth(func):
   @functools.wraps(func)
   def wrapper(*args, **kwds):
@@ -49,6 +130,19 @@ def require_auth(func):
   return wrapper
 
 
+# For the endpoints the result form's upload script calls, which needs a
+# status code rather than a page.
+def require_captain(func):
+  @functools.wraps(func)
+  def wrapper(*args, **kwds):
+    account = flask.session.get("account")
+    if not account:
+      return "Not logged in", 403
+    g.account = account
+    return func(*args, **kwds)
+  return wrapper
+
+
 def require_admin(func):
   @functools.wraps(func)
   def wrapper(*args, **kwds):
@@ -58,15 +152,370 @@ def require_admin(func):
   return wrapper
 
 
+def get_refdata():
+  if not hasattr(g, "refdata"):
+    g.refdata = refdata.get(g.db, g.db_path)
+  return g.refdata
+
+
+def get_maps(week):
+  mapnames = get_refdata().mapnames
+  with contextlib.closing(g.db.cursor()) as cursor:
+    cursor.execute("SELECT set_number, mapid FROM maps WHERE week = ?", (week,))
+    return dict((row[0], mapnames[row[1]]) for row in cursor)
+
+
+def get_lineups(week):
+  get_player = get_refdata().get_player
+  lineups = collections.defaultdict(dict)
+  with contextlib.closing(g.db.cursor()) as cursor:
+    cursor.execute("SELECT team, set_number, player, race FROM lineup WHERE week = ?", (week,))
+    for (team, set_number, player, race) in cursor:
+      lineups[team][set_number] = (get_player(player), race)
+  return lineups
+
+
+def get_aces(week):
+  get_player = get_refdata().get_player
+  with contextlib.closing(g.db.cursor()) as cursor:
+    cursor.execute(
+        "SELECT match_number, home_player, away_player, home_race, away_race "
+        "FROM ace_matches WHERE week = ?", (week,))
+    return dict((row[0], (get_player(row[1]), get_player(row[2]), row[3], row[4]))
+        for row in cursor)
+
+
+# Triggers bump a week's row of week_versions on any change to its data.
+# They are in schema.sql, and ensure_week_versions() adds them to databases
+# made before.
+WEEK_VERSIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS week_versions (
+  week INTEGER PRIMARY KEY,
+  version INTEGER
+);
+""" + "".join("""
+CREATE TRIGGER IF NOT EXISTS %(table)s_insert_week AFTER INSERT ON %(table)s BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week = NEW.week;
+END;
+
+CREATE TRIGGER IF NOT EXISTS %(table)s_update_week AFTER UPDATE ON %(table)s BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week IN (OLD.week, NEW.week);
+END;
+
+CREATE TRIGGER IF NOT EXISTS %(table)s_delete_week AFTER DELETE ON %(table)s BEGIN
+  UPDATE week_versions SET version = version + 1 WHERE week = OLD.week;
+END;
+""" % dict(table=table)
+    for table in ("matches", "maps", "lineup", "referees", "set_results", "ace_matches"))
+
+
+def ensure_week_versions(conn):
+  conn.executescript(WEEK_VERSIONS_SCHEMA)
+
+
+# None for a database without week_versions (a past season from before it).
+def get_week_versions():
+  if not hasattr(g, "week_versions"):
+    with contextlib.closing(g.db.cursor()) as cursor:
+      try:
+        cursor.execute("SELECT week, version FROM week_versions")
+        g.week_versions = dict(cursor)
+      except sqlite3.OperationalError:
+        g.week_versions = None
+  return g.week_versions
+
+
+def get_week_block_key(kind, week):
+  refdata_version = get_refdata().version
+  week_versions = get_week_versions()
+  if refdata_version is None or week_versions is None:
+    return None
+  return (g.db_path, kind, week, refdata_version, week_versions.get(week, 0))
+
+
+# Rendered lineup/result blocks for one week, reused until that week's data
+# or the reference data changes.
+def get_week_block(kind, week):
+  return get_keyed_week_block(kind, week, get_week_block_key(kind, week))
+
+
+def get_keyed_week_block(kind, week, key):
+  block = week_blocks.get(key) if key is not None else None
+  if block is None:
+    if kind == "lineup":
+      block = flask.render_template("lineup_week.html",
+          week = week,
+          matches = get_lineup_week(week),
+          )
+    else:
+      block = flask.render_template("result_week.html",
+          week = week,
+          season = g.season,
+          matches = get_result_week(week),
+          )
+    block = flask.Markup(block)
+    if key is not None:
+      week_blocks.put(key, block)
+  return block
+
+
+def get_live_link(week):
+  url = app.config.get("EVENTS_URL")
+  if url is None:
+    return flask.url_for(live_feed.__name__, week=week)
+  return "%s?week=%d" % (url, week)
+
+
+# A single-week page is fixed by its block's key, which lets the compression
+# middleware keep the compressed page beside the block.
+def stream_week_page(template_name, kind, week):
+  key = get_week_block_key(kind, week)
+  resp = stream_template(template_name,
+      blocks = [get_keyed_week_block(kind, week, key)],
+      live_link = get_live_link(week),
+      )
+  if key is not None:
+    resp.headers[compress.CACHE_KEY_HEADER] = hashlib.sha1(
+        repr((template_name,) + key)).hexdigest()
+  return resp
+
+
+# Renders incrementally so large pages start going out before they are done.
+# The body is produced after the request (and its database connection) has
+# been torn down, so context values must either be loaded already or come
+# from with_request_context.
+def stream_template(template_name, **context):
+  app.update_template_context(context)
+  template = app.jinja_env.get_template(template_name)
+  stream = template.stream(context)
+  stream.enable_buffering(app.config.get("TEMPLATE_STREAM_BUFFER", 16))
+  return flask.Response(stream, mimetype="text/html")
+
+
+# Wraps a generator so that it runs inside a fresh context for the current
+# request, with its own database connection, while the response streams.
+def with_request_context(generator):
+  environ = flask.request.environ
+  def wrapper():
+    with app.request_context(environ):
+      app.preprocess_request()
+      try:
+        for item in generator():
+          yield item
+      finally:
+        app.do_teardown_request()
+  return wrapper()
+
+
 def get_user_team():
   with contextlib.closing(g.db.cursor()) as cursor:
     cursor.execute("SELECT team FROM accounts WHERE id = ?", (g.account,))
     return list(cursor)[0][0]
 
 
+@app.before_first_request
+def init_template_cache():
+  directory = app.config.get("TEMPLATE_CACHE_DIR")
+  if directory is None:
+    directory = os.path.join(app.config["DATA_DIR"], "template_cache")
+  try:
+    os.makedirs(directory)
+  except OSError as err:
+    if err.errno != errno.EEXIST:
+      raise
+  app.jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+
+
+# Databases from before the event log get its tables, and their existing
+# submissions logged, on startup, along with the reference data and week
+# version triggers and the player history indexes.
+# Ratings are then brought up to date, or computed over every season if the
+# database has none yet.
+@app.before_first_request
+def init_event_log():
+  conn = open_db(get_season_db_path(app.config["SEASON"]))
+  try:
+    refdata.ensure_schema(conn)
+    ensure_week_versions(conn)
+    event_log.backfill(conn)
+    history.ensure_schema(conn)
+    if ratings.has_table(conn):
+      ratings.update(conn)
+      conn.commit()
+    else:
+      ratings.rebuild(conn, [ get_season_db_path(season) for season in get_past_seasons() ])
+  finally:
+    conn.close()
+
+
+def get_snapshot_path():
+  return os.path.join(app.config["DATA_DIR"], "ahgl_snapshot.sq3")
+
+
+def get_snapshot_age(path):
+  try:
+    return time.time() - os.path.getmtime(path)
+  except OSError as err:
+    if err.errno != errno.ENOENT:
+      raise
+    return None
+
+
+# Copies the primary database to path as of a single transaction, then swaps
+# it in.  Connections already open on the old snapshot keep reading it.
+def refresh_snapshot(primary_path, path):
+  start = time.time()
+  temp_path = "%s.%d.tmp" % (path, os.getpid())
+  if os.path.exists(temp_path):
+    os.remove(temp_path)
+  conn = sqlite3.connect(primary_path)
+  try:
+    conn.execute("VACUUM INTO ?", (temp_path,))
+  except sqlite3.OperationalError:
+    # SQLite before 3.27: hold a read transaction, which keeps writers from
+    # committing, while the file is copied.
+    conn.execute("BEGIN")
+    conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchall()
+    shutil.copyfile(primary_path, temp_path)
+    conn.rollback()
+  finally:
+    conn.close()
+  os.rename(temp_path, path)
+  incr_metric("snapshot_refreshes_total")
+  set_metric("snapshot_refresh_seconds", time.time() - start)
+
+
+def open_read_snapshot(primary_path):
+  max_age = app.config["READ_SNAPSHOT_MAX_AGE"]
+  path = get_snapshot_path()
+  age = get_snapshot_age(path)
+  if age is None or age > max_age:
+    with file_lock(path + ".lock"):
+      age = get_snapshot_age(path)
+      if age is None or age > max_age:
+        refresh_snapshot(primary_path, path)
+        age = get_snapshot_age(path)
+  set_metric("snapshot_age_seconds", age)
+  g.snapshot_age = age
+  return path
+
+
+# The current season lives in the small database that takes writes.  Each
+# past season is moved to its own file by new_season.py and only ever read,
+# so its queries never touch (or slow down) the current one.
+def get_season_db_path(season):
+  if season == app.config["SEASON"]:
+    return os.path.join(app.config["DATA_DIR"], "ahgl.sq3")
+  return os.path.join(app.config["DATA_DIR"], "ahgl_season_%s.sq3" % season)
+
+
+def get_past_seasons():
+  seasons = []
+  for fname in os.listdir(app.config["DATA_DIR"]):
+    match = re.match(r"^ahgl_season_([a-zA-Z0-9]+)\.sq3$", fname)
+    if match and match.group(1) != app.config["SEASON"]:
+      seasons.append(match.group(1))
+  return sorted(seasons, key=lambda season: (len(season), season))
+
+
+def season_url_for(endpoint, **values):
+  if g.season != app.config["SEASON"]:
+    values["season"] = g.season
+  return flask.url_for(endpoint, **values)
+
+
+def get_season_links(endpoint):
+  links = [ (season, flask.url_for(endpoint, season=season))
+      for season in get_past_seasons() ]
+  if links:
+    links.append((app.config["SEASON"], flask.url_for(endpoint)))
+  return links
+
+
+@app.context_processor
+def inject_season_url_for():
+  return dict(season_url_for=season_url_for)
+
+
+# Seconds a request may spend before its queries are cancelled: the
+# endpoint's entry in REQUEST_BUDGETS, else in DEFAULT_REQUEST_BUDGETS, else
+# REQUEST_BUDGET, which is meant for pages.  None is no limit.
+DEFAULT_REQUEST_BUDGETS = {
+    "submit_maps": 10.0,
+    "submit_lineup": 10.0,
+    "submit_result": 10.0,
+    "get_replay_pack": 30.0,
+    # These last as long as the client takes.
+    "upload_replay": None,
+    "live_feed": None,
+    }
+
+def get_request_budget(endpoint):
+  budgets = app.config.get("REQUEST_BUDGETS", {})
+  if endpoint in budgets:
+    return budgets[endpoint]
+  if endpoint in DEFAULT_REQUEST_BUDGETS:
+    return DEFAULT_REQUEST_BUDGETS[endpoint]
+  return app.config.get("REQUEST_BUDGET", 2.0)
+
+
+def open_request_db(path):
+  conn = open_db(path)
+  seconds = get_request_budget(flask.request.endpoint)
+  if seconds is not None:
+    g.budget = time_budget.Budget(seconds)
+    time_budget.install(conn, g.budget)
+  return conn
+
+
 @app.before_request
 def before_request():
-  g.db = open_db(os.path.join(app.config["DATA_DIR"], "ahgl.sq3"))
+  if flask.request.endpoint in file_endpoints:
+    return
+  g.season = app.config["SEASON"]
+  g.db_path = get_season_db_path(g.season)
+  if flask.request.endpoint not in read_only_endpoints:
+    g.db = open_request_db(g.db_path)
+    return
+  season = flask.request.args.get("season", g.season)
+  if season != g.season:
+    if not re.match(r"^[a-zA-Z0-9]+$", season):
+      flask.abort(404)
+    g.season = season
+    g.db_path = get_season_db_path(season)
+    if not os.path.exists(g.db_path):
+      flask.abort(404)
+  elif app.config.get("READ_SNAPSHOT_MAX_AGE") is not None:
+    g.db_path = open_read_snapshot(g.db_path)
+  g.db = open_request_db(g.db_path)
+  g.db.execute("PRAGMA query_only = ON")
+
+
+@app.after_request
+def after_request(response):
+  if hasattr(g, "snapshot_age"):
+    response.headers["X-Snapshot-Age"] = "%.1f" % g.snapshot_age
+  budget = getattr(g, "budget", None)
+  if budget is not None and budget.elapsed() > budget.seconds:
+    incr_metric('request_budget_overruns_total{endpoint="%s"}' % flask.request.endpoint)
+  return response
+
+
+# A query cancelled by the time budget.  Rolling back gives up the
+# request's locks now rather than when the connection is closed.
+@app.errorhandler(sqlite3.OperationalError)
+def request_budget_exceeded(err):
+  budget = getattr(g, "budget", None)
+  if budget is None or not budget.exceeded:
+    raise
+  g.db.rollback()
+  incr_metric('request_budget_interrupts_total{endpoint="%s"}' % flask.request.endpoint)
+  app.logger.warning("%s cancelled after %.1fs (budget %.1fs)",
+      flask.request.path, budget.elapsed(), budget.seconds)
+  return ("Server busy, please retry", 503,
+      {"Retry-After": "5", "Content-Type": "text/plain"})
 
 @app.teardown_request
 def teardown_request(exception):
@@ -81,6 +530,89 @@ def debug_page():
          for key, value in flask.request.environ.iteritems()])
 
 
+@app.route("/_metrics")
+@content_type("text/plain")
+def metrics_page():
+  with metrics_lock:
+    items = sorted(metrics.items())
+  return "".join(["%s %s\n" % (key, value) for key, value in items])
+
+
+def publish_live_events(broadcaster, events):
+  for event in events:
+    broadcaster.publish(event.seq, event.kind, event.week, dict(
+        (field, event.payload[field]) for field in LIVE_EVENT_FIELDS[event.kind]))
+
+
+# Feeds live_events from the event log of the current season, so event ids
+# are log sequence numbers: the same in every process and across restarts.
+# Also wakes the subscribers every EVENTS_HEARTBEAT seconds.
+def follow_event_log(path, after):
+  conn = open_db(path)
+  last_tick = time.time()
+  while True:
+    event_feed_wakeup.wait(app.config.get("EVENTS_POLL_INTERVAL", 1))
+    event_feed_wakeup.clear()
+    if time.time() - last_tick >= app.config.get("EVENTS_HEARTBEAT", 15):
+      live_events.tick()
+      last_tick = time.time()
+    try:
+      events = event_log.read(conn, after)
+    except sqlite3.Error:
+      app.logger.exception("Failed to read the event log")
+      continue
+    if events:
+      publish_live_events(live_events, events)
+      after = events[-1].seq
+
+
+def start_event_feed():
+  global event_feed_thread
+  with event_feed_lock:
+    if event_feed_thread is not None:
+      return
+    live_events.max_subscribers = app.config.get("EVENTS_MAX_SUBSCRIBERS", 100)
+    with contextlib.closing(g.db.cursor()) as cursor:
+      cursor.execute("SELECT seq FROM events ORDER BY seq DESC LIMIT 1 OFFSET ?",
+          (live_events.events.maxlen,))
+      rows = list(cursor)
+    start = rows[0][0] if rows else 0
+    live_events.start(start)
+    events = event_log.read(g.db, start)
+    publish_live_events(live_events, events)
+    event_feed_thread = threading.Thread(target=follow_event_log,
+        args=(g.db_path, events[-1].seq if events else start))
+    event_feed_thread.daemon = True
+    event_feed_thread.start()
+
+
+# Server-sent events for maps, lineups and results as they are entered, so
+# the week pages only reload when something changed.  A client that
+# reconnects with Last-Event-ID gets what it missed.  Served from here,
+# every subscriber holds a server thread, so past EVENTS_MAX_SUBSCRIBERS
+# of them the rest are turned away and their pages simply don't update
+# live.  That is for the debug server and small sites: event_server.py
+# serves the same feed to thousands from one thread, and with EVENTS_URL
+# set the pages follow it instead.
+@app.route("/events")
+def live_feed():
+  start_event_feed()
+  try:
+    last_id = int(flask.request.headers.get("Last-Event-ID", ""))
+  except ValueError:
+    last_id = live_events.last_id
+  week = flask.request.args.get("week", type=int)
+  if not live_events.subscribe():
+    incr_metric("live_feed_rejected_total")
+    return ("Too many live viewers", 503,
+        {"Retry-After": "60", "Content-Type": "text/plain"})
+  resp = flask.Response(broadcast.Subscription(live_events, last_id, week),
+      mimetype="text/event-stream")
+  resp.headers["Cache-Control"] = "no-cache, no-transform"
+  resp.headers["X-Accel-Buffering"] = "no"
+  return resp
+
+
 @app.route("/")
 def home_page():
   return flask.render_template("home.html", links=dict(
@@ -90,6 +622,7 @@ def home_page():
       show_result = flask.url_for(show_result_select.__name__),
       enter_result = flask.url_for(enter_result.__name__),
       view_rosters = flask.url_for(view_rosters.__name__),
+      leaderboard = flask.url_for(leaderboard.__name__),
     ))
 
 
@@ -120,9 +653,7 @@ def enter_maps():
   with contextlib.closing(g.db.cursor()) as cursor:
     cursor.execute("SELECT MAX(week) FROM maps")
     week_number = (list(cursor)[0][0] or 0) + 1
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT id, mapname FROM mapnames")
-    map_pool = list(cursor)
+  map_pool = sorted(get_refdata().mapnames.items())
   return flask.render_template("enter_maps.html",
       week_number = week_number,
       num_sets = 5,
@@ -135,64 +666,80 @@ def enter_maps():
 @require_auth
 @require_admin
 def submit_maps():
-  postdata = flask.request.form
+  form = validation.Form(flask.request.form)
 
-  week_number = postdata.getlist("week")
-  if len(week_number) != 1 or not week_number[0]:
-    return "No value submitted for 'week'"
-  week_number = week_number[0]
-  try:
-    week_number = int(week_number)
-  except ValueError:
-    return "Invalid week"
+  week_number = validation.week(form)
+  if week_number is not None:
+    form.expect("Maps already submitted",
+        "SELECT COUNT(*) FROM maps WHERE week = ?", (week_number,),
+        validation.is_zero)
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT COUNT(*) FROM maps WHERE week = ?", (week_number,))
-    if list(cursor) != [(0,)]:
-      return "Maps already submitted"
-
-  for setnum in range(1,5+1):
-    mapid = postdata.get("map_%d" % setnum)
-    if not mapid:
-      return "No value submitted for 'map_%d'" % setnum
-    try:
-      mapid = int(mapid)
-    except ValueError:
-      return "Invalid map"
-    with contextlib.closing(g.db.cursor()) as cursor:
-      cursor.execute(
-          "INSERT INTO maps(week, set_number, mapid) "
-          "VALUES (?,?,?) "
-          , (week_number, setnum, mapid))
+  mapids = [ validation.map_id(form, "map_%d" % setnum, "Invalid map for set %d" % setnum)
+      for setnum in range(1,5+1) ]
+
+  errors = form.validate(g.db)
+  if errors:
+    return flask.render_template("errors.html", errors=errors)
 
+  event_log.record(g.db, "maps", week_number, dict(
+      maps = [ [setnum, mapid] for (setnum, mapid) in enumerate(mapids, 1) ],
+      ))
   g.db.commit()
+  event_feed_wakeup.set()
 
   return flask.render_template("success.html", item_type="Maps")
 
 
 @app.route("/show-lineup")
+@read_only
 def show_lineup_select():
   with contextlib.closing(g.db.cursor()) as cursor:
     cursor.execute("SELECT DISTINCT week FROM maps ORDER BY week")
     weeks = [ int(row[0]) for row in cursor ]
 
-  items = [ (week, flask.url_for(show_lineup_week.__name__, week=week)) for week in weeks ]
+  items = [ (week, season_url_for(show_lineup_week.__name__, week=week)) for week in weeks ]
 
   return flask.render_template("week_list.html",
       item_type = "Lineup",
       items = items,
+      season_link = season_url_for(show_lineup_season.__name__),
+      seasons = get_season_links(show_lineup_select.__name__),
       )
 
 
 @app.route("/show-lineup/<int:week>")
+@read_only
 def show_lineup_week(week):
-  teams = {}
-  captains = {}
+  return stream_week_page("show_lineup.html", "lineup", week)
+
+
+@app.route("/show-lineup/season")
+@read_only
+def show_lineup_season():
+  return stream_template("show_lineup.html",
+      blocks = with_request_context(lambda: season_blocks("lineup")),
+      )
+
+
+def season_blocks(kind):
   with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT id, name, captain_info FROM teams")
-    for tid, name, captain in cursor:
-      teams[tid] = name
-      captains[tid] = captain
+    cursor.execute("SELECT DISTINCT week FROM maps ORDER BY week")
+    weeks = [ int(row[0]) for row in cursor ]
+  for week in weeks:
+    yield get_week_block(kind, week)
+
+
+# What the week templates show.  Tuples rather than dicts, since Jinja
+# looks an attribute up as one first and only then as a key.
+LineupMatch = collections.namedtuple("LineupMatch",
+    "number home away referees home_entered away_entered sets")
+ResultMatch = collections.namedtuple("ResultMatch", "number home away status games")
+ResultGame = collections.namedtuple("ResultGame",
+    "number mapname played home away win_arrow forfeit replay_link")
+
+
+def get_lineup_week(week):
+  teams = get_refdata().teams
 
   with contextlib.closing(g.db.cursor()) as cursor:
     cursor.execute(
@@ -201,69 +748,38 @@ def show_lineup_week(week):
         "FROM matches WHERE week = ?", (week,))
     matches = dict((row[0], (row[1], row[2], row[3], row[4])) for row in cursor)
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT set_number, mapname "
-        "FROM maps JOIN mapnames ON mapid = mapnames.id "
-        "WHERE week = ?", (week,))
-    maps = dict((row[0], row[1]) for row in cursor)
+  maps = get_maps(week)
 
   refs = collections.defaultdict(lambda: "no ref")
   with contextlib.closing(g.db.cursor()) as cursor:
     cursor.execute("SELECT team, referee_name FROM referees WHERE week = ?", (week,))
     refs.update(cursor)
 
-  lineups = collections.defaultdict(dict)
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT l.team, set_number, p.name || '.' || IFNULL(p.char_code, 'COWARD'), race "
-        "FROM lineup l JOIN players p on p.id = l.player "
-        "WHERE week = ? "
-        , (week,))
-    for (team, set_number, player, race) in cursor:
-      lineups[team][set_number] = (player, race)
+  lineups = get_lineups(week)
 
-  # TODO: Jinja-ize this.
   lineup_displays = []
   for (match, (home, away, ref1t, ref2t)) in sorted(matches.items()):
-    lineup_displays.append("<h2>Match %d: %s vs %s</h2>"
-        % (match, cgi.escape(teams[home]), cgi.escape(teams[away])))
-    lineup_displays.append("<h3>Suggested channel: ahgl-%d</h3>" % match)
-    lineup_displays.append("<h3>Captains: %s AND %s</h3>"
-        % tuple(cgi.escape(val) for val in (captains[home], captains[away])))
-    lineup_displays.append("<h3>Referees: %s (%s) AND %s (%s)</h3>"
-        % tuple(cgi.escape(val) for val in (teams[ref1t], refs[ref1t], teams[ref2t], refs[ref2t])))
-    lineup_displays.append("<p>")
+    sets = []
     if lineups[home] and lineups[away]:
       for setnum in range(1,5+1):
-        mapname = maps[setnum]
         if setnum == 5:
           homeplayer = ("ACE", "?")
           awayplayer = ("ACE", "?")
         else:
-          homeplayer = lineups[home][setnum]
-          awayplayer = lineups[away][setnum]
-        lineup_displays.append("%s (%s) &lt; %s &gt; (%s) %s<br>"
-            % tuple(cgi.escape(val) for val in (homeplayer[0], homeplayer[1], mapname, awayplayer[1], awayplayer[0])))
-    else:
-      displays = ["NOT ENTERED", "LINEUP ENTERED"]
-      lineup_displays.append(
-          displays[int(bool(lineups[home]))]
-          + " &lt;&gt; " +
-          displays[int(bool(lineups[away]))]
-          )
-
-  return "".join([("""
-    <html>
-      <head>
-        <title>AHGL Lineup</title>
-      </head>
-      <body>
-        <h1>AHGL Lineup Week %d</h1>
-        %s
-      </body>
-    </html>
-  """ % (week, "".join(lineup_displays))).encode()])
+          homeplayer = (lineups[home][setnum][0].full_name, lineups[home][setnum][1])
+          awayplayer = (lineups[away][setnum][0].full_name, lineups[away][setnum][1])
+        sets.append((homeplayer, maps[setnum], awayplayer))
+    lineup_displays.append(LineupMatch(
+        number = match,
+        home = teams[home],
+        away = teams[away],
+        referees = [ (teams[tid].name, refs[tid]) for tid in (ref1t, ref2t) ],
+        home_entered = bool(lineups[home]),
+        away_entered = bool(lineups[away]),
+        sets = sets,
+        ))
+
+  return lineup_displays
 
 
 @app.route("/enter-lineup")
@@ -277,21 +793,12 @@ def enter_lineup():
   except (ValueError, TypeError):
     pass
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT set_number, mapname "
-        "FROM maps JOIN mapnames ON mapid = mapnames.id "
-        "WHERE week = ?", (week_number,))
-    maps = dict((row[0], row[1]) for row in cursor)
+  maps = get_maps(week_number)
 
   team_number = get_user_team()
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT name FROM teams WHERE id = ?", (team_number,))
-    team_name = list(cursor)[0][0]
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT id, name FROM players WHERE team = ? AND active = 1 ORDER BY name", (team_number,))
-    players = list(cursor)
+  team_name = get_refdata().teams[team_number].name
+  players = [ (player.id, player.name)
+      for player in get_refdata().team_players(team_number, active_only=True) ]
 
   with contextlib.closing(g.db.cursor()) as cursor:
     cursor.execute("SELECT COUNT(*) FROM lineup WHERE week = ? AND team = ?", (week_number, team_number,))
@@ -313,131 +820,85 @@ def enter_lineup():
 @require_auth
 def submit_lineup():
   postdata = flask.request.form
+  form = validation.Form(postdata)
 
-  week_number = postdata.getlist("week")
-  if len(week_number) != 1 or not week_number[0]:
-    return "No value submitted for 'week'"
-  week_number = week_number[0]
-  try:
-    week_number = int(week_number)
-  except ValueError:
-    return "Invalid week"
-
-  teamfield = postdata.getlist("team")
-  if len(teamfield) != 1 or not teamfield[0]:
-    return "No value submitted for 'team'"
-  team_string = teamfield[0]
-  try:
-    team_number = int(team_string)
-  except ValueError:
-    return "Invalid team"
-  if team_number != get_user_team():
-    return "Can't submit for another team"
+  week_number = validation.scheduled_week(form)
+  team_number = validation.captain_team(form, g.account)
+  if week_number is not None and team_number is not None:
+    form.expect("Lineup already submitted",
+        "SELECT COUNT(*) FROM lineup WHERE team = ? AND week = ?",
+        (team_number, week_number), validation.is_zero)
 
   referee = postdata.get("referee")
   if not referee:
-    return "No referee submitted"
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT name FROM teams WHERE id = ?", (team_number,))
-    if len(list(cursor)) != 1:
-      return "Invalid team"
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT DISTINCT week FROM maps WHERE week = ?", (week_number,))
-    if len(list(cursor)) != 1:
-      return "Invalid week"
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT COUNT(*) FROM lineup WHERE team = ? AND week = ?", (team_number, week_number))
-    if list(cursor) != [(0,)]:
-      return "Lineup already submitted"
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT id FROM players WHERE team = ? AND active = 1", (team_number,))
-    eligible_players = set([row[0] for row in cursor])
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "INSERT INTO referees(week, team, referee_name) "
-        "VALUES (?,?,?) "
-        , (week_number, team_number, referee))
-
-  entered_players = set()
+    form.error("No referee submitted")
 
+  lineup = []
   for setnum in range(1,5):
-    player = postdata.getlist("player_%d" % setnum)
-    if len(player) != 1 or not player[0]:
-      return "No value submitted for 'player_%d'" % setnum
-    player = player[0]
-    try:
-      player = int(player)
-    except ValueError:
-      return "Invalid value for player %d" % setnum
-    if player not in eligible_players:
-      return "Player %d is not an eligible team member" % setnum
-    if player in entered_players:
-      return "Duplicate player for player %d" % setnum
-    entered_players.add(player)
-
-    race = postdata.getlist("race_%d" % setnum)
-    if len(race) != 1 or not race[0]:
-      return "No value submitted for 'race_%d'" % setnum
-    race = race[0]
-    if race not in list("TZPR"):
-      return "Invalid race for player %d" % setnum
-
-    with contextlib.closing(g.db.cursor()) as cursor:
-      cursor.execute(
-          "INSERT INTO lineup(week, team, set_number, player, race) "
-          "VALUES (?,?,?,?,?) "
-          , (week_number, team_number, setnum, player, race))
-
+    player = validation.team_player(form, "player_%d" % setnum, team_number,
+        ("Invalid value for player %d" % setnum,
+          "Player %d is not an eligible team member" % setnum))
+    if player is not None and player in [ entry[0] for entry in lineup ]:
+      form.error("Duplicate player for player %d" % setnum)
+    race = validation.race(form, "race_%d" % setnum, "Invalid race for player %d" % setnum)
+    lineup.append((player, race))
+
+  errors = form.validate(g.db)
+  if errors:
+    return flask.render_template("errors.html", errors=errors)
+
+  event_log.record(g.db, "lineup", week_number, dict(
+      team = team_number,
+      referee = referee,
+      lineup = [ list(entry) for entry in lineup ],
+      ))
   g.db.commit()
+  event_feed_wakeup.set()
 
   return flask.render_template("success.html", item_type="Lineup")
 
 
 @app.route("/show-result")
+@read_only
 def show_result_select():
   with contextlib.closing(g.db.cursor()) as cursor:
     cursor.execute("SELECT DISTINCT week FROM maps ORDER BY week")
     weeks = [ int(row[0]) for row in cursor ]
 
-  items = [ (week, flask.url_for(show_result_week.__name__, week=week)) for week in weeks ]
+  items = [ (week, season_url_for(show_result_week.__name__, week=week)) for week in weeks ]
 
   return flask.render_template("week_list.html",
       item_type = "Result",
       items = items,
+      season_link = season_url_for(show_result_season.__name__),
+      seasons = get_season_links(show_result_select.__name__),
+      season_pack = get_archive_link(get_season_archive_name(g.season)),
       )
 
 
 @app.route("/show-result/<int:week>")
+@read_only
 def show_result_week(week):
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT id, name FROM teams")
-    teams = dict(cursor)
+  return stream_week_page("show_result.html", "result", week)
+
+
+@app.route("/show-result/season")
+@read_only
+def show_result_season():
+  return stream_template("show_result.html",
+      blocks = with_request_context(lambda: season_blocks("result")),
+      )
+
+
+def get_result_week(week):
+  teams = dict((team.id, team.name) for team in get_refdata().teams.itervalues())
 
   with contextlib.closing(g.db.cursor()) as cursor:
     cursor.execute("SELECT match_number, home_team, away_team FROM matches WHERE week = ?", (week,))
     matches = dict((row[0], (row[1], row[2])) for row in cursor)
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT set_number, mapname "
-        "FROM maps JOIN mapnames ON mapid = mapnames.id "
-        "WHERE week = ?", (week,))
-    maps = dict((row[0], row[1]) for row in cursor)
-
-  lineups = collections.defaultdict(dict)
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT l.team, set_number, p.name || '.' || IFNULL(p.char_code, 'COWARD'), race "
-        "FROM lineup l JOIN players p on p.id = l.player "
-        "WHERE week = ? "
-        , (week,))
-    for (team, set_number, player, race) in cursor:
-      lineups[team][set_number] = (player, race)
+  maps = get_maps(week)
+  lineups = get_lineups(week)
 
   results = collections.defaultdict(dict)
   with contextlib.closing(g.db.cursor()) as cursor:
@@ -445,78 +906,51 @@ def show_result_week(week):
     for (match_number, set_number, home_winner, away_winner, forfeit, replay_hash) in cursor:
       results[match_number][set_number] = (home_winner, away_winner, forfeit, replay_hash)
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT match_number, "
-        "hp.name || '.' || IFNULL(hp.char_code, 'COWARD'), "
-        "ap.name || '.' || IFNULL(ap.char_code, 'COWARD'), "
-        "home_race, away_race "
-        "FROM ace_matches "
-        "JOIN players hp ON ace_matches.home_player = hp.id "
-        "JOIN players ap ON ace_matches.away_player = ap.id "
-        "WHERE week = ?", (week,))
-    aces = dict((row[0], row[1:]) for row in cursor)
-
-  # TODO: Jinja-ize this.
+  aces = get_aces(week)
+
+  def cleanit(word):
+    return re.sub("[^a-zA-Z0-9]", "", word)
+
   result_displays = []
   for (match, (home, away)) in sorted(matches.items()):
-    result_displays.append("<h2>Match %d: %s vs %s</h2><p>"
-        % (match, cgi.escape(teams[home]), cgi.escape(teams[away])))
     if not results[match]:
-      result_displays.append("No result entered")
+      result_displays.append(ResultMatch(match, teams[home], teams[away], "No result entered", []))
       continue
-    elif not lineups[matches[match][0]] or not lineups[matches[match][1]]:
-      result_displays.append("Missing lineup")
+    elif not lineups[home] or not lineups[away]:
+      result_displays.append(ResultMatch(match, teams[home], teams[away], "Missing lineup", []))
       continue
 
+    games = []
     for setnum in range(1,5+1):
-      result_displays.append(
-          "Game %d (%s): " % (setnum, cgi.escape(maps[setnum])))
       win_tuple = (results[match][setnum][0], results[match][setnum][1])
       if not sum(win_tuple):
-        result_displays.append("Not played<br>")
+        games.append(ResultGame(setnum, maps[setnum], False, None, None, None, False, None))
         continue
       if setnum == 5:
-        homeplayer = (aces[match][0], aces[match][2])
-        awayplayer = (aces[match][1], aces[match][3])
+        homeplayer = (aces[match][0].full_name, aces[match][2])
+        awayplayer = (aces[match][1].full_name, aces[match][3])
       else:
-        homeplayer = lineups[home][setnum]
-        awayplayer = lineups[away][setnum]
+        homeplayer = (lineups[home][setnum][0].full_name, lineups[home][setnum][1])
+        awayplayer = (lineups[away][setnum][0].full_name, lineups[away][setnum][1])
       win_arrows = {(1,0): ">", (0,1): "<"}
-      win_arrow = win_arrows[win_tuple]
-      result_displays.append("%s (%s) %s (%s) %s"
-          % tuple(cgi.escape(val) for val in (homeplayer[0], homeplayer[1], win_arrow, awayplayer[1], awayplayer[0])))
-
-      if results[match][setnum][2]:
-        result_displays.append(" -- forfeit")
-      elif not results[match][setnum][3]:
-        result_displays.append(" -- no replay")
-      else:
-        replayhash = results[match][setnum][3]
-        def cleanit(word):
-          return re.sub("[^a-zA-Z0-9]", "", word)
-        replaylink = "/replay/%s/%s-%s_%d_%s-%s.SC2Replay" % (
+      replay_link = None
+      replayhash = results[match][setnum][3]
+      if replayhash:
+        replay_link = "/replay/%s/%s-%s_%d_%s-%s.SC2Replay" % (
             replayhash, cleanit(teams[home]), cleanit(teams[away]), setnum, cleanit(homeplayer[0]), cleanit(awayplayer[0]))
-        result_displays.append(" -- <a href=\"%s\">replay</a>" % cgi.escape(replaylink, True))
-
-      result_displays.append("<br>")
-
-  return "".join([("""
-    <html>
-      <head>
-        <title>AHGL Result</title>
-      </head>
-      <body>
-        <h1>AHGL Result Week %(week)d</h1>
-        <p><a href="/replay-pack/%(week)d/ahgl_replays_season_%(season)s_week_%(week)d.zip">Replay Pack</a></p>
-        %(display)s
-      </body>
-    </html>
-  """ % dict(
-    week = week,
-    season = app.config["SEASON"],
-    display = "".join(result_displays),
-    )).encode()])
+      games.append(ResultGame(
+          number = setnum,
+          mapname = maps[setnum],
+          played = True,
+          home = homeplayer,
+          away = awayplayer,
+          win_arrow = win_arrows[win_tuple],
+          forfeit = bool(results[match][setnum][2]),
+          replay_link = replay_link,
+          ))
+    result_displays.append(ResultMatch(match, teams[home], teams[away], None, games))
+
+  return result_displays
 
 
 @app.route("/enter-result")
@@ -529,31 +963,20 @@ def enter_result():
   except (ValueError, TypeError):
     pass
 
+  teams = get_refdata().teams
   with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT match_number, ht.name, at.name FROM matches, teams ht, teams at WHERE week = ? AND ht.id = home_team AND at.id = away_team", (week_number,))
-    matches = list(cursor)
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT set_number, mapname "
-        "FROM maps JOIN mapnames ON mapid = mapnames.id "
-        "WHERE week = ?", (week_number,))
-    maps = dict((row[0], row[1]) for row in cursor)
+    cursor.execute("SELECT match_number, home_team, away_team FROM matches WHERE week = ?", (week_number,))
+    week_matches = list(cursor)
+  matches = [ (match, teams[home].name, teams[away].name)
+      for (match, home, away) in week_matches ]
 
   extra_params = {}
-  for role in ["home", "away"]:
-    with contextlib.closing(g.db.cursor()) as cursor:
-      cursor.execute(
-          "SELECT players.id, teams.name, players.name "
-          "FROM matches "
-          "JOIN teams ON matches.%s_team = teams.id "
-          "JOIN players ON teams.id = players.team "
-          "WHERE matches.week = ? AND players.active "
-          % (role,)
-          , (week_number,))
-      extra_params[role + "_aces"] = list(sorted([
-        (pid, tname + " - " + pname) for (pid, tname, pname) in cursor ],
-        key=operator.itemgetter(1)))
+  for role, index in [("home", 1), ("away", 2)]:
+    extra_params[role + "_aces"] = list(sorted([
+      (player.id, teams[row[index]].name + " - " + player.name)
+      for row in week_matches
+      for player in get_refdata().team_players(row[index], active_only=True) ],
+      key=operator.itemgetter(1)))
 
   return flask.render_template("enter_result.html",
       week_number = week_number,
@@ -561,30 +984,22 @@ def enter_result():
       num_sets = 5,
       max_required = 3,
       submit_link = flask.url_for(submit_result.__name__),
+      check_link = flask.url_for(check_replays.__name__),
+      upload_link = flask.url_for(upload_replay.__name__, rephash="HASH"),
       **extra_params)
 
 
 @app.route("/submit-result", methods=["POST"])
 def submit_result():
   postdata = flask.request.form
+  form = validation.Form(postdata)
 
-  week_number = postdata.getlist("week")
-  if len(week_number) != 1 or not week_number[0]:
-    return "No value submitted for 'week'"
-  week_number = week_number[0]
-  try:
-    week_number = int(week_number)
-  except ValueError:
-    return "Invalid week"
-
-  match = postdata.getlist("match")
-  if len(match) != 1 or not match[0]:
-    return "No value submitted for 'match'"
-  match = match[0]
-  try:
-    match = int(match)
-  except ValueError:
-    return "Invalid match"
+  week_number = validation.scheduled_week(form)
+  match = validation.match(form, week_number)
+  if week_number is not None and match is not None:
+    form.expect("Result already submitted",
+        "SELECT COUNT(*) FROM set_results WHERE week = ? AND match_number = ?",
+        (week_number, match), validation.is_zero)
 
   sum_home = 0
   sum_away = 0
@@ -602,123 +1017,199 @@ def submit_result():
     elif sum_home >= 3 or sum_away >= 3:
       winners[setnum] = (0, 0)
     else:
-      return "Invalid winner for set %d" % setnum
-
-  num_sets = sum_home + sum_away
+      form.error("Invalid winner for set %d" % setnum)
+      winners[setnum] = (0, 0)
 
   if sum(winners[5]):
-    home_ace = postdata.get("home_ace")
-    away_ace = postdata.get("away_ace")
-    home_ace_race = postdata.get("home_ace_race")
-    away_ace_race = postdata.get("away_ace_race")
-    # Make sure the aces were specified.
-    if not home_ace:
-      return "No home ace specified."
-    if not away_ace:
-      return "No away ace specified."
-    # Make sure the aces are integers.
-    try:
-      home_ace = int(home_ace)
-      away_ace = int(away_ace)
-    except ValueError:
-      return "Invalid ace specified."
-    # Make sure they are not zero.
-    if not home_ace:
-      return "No home ace specified."
-    if not away_ace:
-      return "No away ace specified."
-    # Make sure the races are there.
-    if not home_ace_race:
-      return "No home ace race specified."
-    if not away_ace_race:
-      return "No away ace race specified."
-    if home_ace_race not in list("TZPR"):
-      return "Invalid home ace race specified."
-    if away_ace_race not in list("TZPR"):
-      return "Invalid home ace race specified."
-    with contextlib.closing(g.db.cursor()) as cursor:
-      cursor.execute(
-          "SELECT home_team, away_team "
-          "FROM matches "
-          "WHERE week = ? AND match_number = ?"
-          , (week_number, match))
-      (home_team, away_team) = list(cursor)[0]
-    with contextlib.closing(g.db.cursor()) as cursor:
-      cursor.execute("SELECT id, team FROM players WHERE id IN (?,?)", (home_ace, away_ace,))
-      membership = dict(cursor)
-    if membership[home_ace] != home_team:
-      return "Home ace is on the wrong team."
-    if membership[away_ace] != away_team:
-      return "Away ace is on the wrong team."
+    home_ace = validation.match_player(form, "home_ace", "home", week_number, match,
+        ("No home ace specified.", "Invalid ace specified.", "Home ace is on the wrong team."))
+    away_ace = validation.match_player(form, "away_ace", "away", week_number, match,
+        ("No away ace specified.", "Invalid ace specified.", "Away ace is on the wrong team."))
+    home_ace_race = validation.race(form, "home_ace_race", "Invalid home ace race specified.",
+        "No home ace race specified.")
+    away_ace_race = validation.race(form, "away_ace_race", "Invalid away ace race specified.",
+        "No away ace race specified.")
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT DISTINCT week FROM maps WHERE week = ?", (week_number,))
-    if len(list(cursor)) != 1:
-      return "Invalid week"
-
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT COUNT(*) FROM matches WHERE week = ? AND match_number = ?", (week_number, match))
-    if list(cursor) != [(1,)]:
-      return "Invalid match"
+  for setnum in range(1, 5+1):
+    # Sent by the upload script once the replay is on the server already.
+    rephash = postdata.get("replay_hash_%d" % setnum)
+    if flask.request.files.get("replay_%d" % setnum) or not rephash:
+      continue
+    if not valid_replay_hash.match(rephash) or not os.path.exists(get_replay_path(rephash)):
+      form.error("Replay for set %d was not uploaded" % setnum)
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT COUNT(*) FROM set_results WHERE week = ? AND match_number = ?", (week_number, match))
-    if list(cursor) != [(0,)]:
-      return "Result already submitted"
+  errors = form.validate(g.db)
+  if errors:
+    return flask.render_template("errors.html", errors=errors)
 
   rephashes = {}
 
   for setnum in range(1, 5+1):
     repfield = flask.request.files.get("replay_%d" % setnum)
-    if not repfield:
-      continue
-    rep = repfield.read()
-    rephash = hashlib.sha1(rep).hexdigest()
-    repfile = os.path.join(app.config["DATA_DIR"], rephash + ".SC2Replay")
-    if not os.path.exists(repfile):
-      with open(repfile, "wb") as handle:
-        handle.write(rep)
-    rephashes[setnum] = rephash
+    if repfield:
+      rephashes[setnum] = store_replay(repfield.read())
+    elif postdata.get("replay_hash_%d" % setnum):
+      rephashes[setnum] = postdata["replay_hash_%d" % setnum]
 
+  sets = []
   for setnum in range(1, 5+1):
     forfeit = 1 if postdata.get("forfeit_%d" % setnum) == "on" else 0
     wins = winners[setnum]
-    g.db.cursor().execute(
-        "INSERT INTO set_results(week, match_number, set_number, home_winner, away_winner, forfeit, replay_hash) "
-        "VALUES (?,?,?,?,?,?,?) "
-        , (week_number, match, setnum, wins[0], wins[1], forfeit, rephashes.get(setnum)))
+    sets.append([wins[0], wins[1], forfeit, rephashes.get(setnum)])
 
+  ace = None
   if sum(winners[5]):
-    g.db.cursor().execute(
-        "INSERT INTO ace_matches(week, match_number, home_player, away_player, home_race, away_race) "
-        "VALUES (?,?,?,?,?,?) "
-        , (week_number, match, home_ace, away_ace, home_ace_race, away_ace_race))
+    ace = dict(
+        home_player = home_ace,
+        away_player = away_ace,
+        home_race = home_ace_race,
+        away_race = away_ace_race,
+        )
 
+  event_log.record(g.db, "result", week_number, dict(
+      match = match,
+      sets = sets,
+      ace = ace,
+      ))
+  ratings.update(g.db)
   g.db.commit()
+  event_feed_wakeup.set()
+  archive_wakeup.set()
 
   return flask.render_template("success.html", item_type="Result")
 
 
+def get_ratings():
+  try:
+    return ratings.load(g.db)
+  except sqlite3.OperationalError:
+    # Season file from before ratings.
+    return {}
+
+
 @app.route("/view-rosters")
+@read_only
 def view_rosters():
   players = []
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT t.name, p.id, p.name, IFNULL(p.char_code, 'COWARD'), p.active "
-        "FROM players p JOIN teams t ON p.team = t.id "
-        "ORDER BY t.name, p.name "
-        )
-    for team, pid, name, char_code, active in cursor:
-      safe_name = re.sub(r'[^a-zA-Z0-9]', '', name)
-      full_name = name + "." + char_code
-      players.append((team, pid, full_name, "replays_" + safe_name + ".zip", active))
+  teams = get_refdata().teams
+  player_ratings = get_ratings()
+  for team in sorted(teams.itervalues(), key=lambda team: team.name):
+    for player in get_refdata().team_players(team.id):
+      rating = player_ratings.get(player.id)
+      players.append((team.name, player.id, player.full_name,
+        get_archive_link(get_player_archive_name(g.season, player.id)),
+        player.active, "%.0f" % rating.rating if rating else ""))
 
   return flask.render_template("view_rosters.html",
       players = players,
       )
 
 
+@app.route("/leaderboard")
+@read_only
+def leaderboard():
+  players = get_refdata().players
+  teams = get_refdata().teams
+  rows = []
+  ranked = sorted(get_ratings().itervalues(),
+      key=lambda rating: (-rating.rating, rating.player))
+  for rank, rating in enumerate(ranked, 1):
+    player = players.get(rating.player)
+    if player is None:
+      continue
+    team = teams.get(player.team)
+    rows.append((rank, player.id, player.full_name, team.name if team else "",
+      "%.0f" % rating.rating, rating.games, rating.wins, rating.games - rating.wins))
+
+  return flask.render_template("leaderboard.html",
+      rows = rows,
+      seasons = get_season_links("leaderboard"),
+      )
+
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+# Cursors are "<week>-<set>-<match>".  Links from before the match was
+# part of it ("<week>-<set>") start at the same place, since no match is 0.
+def parse_history_cursor(value):
+  if value is None:
+    return history.FIRST_PAGE
+  match = re.match(r"^([0-9]+)-([0-9]+)(?:-([0-9]+))?$", value)
+  if not match:
+    return None
+  return int(match.group(1)), int(match.group(2)), int(match.group(3) or 0)
+
+
+def format_history_cursor(cursor):
+  return "%d-%d-%d" % cursor if cursor else None
+
+
+# The player's sets from ?before= on, as display dicts, and the cursor of
+# the next page.
+def get_player_history(player, limit):
+  players = get_refdata().players
+  teams = get_refdata().teams
+  mapnames = get_refdata().mapnames
+  if player not in players:
+    flask.abort(404)
+  before = parse_history_cursor(flask.request.args.get("before"))
+  if before is None:
+    flask.abort(400)
+
+  sets, after = history.get_sets(g.db, player, before, limit)
+  pname = re.sub("[^a-zA-Z0-9]", "", players[player].name)
+  games = []
+  for played in sets:
+    team, opponent_team = played.home_team, played.away_team
+    if not played.home:
+      team, opponent_team = opponent_team, team
+    opponent = players.get(played.opponent)
+    replay_link = None
+    if played.replay_hash:
+      replay_link = flask.url_for("get_replay", rephash=played.replay_hash,
+          fakepath="%s_Week%d-Set%d.SC2Replay" % (pname, played.week, played.set_number))
+    games.append(dict(
+        week = played.week,
+        set = played.set_number,
+        match = played.match,
+        team = teams[team].name,
+        race = played.race,
+        opponent = opponent.full_name if opponent else None,
+        opponent_id = played.opponent,
+        opponent_team = teams[opponent_team].name,
+        opponent_race = played.opponent_race,
+        map = mapnames.get(played.mapid),
+        result = "win" if played.won else "loss",
+        forfeit = bool(played.forfeit),
+        replay = replay_link,
+        ))
+  return games, format_history_cursor(after)
+
+
+@app.route("/player/<int:player>")
+@read_only
+def player_history(player):
+  games, after = get_player_history(player, HISTORY_PAGE_SIZE)
+  return flask.render_template("player_history.html",
+      player = get_refdata().players[player].full_name,
+      games = games,
+      next_link = after and season_url_for("player_history", player=player, before=after),
+      first_link = "before" in flask.request.args and season_url_for("player_history", player=player),
+      )
+
+
+@app.route("/api/player/<int:player>/history")
+@read_only
+def player_history_api(player):
+  limit = flask.request.args.get("limit", HISTORY_PAGE_SIZE, type=int)
+  limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+  games, after = get_player_history(player, limit)
+  return flask.jsonify(player=player, sets=games, next=after)
+
+
 @app.route("/replay/<rephash>/<fakepath>")
+@read_only
 @content_type("application/octet-stream")
 def get_replay(rephash, fakepath):
   match = re.search(r'^[0-9a-f]{40}$', rephash)
@@ -736,109 +1227,428 @@ def get_replay(rephash, fakepath):
     return handle.read()
 
 
-@app.route("/player-replays/<int:player>/<fakepath>")
-@content_type("application/octet-stream")
-def get_player_replays(player, fakepath):
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT name FROM players WHERE id = ?", (player,))
-    pname = list(cursor)[0][0]
+valid_replay_hash = re.compile(r"^[0-9a-f]{40}$")
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT m.week, m.match_number, l.set_number "
-        "FROM matches m JOIN lineup l ON m.week = l.week "
-          "AND (m.home_team = l.team OR m.away_team = l.team) "
-        "WHERE player = ? "
-        , (player,))
-    non_ace_wms = list(cursor)
+def get_replay_path(rephash):
+  return os.path.join(app.config["DATA_DIR"], rephash + ".SC2Replay")
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT week, match_number, 5 "
-        "FROM ace_matches "
-        "WHERE home_player = ? OR away_player = ?"
-        , (player, player))
-    ace_wms = list(cursor)
 
-  prefix = "AHGL_S%s_%s" % (app.config["SEASON"], re.sub("[^a-zA-Z0-9]", "", pname))
+def store_replay(rep):
+  rephash = hashlib.sha1(rep).hexdigest()
+  repfile = get_replay_path(rephash)
+  if not os.path.exists(repfile):
+    with open(repfile, "wb") as handle:
+      handle.write(rep)
+  # Compressed once here so that archives only ever copy it.
+  if replay_zip.read_blob(repfile) is None:
+    replay_zip.prepare_blob(repfile)
+  return rephash
 
-  buf = cStringIO.StringIO()
-  zfile = zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED)
 
-  for w,m,s in sorted(non_ace_wms + ace_wms):
-    with contextlib.closing(g.db.cursor()) as cursor:
-      cursor.execute(
-          "SELECT replay_hash "
-          "FROM set_results "
-          "WHERE week = ? AND match_number = ? AND set_number = ? "
-          , (w,m,s))
-      hashlist = list(cursor)
-      if not hashlist:
-        # Player was in a lineup, but game was not played.
-        continue
-      replayhash = hashlist[0][0]
-      zfile.write(
-        os.path.join(app.config["DATA_DIR"], replayhash + ".SC2Replay"),
-        prefix + "/Week%d-Set%d.SC2Replay" % (w, s))
+def get_upload_dir():
+  directory = os.path.join(app.config["DATA_DIR"], "uploads")
+  try:
+    os.makedirs(directory)
+  except OSError as err:
+    if err.errno != errno.EEXIST:
+      raise
+  return directory
 
-  zfile.close()
 
+# Drops uploads nobody has added to for UPLOAD_MAX_AGE seconds and returns
+# how many are still in progress.
+def prune_uploads(directory):
+  now = time.time()
+  pending = 0
+  for fname in os.listdir(directory):
+    if not fname.endswith(".part"):
+      continue
+    path = os.path.join(directory, fname)
+    try:
+      age = now - os.path.getmtime(path)
+    except OSError as err:
+      if err.errno != errno.ENOENT:
+        raise
+      continue
+    if age < app.config.get("UPLOAD_MAX_AGE", 24 * 60 * 60):
+      pending += 1
+      continue
+    with file_lock(path + ".lock"):
+      try:
+        os.remove(path)
+      except OSError as err:
+        if err.errno != errno.ENOENT:
+          raise
+  return pending
+
+
+# Takes the hashes of the replays about to be submitted and returns the ones
+# the server does not have, so only those need to be sent.
+@app.route("/replay-check", methods=["POST"])
+@require_captain
+def check_replays():
+  hashes = flask.request.form.getlist("hash")
+  if not all(valid_replay_hash.match(rephash) for rephash in hashes):
+    return "Invalid replay hash", 400
+  return flask.jsonify(missing=[ rephash for rephash in hashes
+      if not os.path.exists(get_replay_path(rephash)) ])
+
+
+# Resumable upload of one replay, addressed by its SHA-1.  GET reports how
+# many bytes the server has; PUT appends a chunk at ?offset= of a replay of
+# ?total= bytes, streaming it to the partial file.  The partial file is
+# checked against the hash and moved into place once it is complete.  At
+# most MAX_PENDING_UPLOADS replays can be part way up at once.
+@app.route("/replay-upload/<rephash>", methods=["GET", "PUT"])
+@require_captain
+def upload_replay(rephash):
+  if not valid_replay_hash.match(rephash):
+    flask.abort(404)
+  if os.path.exists(get_replay_path(rephash)):
+    return flask.jsonify(offset=None, complete=True)
+
+  upload_dir = get_upload_dir()
+  part_path = os.path.join(upload_dir, rephash + ".part")
+  with file_lock(part_path + ".lock"):
+    try:
+      offset = os.path.getsize(part_path)
+    except OSError as err:
+      if err.errno != errno.ENOENT:
+        raise
+      offset = 0
+    if flask.request.method == "GET":
+      return flask.jsonify(offset=offset, complete=False)
+
+    try:
+      start = int(flask.request.args.get("offset"))
+      total = int(flask.request.args.get("total"))
+    except (ValueError, TypeError):
+      return "Invalid offset or total", 400
+    if total > app.config.get("MAX_REPLAY_SIZE", 32 << 20):
+      return "Replay too large", 413
+    if start != offset:
+      resp = flask.jsonify(offset=offset, complete=False)
+      resp.status_code = 409
+      return resp
+    length = flask.request.content_length
+    if length is None:
+      return "Content-Length required", 411
+    if offset + length > total:
+      return "Chunk runs past the end of the replay", 400
+    if offset == 0 and prune_uploads(upload_dir) >= app.config.get("MAX_PENDING_UPLOADS", 50):
+      return "Too many uploads in progress", 503
+
+    # A dropped connection leaves what did arrive, to be resumed from.
+    remaining = length
+    with open(part_path, "ab") as handle:
+      while remaining > 0:
+        data = flask.request.stream.read(min(remaining, 1 << 16))
+        if not data:
+          break
+        handle.write(data)
+        remaining -= len(data)
+    offset += length - remaining
+    if offset < total:
+      return flask.jsonify(offset=offset, complete=False)
+
+    digest = hashlib.sha1()
+    with open(part_path, "rb") as handle:
+      for data in iter(lambda: handle.read(1 << 16), ""):
+        digest.update(data)
+    if digest.hexdigest() != rephash:
+      os.remove(part_path)
+      return "Replay does not match its hash", 400
+    os.rename(part_path, get_replay_path(rephash))
+    replay_zip.prepare_blob(get_replay_path(rephash))
+    return flask.jsonify(offset=offset, complete=True)
+
+
+def build_zip(entries):
+  buf = cStringIO.StringIO()
+  replay_zip.write_zip(buf, entries, app.config.get("ZIP_WORKERS"))
   return buf.getvalue()
 
 
+# The replays of every set the player played this season, named by week,
+# match and set under the player's id, so that a rename or a second match
+# in a week never gives a new or clashing name to one already archived.
+PLAYER_REPLAYS = """
+SELECT l.week, m.match_number, l.set_number, s.replay_hash
+FROM lineup l
+JOIN matches m ON m.week = l.week AND l.team IN (m.home_team, m.away_team)
+JOIN set_results s ON s.week = l.week AND s.match_number = m.match_number
+  AND s.set_number = l.set_number
+WHERE l.player = ? AND s.replay_hash IS NOT NULL
+UNION ALL
+SELECT a.week, a.match_number, 5, s.replay_hash
+FROM ace_matches a
+JOIN set_results s ON s.week = a.week AND s.match_number = a.match_number
+  AND s.set_number = 5
+WHERE (a.home_player = ? OR a.away_player = ?) AND s.replay_hash IS NOT NULL
+ORDER BY 1, 2, 3
+"""
+
+def get_player_replay_entries(player):
+  prefix = "AHGL_S%s_Player%d" % (g.season, player)
+  entries = []
+  with contextlib.closing(g.db.cursor()) as cursor:
+    cursor.execute(PLAYER_REPLAYS, (player, player, player))
+    for week, match, setnum, replayhash in cursor:
+      replay_path = get_replay_path(replayhash)
+      if not os.path.exists(replay_path):
+        app.logger.warning("Replay %s is missing; left out", replayhash)
+        continue
+      entries.append((prefix + "/Week%d-Match%d-Set%d.SC2Replay" % (week, match, setnum),
+          replay_path))
+  return entries
+
+
 @app.route("/replay-pack/<int:week>/<fakepath>")
+@read_only
 @content_type("application/zip")
 def get_replay_pack(week, fakepath):
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute("SELECT id, name FROM teams")
-    teams = dict(cursor)
-
-  lineups = collections.defaultdict(dict)
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT l.team, set_number, p.name "
-        "FROM lineup l JOIN players p on p.id = l.player "
-        "WHERE week = ? "
-        , (week,))
-    for (team, set_number, player) in cursor:
-      lineups[team][set_number] = player
+  return build_zip(get_replay_pack_entries(week))
 
-  with contextlib.closing(g.db.cursor()) as cursor:
-    cursor.execute(
-        "SELECT match_number, hp.name, ap.name "
-        "FROM ace_matches "
-        "JOIN players hp ON ace_matches.home_player = hp.id "
-        "JOIN players ap ON ace_matches.away_player = ap.id "
-        "WHERE week = ?", (week,))
-    aces = dict((row[0], row[1:]) for row in cursor)
 
-  buf = cStringIO.StringIO()
-  zfile = zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED)
+# Sets whose lineup or replay is missing are left out (and logged) rather
+# than failing the whole pack.
+def get_replay_pack_entries(week, match_number=None):
+  teams = dict((team.id, team.name) for team in get_refdata().teams.itervalues())
+  lineups = get_lineups(week)
+  aces = get_aces(week)
 
+  entries = []
   with contextlib.closing(g.db.cursor()) as cursor:
     cursor.execute(
         "SELECT m.match_number, m.home_team, m.away_team, s.set_number, s.replay_hash "
         "FROM matches m JOIN set_results s "
         "  ON m.match_number = s.match_number "
         "  AND m.week = ? AND s.week = ? "
-        , (week, week))
+        "WHERE ? IS NULL OR m.match_number = ? "
+        "ORDER BY m.match_number, s.set_number "
+        , (week, week, match_number, match_number))
     for row in cursor:
       match, hteam, ateam, setnum, replayhash = row
       if not replayhash:
         continue
       if setnum < 5:
-        hplayer = lineups[hteam][setnum]
-        aplayer = lineups[ateam][setnum]
+        hplayer = lineups[hteam].get(setnum)
+        aplayer = lineups[ateam].get(setnum)
       else:
-        hplayer = aces[match][0]
-        aplayer = aces[match][1]
+        hplayer, aplayer = aces.get(match, (None, None))[:2]
+      if hplayer is None or aplayer is None:
+        app.logger.warning("No players for week %d match %d set %d; replay left out",
+            week, match, setnum)
+        continue
+      if setnum < 5:
+        hplayer, aplayer = hplayer[0], aplayer[0]
+      replay_path = get_replay_path(replayhash)
+      if not os.path.exists(replay_path):
+        app.logger.warning("Replay %s is missing; left out", replayhash)
+        continue
       def cleanit(word):
         return re.sub("[^a-zA-Z0-9]", "", word)
-      zfile.write(
-        os.path.join(app.config["DATA_DIR"], replayhash + ".SC2Replay"),
+      entries.append((
         "AHGL_S%s_Week-%d/Match-%d_%s-%s/%s-%s_%d_%s-%s.SC2Replay" % (
-          app.config["SEASON"], week, match, cleanit(teams[hteam]), cleanit(teams[ateam]), cleanit(teams[hteam]), cleanit(teams[ateam]), setnum, cleanit(hplayer), cleanit(aplayer)))
+          g.season, week, match, cleanit(teams[hteam]), cleanit(teams[ateam]), cleanit(teams[hteam]), cleanit(teams[ateam]), setnum, cleanit(hplayer.name), cleanit(aplayer.name)),
+        replay_path))
 
-  zfile.close()
+  return entries
 
-  return buf.getvalue()
+
+@contextlib.contextmanager
+def file_lock(path):
+  with open(path, "a") as handle:
+    fcntl.flock(handle, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+# Archives are plain files in DATA_DIR, written only by the archive thread,
+# and downloaded as they are from /archives/<name>.
+ARCHIVE_NAME = re.compile(r"^ahgl_replays_season_[a-zA-Z0-9]+(_player_[0-9]+)?\.zip$")
+
+def get_season_archive_name(season):
+  return "ahgl_replays_season_%s.zip" % season
+
+
+def get_player_archive_name(season, player):
+  return "ahgl_replays_season_%s_player_%d.zip" % (season, player)
+
+
+# A link to the archive, or None while there is none.
+def get_archive_link(name):
+  if not os.path.exists(os.path.join(app.config["DATA_DIR"], name)):
+    return None
+  return flask.url_for(get_archive.__name__, name=name)
+
+
+def get_season_archive_path():
+  return os.path.join(app.config["DATA_DIR"], get_season_archive_name(g.season))
+
+
+def update_season_archive(entries):
+  path = get_season_archive_path()
+  with file_lock(path + ".lock"):
+    replay_zip.append_zip(path, entries, app.config.get("ZIP_WORKERS"))
+
+
+def get_player_archive_path(player):
+  return os.path.join(app.config["DATA_DIR"], get_player_archive_name(g.season, player))
+
+
+def get_match_players(week, match):
+  with contextlib.closing(g.db.cursor()) as cursor:
+    cursor.execute(
+        "SELECT l.player "
+        "FROM matches m JOIN lineup l ON m.week = l.week "
+          "AND (m.home_team = l.team OR m.away_team = l.team) "
+        "WHERE m.week = ? AND m.match_number = ? "
+        "UNION "
+        "SELECT home_player FROM ace_matches WHERE week = ? AND match_number = ? "
+        "UNION "
+        "SELECT away_player FROM ace_matches WHERE week = ? AND match_number = ? "
+        , (week, match) * 3)
+    return [ row[0] for row in cursor ]
+
+
+# Each archive only has the player's new games appended, so a result costs
+# one compression per replay rather than a rebuild of every history.
+def update_player_archives(players):
+  for player in players:
+    entries = get_player_replay_entries(player)
+    path = get_player_archive_path(player)
+    with file_lock(path + ".lock"):
+      replay_zip.append_zip(path, entries, app.config.get("ZIP_WORKERS"))
+
+
+# Archives follow the event log from their own checkpoint.  A pass appends
+# the replays of every result since then at once, so each archive is
+# rewritten once per pass rather than once per result, and only then
+# moves the checkpoint.  A pass that fails (the disk is full, say) leaves
+# it where it was, so the next pass tries those results again rather than
+# leaving them out.
+def update_archives():
+  with file_lock(os.path.join(app.config["DATA_DIR"], "archive_events.lock")):
+    events = event_log.read(g.db, event_log.get_checkpoint(g.db, "archives"))
+    if not events:
+      return
+    try:
+      entries = []
+      players = set()
+      for event in events:
+        if event.kind == "result":
+          entries.extend(get_replay_pack_entries(event.week, event.payload["match"]))
+          players.update(get_match_players(event.week, event.payload["match"]))
+      if entries:
+        update_season_archive(entries)
+      update_player_archives(sorted(players))
+    except Exception:
+      app.logger.exception("Failed to archive events %d-%d; will retry",
+          events[0].seq, events[-1].seq)
+      incr_metric("archive_event_failures_total")
+      return
+    event_log.set_checkpoint(g.db, "archives", events[-1].seq)
+    g.db.commit()
+
+
+# One pass over the current season, outside any request.  Flask 0.8 keeps
+# g in the request context, so the pass borrows one.
+def run_archive_pass():
+  with app.test_request_context():
+    g.season = app.config["SEASON"]
+    g.db_path = get_season_db_path(g.season)
+    g.db = open_db(g.db_path)
+    update_archives()
+
+
+# Archives are brought up to date on a thread of their own, so a submit
+# neither waits for archive writes, which grow with the season, nor fails
+# on them.  Each submit wakes it, and so does every ARCHIVE_POLL_INTERVAL
+# seconds for results taken by other processes.
+def follow_archive_events():
+  while True:
+    archive_wakeup.clear()
+    try:
+      run_archive_pass()
+    except Exception:
+      app.logger.exception("Failed to update the replay archives")
+    archive_wakeup.wait(app.config.get("ARCHIVE_POLL_INTERVAL", 60))
+
+
+@app.before_first_request
+def start_archive_consumer():
+  global archive_thread
+  if not app.config.get("ARCHIVE_IN_BACKGROUND", True):
+    return
+  with archive_lock:
+    if archive_thread is not None:
+      return
+    archive_thread = threading.Thread(target=follow_archive_events)
+    archive_thread.daemon = True
+    archive_thread.start()
+
+
+def send_ranged_file(path, ctype):
+  if app.use_x_sendfile:
+    # The front-end server sends the file, ranges and all.
+    if not os.path.exists(path):
+      flask.abort(404)
+    return flask.send_file(path, ctype, cache_timeout=0)
+  try:
+    handle = open(path, "rb")
+  except IOError as err:
+    if err.errno != errno.ENOENT:
+      raise
+    flask.abort(404)
+
+  stat = os.fstat(handle.fileno())
+  length = stat.st_size
+  etag = "%x-%x-%x" % (stat.st_ino, int(stat.st_mtime * 1000), length)
+  headers = {
+      "Content-Type": ctype,
+      "Accept-Ranges": "bytes",
+      "ETag": '"%s"' % etag,
+      }
+
+  # A resumed download must come from the same version of the file, since
+  # archives are replaced as results come in.
+  start, stop = 0, length
+  status = 200
+  if_range = flask.request.if_range
+  if (flask.request.range is not None and if_range.date is None
+      and if_range.etag in (None, etag)):
+    bounds = flask.request.range.range_for_length(length)
+    if bounds is None:
+      handle.close()
+      headers["Content-Range"] = "bytes */%d" % length
+      return flask.Response("", 416, headers)
+    start, stop = bounds
+    status = 206
+    headers["Content-Range"] = "bytes %d-%d/%d" % (start, stop - 1, length)
+  headers["Content-Length"] = str(stop - start)
+
+  def generate():
+    with handle:
+      handle.seek(start)
+      remaining = stop - start
+      while remaining > 0:
+        data = handle.read(min(remaining, 1 << 16))
+        if not data:
+          break
+        remaining -= len(data)
+        yield data
+
+  return flask.Response(generate(), status, headers, direct_passthrough=True)
+
+
+# What a front-end server would do with /archives/ mapped to DATA_DIR (or
+# does, given USE_X_SENDFILE), for when there is none.
+@app.route("/archives/<name>")
+@file_only
+def get_archive(name):
+  if not ARCHIVE_NAME.match(name):
+    flask.abort(404)
+  return send_ranged_file(os.path.join(app.config["DATA_DIR"], name), "application/zip")
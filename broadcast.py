@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+import json
+import threading
+import collections
+
+
+# Fan-out of small change events to live feed subscribers.  Events go into
+# one shared ring buffer and every waiting subscriber is woken by the same
+# condition.  Subscribers wait without a timeout (on Python 2 a timed wait
+# polls), and a single caller of tick() wakes them all for heartbeats, so an
+# idle subscriber is a blocked thread and nothing more.  Each one does hold
+# a server thread, though, so their number can be capped; event_server.py
+# keeps subscribers as sockets on one thread instead, and calls since() and
+# catch_up() itself.  Subscribers that fall further behind than the buffer
+# reaches are told to reset, i.e. refetch everything.
+
+class Broadcaster(object):
+
+  def __init__(self, history=1000, max_subscribers=None):
+    self.condition = threading.Condition()
+    self.events = collections.deque(maxlen=history)
+    self.last_id = 0
+    # Subscribers at or after this id have every later event available.
+    self.floor = 0
+    self.max_subscribers = max_subscribers
+    self.subscribers = 0
+
+  def subscribe(self):
+    with self.condition:
+      if self.max_subscribers is not None and self.subscribers >= self.max_subscribers:
+        return False
+      self.subscribers += 1
+      return True
+
+  def unsubscribe(self):
+    with self.condition:
+      self.subscribers -= 1
+
+  def start(self, last_id):
+    with self.condition:
+      self.events.clear()
+      self.last_id = self.floor = last_id
+
+  # Ids must increase; events at or below the last one are ignored.
+  def publish(self, event_id, kind, week, fields):
+    fields = dict(fields, week=week)
+    with self.condition:
+      if event_id <= self.last_id:
+        return
+      self.last_id = event_id
+      if len(self.events) == self.events.maxlen:
+        self.floor = self.events[0][0]
+      self.events.append((event_id, kind, week, json.dumps(fields, sort_keys=True)))
+      self.condition.notify_all()
+
+  # Returns the events after last_id, or None if some were already dropped
+  # (or last_id is ahead of the log).
+  def _since(self, last_id):
+    if last_id > self.last_id or last_id < self.floor:
+      return None
+    return [ event for event in self.events if event[0] > last_id ]
+
+  def since(self, last_id):
+    with self.condition:
+      return self._since(last_id)
+
+  # Wakes every waiting subscriber, which sends a heartbeat if nothing
+  # new arrived.
+  def tick(self):
+    with self.condition:
+      self.condition.notify_all()
+
+  def wait(self, last_id, timeout=None):
+    with self.condition:
+      if last_id == self.last_id:
+        self.condition.wait(timeout)
+      return self._since(last_id)
+
+
+def format_event(event_id, kind, data):
+  return "id: %d\nevent: %s\ndata: %s\n\n" % (event_id, kind, data)
+
+
+# The SSE text owed to a subscriber at last_id given what since() returned
+# for it, and the id it is at afterwards.
+def catch_up(broadcaster, last_id, week, events):
+  if events is None:
+    last_id = broadcaster.last_id
+    return format_event(last_id, "reset", "{}"), last_id
+  chunks = []
+  for (event_id, kind, event_week, data) in events:
+    last_id = event_id
+    if week is None or event_week == week:
+      chunks.append(format_event(event_id, kind, data))
+  return "".join(chunks), last_id
+
+
+# Yields the SSE stream for one subscriber, optionally limited to a week.
+def stream(broadcaster, last_id, week):
+  yield "retry: 5000\n\n"
+  while True:
+    events = broadcaster.wait(last_id)
+    if events == []:
+      yield ": heartbeat\n\n"
+      continue
+    text, last_id = catch_up(broadcaster, last_id, week, events)
+    if text:
+      yield text
+
+
+# The response body for a subscriber taken with subscribe(); the server
+# closing it, even before the first chunk, gives the place back.
+class Subscription(object):
+
+  def __init__(self, broadcaster, last_id, week):
+    self.broadcaster = broadcaster
+    self.body = stream(broadcaster, last_id, week)
+    self.closed = False
+
+  def __iter__(self):
+    return self.body
+
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      self.body.close()
+      self.broadcaster.unsubscribe()
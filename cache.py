@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+import threading
+import collections
+
+
+class LRUCache(object):
+
+  def __init__(self, max_entries):
+    self.max_entries = max_entries
+    self.lock = threading.Lock()
+    self.entries = collections.OrderedDict()
+
+  def get(self, key):
+    with self.lock:
+      value = self.entries.pop(key, None)
+      if value is not None:
+        self.entries[key] = value
+      return value
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+import zlib
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+
+# WSGI middleware that compresses text responses for clients that accept it.
+# Bodies are compressed as they stream, flushing after every chunk so pages
+# still render progressively.  A response carrying an X-Cache-Key header is
+# the same for as long as that key is, so its compressed body is kept in the
+# given cache and later requests are answered from there without running
+# the compressor (or iterating the page) again.  Anything that is not text,
+# such as replays and zips, passes through untouched.  Text responses get
+# Vary: Accept-Encoding whether or not this one was compressed, so that a
+# shared cache never hands an uncompressed copy to a client that wanted it
+# compressed, or the reverse.
+
+CACHE_KEY_HEADER = "X-Cache-Key"
+
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    )
+
+
+def parse_accept_encoding(header):
+  qualities = {}
+  for part in header.split(","):
+    params = part.split(";")
+    name = params[0].strip().lower()
+    if not name:
+      continue
+    quality = 1.0
+    for param in params[1:]:
+      key, _, value = param.partition("=")
+      if key.strip() == "q":
+        try:
+          quality = float(value)
+        except ValueError:
+          quality = 0.0
+    qualities[name] = quality
+  return qualities
+
+
+def choose_encoding(header):
+  qualities = parse_accept_encoding(header or "")
+  best, best_quality = None, 0.0
+  for encoding in (["br"] if brotli is not None else []) + ["gzip"]:
+    quality = qualities.get(encoding, qualities.get("*", 0.0))
+    if quality > best_quality:
+      best, best_quality = encoding, quality
+  return best
+
+
+class GzipStream(object):
+
+  def __init__(self, level):
+    self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+  def compress(self, data):
+    return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+  def finish(self):
+    return self.compressor.flush()
+
+
+class BrotliStream(object):
+
+  def __init__(self, level):
+    self.compressor = brotli.Compressor(quality=min(level, 11))
+
+  def compress(self, data):
+    return self.compressor.process(data) + self.compressor.flush()
+
+  def finish(self):
+    return self.compressor.finish()
+
+
+STREAMS = {"gzip": GzipStream, "br": BrotliStream}
+
+
+def is_compressible(status, headers):
+  if not status.startswith("200"):
+    return False
+  ctype = ""
+  for name, value in headers:
+    name = name.lower()
+    if name == "content-type":
+      ctype = value.lower()
+    elif name in ("content-encoding", "content-range"):
+      return False
+    elif name == "cache-control" and "no-transform" in value.lower():
+      return False
+  return ctype.startswith(COMPRESSIBLE_TYPES)
+
+
+def add_vary(headers):
+  for index, (name, value) in enumerate(headers):
+    if name.lower() == "vary":
+      if "accept-encoding" not in value.lower() and value.strip() != "*":
+        headers[index] = (name, value + ", Accept-Encoding")
+      return headers
+  return headers + [("Vary", "Accept-Encoding")]
+
+
+def get_content_length(headers):
+  for name, value in headers:
+    if name.lower() == "content-length":
+      try:
+        return int(value)
+      except ValueError:
+        return None
+  return None
+
+
+class CompressMiddleware(object):
+
+  def __init__(self, app, cache, min_size=512, level=6):
+    self.app = app
+    self.cache = cache
+    self.min_size = min_size
+    self.level = level
+
+  def __call__(self, environ, start_response):
+    encoding = choose_encoding(environ.get("HTTP_ACCEPT_ENCODING"))
+    if encoding is None:
+      return self.app(environ, self.pass_through(start_response))
+
+    response = []
+    written = []
+    def capture(status, headers, exc_info=None):
+      response[:] = [status, headers, exc_info]
+      return written.append
+    app_iter = self.app(environ, capture)
+    status, headers, exc_info = response
+
+    cache_key = None
+    for name, value in headers:
+      if name == CACHE_KEY_HEADER:
+        cache_key = ("compressed", value, encoding)
+    headers = [ (name, value) for (name, value) in headers if name != CACHE_KEY_HEADER ]
+
+    if not is_compressible(status, headers):
+      start_response(status, headers, exc_info)
+      return self.prepend(written, app_iter)
+    headers = add_vary(headers)
+    length = get_content_length(headers)
+    if length is not None and length < self.min_size:
+      start_response(status, headers, exc_info)
+      return self.prepend(written, app_iter)
+
+    headers = [ (name, value) for (name, value) in headers
+        if name.lower() != "content-length" ]
+    headers.append(("Content-Encoding", encoding))
+
+    cached = self.cache.get(cache_key) if cache_key is not None else None
+    if cached is not None:
+      if hasattr(app_iter, "close"):
+        app_iter.close()
+      start_response(status, headers + [("Content-Length", str(len(cached)))], exc_info)
+      return [cached]
+
+    start_response(status, headers, exc_info)
+    return self.compress(self.prepend(written, app_iter), encoding, cache_key)
+
+  def pass_through(self, start_response):
+    def wrapper(status, headers, exc_info=None):
+      headers = [ (name, value) for (name, value) in headers if name != CACHE_KEY_HEADER ]
+      if is_compressible(status, headers):
+        headers = add_vary(headers)
+      return start_response(status, headers, exc_info)
+    return wrapper
+
+  def prepend(self, written, app_iter):
+    for data in written:
+      yield data
+    try:
+      for data in app_iter:
+        yield data
+    finally:
+      if hasattr(app_iter, "close"):
+        app_iter.close()
+
+  def compress(self, body, encoding, cache_key):
+    stream = STREAMS[encoding](self.level)
+    chunks = []
+    for data in body:
+      if not data:
+        continue
+      data = stream.compress(data)
+      chunks.append(data)
+      yield data
+    data = stream.finish()
+    chunks.append(data)
+    yield data
+    if cache_key is not None:
+      self.cache.put(cache_key, "".join(chunks))
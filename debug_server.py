@@ -16,4 +16,5 @@ if __name__ == '__main__':
 
   ahgl_admin.app.config.from_object(__name__)
   ahgl_admin.app.secret_key = 'AHGL'
-  ahgl_admin.app.run(debug=True)
+  # Threaded, since every open week page holds a live feed connection.
+  ahgl_admin.app.run(debug=True, threaded=True)
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import contextlib
+import collections
+
+import refdata
+
+
+# Every accepted submission is appended to the events table as a typed
+# event, and the maps/lineup/result rows are written by applying that event,
+# all in the submitter's transaction.  So the log always matches the tables:
+# consumers tail it from a checkpoint to keep derived state up to date, and
+# replaying it onto the reference tables rebuilds (or mirrors) a database.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT,
+  week INTEGER,
+  payload TEXT,
+  created REAL
+);
+
+CREATE TABLE IF NOT EXISTS checkpoints (
+  consumer TEXT PRIMARY KEY,
+  seq INTEGER
+);
+"""
+
+# Tables that are maintained by hand rather than through submissions.
+# accounts is one too, but its login keys stay with the primary database.
+REFERENCE_TABLES = ["teams", "players", "mapnames", "matches"]
+
+Event = collections.namedtuple("Event", "seq kind week payload created")
+
+
+def apply_maps(cursor, week, payload):
+  for setnum, mapid in payload["maps"]:
+    cursor.execute(
+        "INSERT INTO maps(week, set_number, mapid) "
+        "VALUES (?,?,?) "
+        , (week, setnum, mapid))
+
+
+def apply_lineup(cursor, week, payload):
+  cursor.execute(
+      "INSERT INTO referees(week, team, referee_name) "
+      "VALUES (?,?,?) "
+      , (week, payload["team"], payload["referee"]))
+  for setnum, (player, race) in enumerate(payload["lineup"], 1):
+    cursor.execute(
+        "INSERT INTO lineup(week, team, set_number, player, race) "
+        "VALUES (?,?,?,?,?) "
+        , (week, payload["team"], setnum, player, race))
+
+
+def apply_result(cursor, week, payload):
+  for setnum, (home_winner, away_winner, forfeit, replay_hash) in enumerate(payload["sets"], 1):
+    cursor.execute(
+        "INSERT INTO set_results(week, match_number, set_number, home_winner, away_winner, forfeit, replay_hash) "
+        "VALUES (?,?,?,?,?,?,?) "
+        , (week, payload["match"], setnum, home_winner, away_winner, forfeit, replay_hash))
+  ace = payload.get("ace")
+  if ace:
+    cursor.execute(
+        "INSERT INTO ace_matches(week, match_number, home_player, away_player, home_race, away_race) "
+        "VALUES (?,?,?,?,?,?) "
+        , (week, payload["match"], ace["home_player"], ace["away_player"], ace["home_race"], ace["away_race"]))
+
+
+APPLY = {
+    "maps": apply_maps,
+    "lineup": apply_lineup,
+    "result": apply_result,
+    }
+
+
+def append(cursor, kind, week, payload, seq=None, created=None):
+  cursor.execute(
+      "INSERT INTO events(seq, kind, week, payload, created) "
+      "VALUES (?,?,?,?,?) "
+      , (seq, kind, week, json.dumps(payload, sort_keys=True),
+        time.time() if created is None else created))
+  return cursor.lastrowid
+
+
+# Logs the event and applies it.  The caller commits.
+def record(conn, kind, week, payload):
+  with contextlib.closing(conn.cursor()) as cursor:
+    seq = append(cursor, kind, week, payload)
+    APPLY[kind](cursor, week, payload)
+  return seq
+
+
+def read(conn, after=0, limit=None):
+  with contextlib.closing(conn.cursor()) as cursor:
+    cursor.execute(
+        "SELECT seq, kind, week, payload, created FROM events "
+        "WHERE seq > ? ORDER BY seq LIMIT ?"
+        , (after, -1 if limit is None else limit))
+    return [ Event(seq, kind, week, json.loads(payload), created)
+        for (seq, kind, week, payload, created) in cursor ]
+
+
+def last_seq(conn):
+  with contextlib.closing(conn.cursor()) as cursor:
+    cursor.execute("SELECT MAX(seq) FROM events")
+    return list(cursor)[0][0] or 0
+
+
+def get_checkpoint(conn, consumer):
+  with contextlib.closing(conn.cursor()) as cursor:
+    cursor.execute("SELECT seq FROM checkpoints WHERE consumer = ?", (consumer,))
+    rows = list(cursor)
+  return rows[0][0] if rows else 0
+
+
+def set_checkpoint(conn, consumer, seq):
+  with contextlib.closing(conn.cursor()) as cursor:
+    cursor.execute("INSERT OR REPLACE INTO checkpoints VALUES (?,?)", (consumer, seq))
+
+
+def ensure_schema(conn):
+  conn.executescript(SCHEMA)
+
+
+# Logs the submissions already in a database that predates the log, in the
+# order they could have been entered.  Does nothing once events exist.
+def backfill(conn):
+  ensure_schema(conn)
+  conn.execute("BEGIN IMMEDIATE")
+  if last_seq(conn):
+    conn.rollback()
+    return 0
+  events = []
+  weeks = conn.execute(
+      "SELECT week FROM maps UNION SELECT week FROM referees "
+      "UNION SELECT week FROM set_results ORDER BY week").fetchall()
+  for (week,) in weeks:
+    maps = conn.execute(
+        "SELECT set_number, mapid FROM maps WHERE week = ? ORDER BY set_number", (week,)).fetchall()
+    if maps:
+      events.append(("maps", week, {"maps": [ list(row) for row in maps ]}))
+    for (team, referee) in conn.execute(
+        "SELECT team, referee_name FROM referees WHERE week = ? ORDER BY team", (week,)).fetchall():
+      lineup = conn.execute(
+          "SELECT player, race FROM lineup WHERE week = ? AND team = ? ORDER BY set_number"
+          , (week, team)).fetchall()
+      events.append(("lineup", week, {"team": team, "referee": referee,
+          "lineup": [ list(row) for row in lineup ]}))
+    for (match,) in conn.execute(
+        "SELECT DISTINCT match_number FROM set_results WHERE week = ? ORDER BY match_number", (week,)).fetchall():
+      sets = conn.execute(
+          "SELECT home_winner, away_winner, forfeit, replay_hash FROM set_results "
+          "WHERE week = ? AND match_number = ? ORDER BY set_number", (week, match)).fetchall()
+      ace = conn.execute(
+          "SELECT home_player, away_player, home_race, away_race FROM ace_matches "
+          "WHERE week = ? AND match_number = ?", (week, match)).fetchall()
+      events.append(("result", week, {"match": match, "sets": [ list(row) for row in sets ],
+          "ace": dict(zip(["home_player", "away_player", "home_race", "away_race"], ace[0])) if ace else None}))
+  with contextlib.closing(conn.cursor()) as cursor:
+    for kind, week, payload in events:
+      append(cursor, kind, week, payload)
+  conn.commit()
+  return len(events)
+
+
+# Makes the reference table match the attached "source" database, touching
+# only rows that differ so the version triggers fire only for real changes.
+# Rows are compared with IS, under which NULLs (a match without a backup
+# referee) are equal, as they are to EXCEPT.
+def sync_table(conn, table):
+  names = [ row[1] for row in conn.execute("PRAGMA main.table_info(%s)" % table) ]
+  columns = ", ".join(names)
+  conn.execute("DELETE FROM main.%s WHERE NOT EXISTS (SELECT 1 FROM source.%s AS s WHERE %s)"
+      % (table, table, " AND ".join("s.%s IS main.%s.%s" % (name, table, name) for name in names)))
+  conn.execute("INSERT OR REPLACE INTO main.%s (%s) SELECT %s FROM source.%s EXCEPT SELECT %s FROM main.%s"
+      % (table, columns, columns, table, columns, table))
+
+
+# Brings dest up to date with source: reference tables are copied, then the
+# events dest has not seen yet are applied with their original sequence.
+def replay(source_path, dest_path, schema_path="./schema.sql"):
+  fresh = not os.path.exists(dest_path)
+  source = sqlite3.connect(source_path)
+  dest = sqlite3.connect(dest_path)
+  try:
+    if fresh:
+      with open(schema_path) as handle:
+        dest.executescript(handle.read())
+    ensure_schema(dest)
+    refdata.ensure_schema(dest)
+    dest.execute("ATTACH DATABASE ? AS source", (source_path,))
+    for table in REFERENCE_TABLES:
+      sync_table(dest, table)
+    events = read(source, last_seq(dest))
+    with contextlib.closing(dest.cursor()) as cursor:
+      for event in events:
+        append(cursor, event.kind, event.week, event.payload, event.seq, event.created)
+        APPLY[event.kind](cursor, event.week, event.payload)
+    dest.commit()
+    return len(events)
+  finally:
+    source.close()
+    dest.close()
+
+
+def tail(path, after, consumer, follow, interval, out=sys.stdout):
+  conn = sqlite3.connect(path)
+  try:
+    if consumer is not None:
+      after = get_checkpoint(conn, consumer)
+    while True:
+      events = read(conn, after)
+      for event in events:
+        print >>out, json.dumps(event._asdict(), sort_keys=True)
+      out.flush()
+      if events:
+        after = events[-1].seq
+        if consumer is not None:
+          set_checkpoint(conn, consumer, after)
+          conn.commit()
+      if not follow:
+        return
+      time.sleep(interval)
+  finally:
+    conn.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Read, replay or backfill the submission event log.")
+  commands = parser.add_subparsers(dest="command")
+
+  tail_parser = commands.add_parser("tail", help="print events as JSON lines")
+  tail_parser.add_argument("db")
+  tail_parser.add_argument("--after", type=int, default=0, help="start after this sequence number")
+  tail_parser.add_argument("--consumer", help="start from, and advance, this consumer's checkpoint")
+  tail_parser.add_argument("--follow", action="store_true", help="keep waiting for new events")
+  tail_parser.add_argument("--interval", type=float, default=1.0)
+
+  replay_parser = commands.add_parser("replay", help="apply new events to another database")
+  replay_parser.add_argument("source")
+  replay_parser.add_argument("dest", help="created from schema.sql if it does not exist")
+
+  backfill_parser = commands.add_parser("backfill", help="log the submissions of an existing database")
+  backfill_parser.add_argument("db")
+
+  options = parser.parse_args()
+  if options.command == "tail":
+    tail(options.db, options.after, options.consumer, options.follow, options.interval)
+  elif options.command == "replay":
+    print "%d events applied" % replay(options.source, options.dest)
+  else:
+    conn = sqlite3.connect(options.db)
+    try:
+      print "%d events logged" % backfill(conn)
+    finally:
+      conn.close()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+import time
+import socket
+import logging
+import sqlite3
+import asyncore
+import asynchat
+import argparse
+import urlparse
+
+import ahgl_admin
+import broadcast
+import event_log
+
+
+# The live feed (/events) as its own evented process, for more viewers than
+# the app's server has threads.  Every subscriber is a socket and an output
+# buffer on one thread, so an idle one costs a file descriptor and a few
+# hundred bytes.  It follows the event log of the season database on its
+# own, sends each subscriber the events of its week as they arrive, and
+# heartbeats every --heartbeat seconds.  A subscriber that stops reading is
+# dropped once --max-pending bytes are waiting for it, and catches up from
+# Last-Event-ID when it reconnects.  Run it behind the same front-end as
+# the app, with /events routed to it, or point EVENTS_URL at it.
+
+RESPONSE_HEADERS = (
+    "HTTP/1.1 200 OK\r\n"
+    "Content-Type: text/event-stream\r\n"
+    "Cache-Control: no-cache, no-transform\r\n"
+    "X-Accel-Buffering: no\r\n"
+    "Access-Control-Allow-Origin: *\r\n"
+    "Connection: close\r\n"
+    "\r\n")
+NOT_FOUND = "HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+MAX_REQUEST_SIZE = 8192
+
+
+class FeedConnection(asynchat.async_chat):
+
+  def __init__(self, sock, server):
+    asynchat.async_chat.__init__(self, sock, server.map)
+    self.server = server
+    self.request = []
+    self.request_size = 0
+    self.last_id = None
+    self.week = None
+    self.set_terminator("\r\n\r\n")
+
+  def collect_incoming_data(self, data):
+    if self.last_id is not None:
+      # Nothing more is expected from a subscriber.
+      return
+    self.request.append(data)
+    self.request_size += len(data)
+    if self.request_size > MAX_REQUEST_SIZE:
+      self.close()
+
+  def found_terminator(self):
+    lines = "".join(self.request).split("\r\n")
+    self.request = []
+    self.set_terminator(None)
+    parts = lines[0].split(" ")
+    url = urlparse.urlsplit(parts[1] if len(parts) > 1 else "")
+    if parts[0] != "GET" or url.path != self.server.path:
+      self.push(NOT_FOUND)
+      self.close_when_done()
+      return
+    headers = dict((name.strip().lower(), value.strip())
+        for (name, _, value) in (line.partition(":") for line in lines[1:]))
+    try:
+      self.week = int(urlparse.parse_qs(url.query)["week"][0])
+    except (KeyError, ValueError):
+      self.week = None
+    try:
+      self.last_id = int(headers.get("last-event-id", ""))
+    except ValueError:
+      self.last_id = self.server.broadcaster.last_id
+    self.push(RESPONSE_HEADERS + "retry: 5000\n\n")
+    self.server.subscribers.add(self)
+    self.send_events()
+
+  def send_text(self, text):
+    if self not in self.server.subscribers:
+      # Dropped earlier in the same round.
+      return
+    # Event kinds come from SQLite as unicode, and async_chat would send
+    # the raw buffer of that.
+    self.push(text.encode("utf-8"))
+    if len(self.producer_fifo) * self.ac_out_buffer_size > self.server.max_pending:
+      self.close()
+
+  def send_events(self):
+    events = self.server.broadcaster.since(self.last_id)
+    text, self.last_id = broadcast.catch_up(self.server.broadcaster,
+        self.last_id, self.week, events)
+    if text:
+      self.send_text(text)
+
+  def handle_error(self):
+    logging.exception("Dropping a live feed connection")
+    self.close()
+
+  def close(self):
+    self.server.subscribers.discard(self)
+    asynchat.async_chat.close(self)
+
+
+class FeedServer(asyncore.dispatcher):
+
+  def __init__(self, address, broadcaster, path="/events", max_pending=1 << 18, map=None):
+    self.map = {} if map is None else map
+    asyncore.dispatcher.__init__(self, map=self.map)
+    self.broadcaster = broadcaster
+    self.path = path
+    self.max_pending = max_pending
+    self.subscribers = set()
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind(address)
+    self.listen(1024)
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is not None:
+      FeedConnection(pair[0], self)
+
+  def send_events(self):
+    for subscriber in list(self.subscribers):
+      subscriber.send_events()
+
+  def heartbeat(self):
+    for subscriber in list(self.subscribers):
+      subscriber.send_text(": heartbeat\n\n")
+
+  # Waits up to timeout seconds for the sockets to be ready, and serves them.
+  def poll(self, timeout):
+    asyncore.loop(timeout, True, self.map, 1)
+
+  def close_all(self):
+    asyncore.close_all(self.map)
+
+
+def serve(db_path, address, poll_interval, heartbeat, history, max_pending):
+  conn = sqlite3.connect(db_path)
+  rows = conn.execute("SELECT seq FROM events ORDER BY seq DESC LIMIT 1 OFFSET ?",
+      (history,)).fetchall()
+  after = rows[0][0] if rows else 0
+  live = broadcast.Broadcaster(history)
+  live.start(after)
+  server = FeedServer(address, live, max_pending=max_pending)
+  next_poll = last_tick = time.time()
+  while True:
+    server.poll(max(0, min(next_poll, last_tick + heartbeat) - time.time()))
+    now = time.time()
+    if now >= next_poll:
+      next_poll = now + poll_interval
+      try:
+        events = event_log.read(conn, after)
+      except sqlite3.Error:
+        logging.exception("Failed to read the event log")
+        events = []
+      if events:
+        ahgl_admin.publish_live_events(live, events)
+        after = events[-1].seq
+        server.send_events()
+    if now - last_tick >= heartbeat:
+      last_tick = now
+      server.heartbeat()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Serve the live feed of a season's submissions.")
+  parser.add_argument("db", help="the current season's database")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=5001)
+  parser.add_argument("--interval", type=float, default=1.0,
+      help="seconds between reads of the event log")
+  parser.add_argument("--heartbeat", type=float, default=15.0,
+      help="seconds between heartbeats, which keep idle connections open")
+  parser.add_argument("--history", type=int, default=1000,
+      help="events kept for subscribers that reconnect")
+  parser.add_argument("--max-pending", type=int, default=1 << 18,
+      help="bytes waiting for a subscriber before it is dropped")
+  options = parser.parse_args()
+
+  logging.basicConfig()
+  serve(options.db, (options.host, options.port), options.interval,
+      options.heartbeat, options.history, options.max_pending)
+
+
+if __name__ == '__main__':
+  main()
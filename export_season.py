@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+import os
+import re
+import gzip
+import json
+import errno
+import sqlite3
+import argparse
+import tempfile
+import contextlib
+
+import ahgl_admin
+import refdata
+
+
+# Exports a season as one row per played set, with the schedule, map,
+# players, races and result already joined in, for analysis elsewhere.
+# Each week goes to its own part file: a gzip stream of JSON lines, each
+# line one batch of rows stored column by column ({"week": [...], ...}),
+# so neither side holds more than a batch in memory.  With pandas:
+#
+#   pandas.concat(pandas.DataFrame(batch) for batch in read_part(path))
+#
+# manifest.json lists the parts with the week version each was written at.
+# A later run only writes weeks that are new or have changed since, unless
+# teams, players or map names changed, which redoes them all, and removes
+# the parts of weeks that no longer have any results.
+
+FORMAT = "ahgl-set-columns-1"
+MANIFEST = "manifest.json"
+PART_NAME = re.compile(r"^week_\d{3,}\.json\.gz$")
+
+COLUMNS = [
+    "season", "week", "match", "set", "map",
+    "home_team", "home_team_name", "away_team", "away_team_name",
+    "home_player", "home_player_name", "home_race",
+    "away_player", "away_player_name", "away_race",
+    "winner", "forfeit", "replay_hash", "replay_bytes",
+    ]
+
+# Sets 1-4 are played by the lineups; set 5 is the ace match.
+SETS = """
+SELECT s.week, s.match_number, s.set_number, mn.mapname,
+    m.home_team, ht.name, m.away_team, at.name,
+    hp.id, hp.name, COALESCE(a.home_race, hl.race),
+    ap.id, ap.name, COALESCE(a.away_race, al.race),
+    CASE WHEN s.home_winner THEN 'home' ELSE 'away' END,
+    s.forfeit, s.replay_hash
+FROM set_results s
+JOIN matches m ON m.week = s.week AND m.match_number = s.match_number
+LEFT JOIN teams ht ON ht.id = m.home_team
+LEFT JOIN teams at ON at.id = m.away_team
+LEFT JOIN maps mp ON mp.week = s.week AND mp.set_number = s.set_number
+LEFT JOIN mapnames mn ON mn.id = mp.mapid
+LEFT JOIN lineup hl ON hl.week = s.week AND hl.team = m.home_team AND hl.set_number = s.set_number
+LEFT JOIN lineup al ON al.week = s.week AND al.team = m.away_team AND al.set_number = s.set_number
+LEFT JOIN ace_matches a ON a.week = s.week AND a.match_number = s.match_number AND s.set_number = 5
+LEFT JOIN players hp ON hp.id = COALESCE(a.home_player, hl.player)
+LEFT JOIN players ap ON ap.id = COALESCE(a.away_player, al.player)
+WHERE s.week = ? AND s.home_winner + s.away_winner = 1
+ORDER BY s.match_number, s.set_number
+"""
+
+
+def get_week_versions(conn):
+  with contextlib.closing(conn.cursor()) as cursor:
+    cursor.execute("SELECT DISTINCT week FROM set_results ORDER BY week")
+    weeks = dict((row[0], None) for row in cursor)
+    try:
+      cursor.execute("SELECT week, version FROM week_versions")
+    except sqlite3.OperationalError:
+      # Database predates week_versions; weeks are exported once.
+      return weeks
+    for week, version in cursor:
+      if week in weeks:
+        weeks[week] = version
+  return weeks
+
+
+def get_replay_bytes(data_dir, rephash):
+  if not rephash:
+    return None
+  try:
+    return os.path.getsize(os.path.join(data_dir, rephash + ".SC2Replay"))
+  except OSError as err:
+    if err.errno != errno.ENOENT:
+      raise
+    return None
+
+
+def iter_batches(conn, season, week, data_dir, batch_size):
+  with contextlib.closing(conn.cursor()) as cursor:
+    cursor.execute(SETS, (week,))
+    while True:
+      rows = cursor.fetchmany(batch_size)
+      if not rows:
+        return
+      rows = [ (season,) + row + (get_replay_bytes(data_dir, row[-1]),) for row in rows ]
+      yield dict(zip(COLUMNS, map(list, zip(*rows))))
+
+
+def write_atomic(path, write):
+  fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+      prefix=os.path.basename(path) + ".")
+  try:
+    with os.fdopen(fd, "wb") as handle:
+      write(handle)
+    os.rename(temp_path, path)
+  except:
+    os.remove(temp_path)
+    raise
+
+
+def write_part(path, batches):
+  counts = [0]
+  def write(handle):
+    with gzip.GzipFile(fileobj=handle, mode="wb", mtime=0) as out:
+      for batch in batches:
+        out.write(json.dumps(batch, sort_keys=True, separators=(",", ":")) + "\n")
+        counts[0] += len(batch["week"])
+  write_atomic(path, write)
+  return counts[0]
+
+
+def read_part(path):
+  with gzip.open(path, "rb") as handle:
+    for line in handle:
+      yield json.loads(line)
+
+
+def load_manifest(out_dir):
+  try:
+    with open(os.path.join(out_dir, MANIFEST)) as handle:
+      return json.load(handle)
+  except IOError as err:
+    if err.errno != errno.ENOENT:
+      raise
+    return None
+
+
+def save_manifest(out_dir, manifest):
+  write_atomic(os.path.join(out_dir, MANIFEST),
+      lambda handle: json.dump(manifest, handle, indent=1, sort_keys=True))
+
+
+def remove(path):
+  try:
+    os.remove(path)
+  except OSError as err:
+    if err.errno != errno.ENOENT:
+      raise
+
+
+# Writes the weeks that are new or changed since the last export to out_dir,
+# removes the parts of weeks that are gone, and returns the numbers of both.
+# The manifest is saved after every part, and before any part it no longer
+# lists is removed, so an interrupted export picks up where it stopped.
+def export(db_path, data_dir, season, out_dir, batch_size=1000, full=False):
+  try:
+    os.makedirs(out_dir)
+  except OSError as err:
+    if err.errno != errno.EEXIST:
+      raise
+
+  with contextlib.closing(sqlite3.connect(db_path)) as conn:
+    conn.execute("PRAGMA query_only = ON")
+    # One read transaction, so every part sees the same state.
+    conn.execute("BEGIN")
+    version = refdata.get_version(conn)
+    manifest = None if full else load_manifest(out_dir)
+    if (manifest is None or manifest["format"] != FORMAT
+        or manifest["season"] != season or manifest["refdata_version"] != version):
+      manifest = dict(format=FORMAT, season=season, columns=COLUMNS, parts={})
+    manifest["refdata_version"] = version
+
+    week_versions = get_week_versions(conn)
+    exported = []
+    for week, week_version in sorted(week_versions.iteritems()):
+      part = manifest["parts"].get(str(week))
+      if part is not None and part["week_version"] == week_version:
+        continue
+      fname = "week_%03d.json.gz" % week
+      rows = write_part(os.path.join(out_dir, fname),
+          iter_batches(conn, season, week, data_dir, batch_size))
+      manifest["parts"][str(week)] = dict(file=fname, rows=rows, week_version=week_version)
+      save_manifest(out_dir, manifest)
+      exported.append(week)
+    removed = sorted(int(week) for week in manifest["parts"] if int(week) not in week_versions)
+    for week in removed:
+      del manifest["parts"][str(week)]
+    save_manifest(out_dir, manifest)
+
+  listed = set(part["file"] for part in manifest["parts"].itervalues())
+  for fname in os.listdir(out_dir):
+    if PART_NAME.match(fname) and fname not in listed:
+      remove(os.path.join(out_dir, fname))
+  return exported, removed
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Export a season's played sets as compressed column batches, one file per week.")
+  parser.add_argument("data_dir")
+  parser.add_argument("current_season", help="name of the current season")
+  parser.add_argument("out_dir")
+  parser.add_argument("--season", help="archived season to export instead of the current one")
+  parser.add_argument("--batch-size", type=int, default=1000, help="rows per batch")
+  parser.add_argument("--full", action="store_true", help="rewrite every week")
+  options = parser.parse_args()
+
+  ahgl_admin.app.config["DATA_DIR"] = options.data_dir
+  ahgl_admin.app.config["SEASON"] = options.current_season
+  season = options.season or options.current_season
+  db_path = ahgl_admin.get_season_db_path(season)
+  if not os.path.exists(db_path):
+    parser.error("no database for season %s" % season)
+  weeks, removed = export(db_path, options.data_dir, season, options.out_dir,
+      max(1, options.batch_size), options.full)
+  print "%d weeks exported%s" % (len(weeks),
+      (": " + ", ".join(map(str, weeks))) if weeks else "")
+  if removed:
+    print "%d weeks removed: %s" % (len(removed), ", ".join(map(str, removed)))
+
+
+if __name__ == '__main__':
+  main()
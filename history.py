@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import contextlib
+import collections
+
+
+# Every set a player has played, newest first, a page at a time.  Pages are
+# addressed by the (week, set, match) of the last set shown rather than an
+# offset, and each of the three places a player can appear (a lineup, or
+# either side of an ace match) is read backwards along its own player index
+# from that point, so a page costs the same however long the history is.
+# The match breaks ties between sets of the same week and number (a player
+# entered for two matches in one week), so a page boundary never skips or
+# repeats one.
+
+SCHEMA = """
+CREATE INDEX IF NOT EXISTS lineup_player ON lineup (player, week, set_number);
+CREATE INDEX IF NOT EXISTS ace_matches_home_player ON ace_matches (home_player, week);
+CREATE INDEX IF NOT EXISTS ace_matches_away_player ON ace_matches (away_player, week);
+"""
+
+ACE_SET = 5
+
+# Sorts after every real (week, set, match).
+FIRST_PAGE = (1 << 62, 0, 0)
+
+PlayedSet = collections.namedtuple("PlayedSet",
+    "week set_number match home_team away_team home race opponent opponent_race "
+    "won forfeit replay_hash mapid")
+
+
+def ensure_schema(conn):
+  conn.executescript(SCHEMA)
+
+
+LINEUP_SETS = """
+SELECT l.week, l.set_number, m.match_number, m.home_team, m.away_team,
+    m.home_team = l.team, l.race, o.player, o.race,
+    CASE WHEN m.home_team = l.team THEN s.home_winner ELSE s.away_winner END,
+    s.forfeit, s.replay_hash, p.mapid
+FROM lineup l
+JOIN matches m ON m.week = l.week AND l.team IN (m.home_team, m.away_team)
+JOIN set_results s ON s.week = l.week AND s.match_number = m.match_number
+  AND s.set_number = l.set_number
+LEFT JOIN lineup o ON o.week = l.week AND o.set_number = l.set_number
+  AND o.team = CASE WHEN m.home_team = l.team THEN m.away_team ELSE m.home_team END
+LEFT JOIN maps p ON p.week = l.week AND p.set_number = l.set_number
+WHERE l.player = ? AND (l.week, l.set_number, m.match_number) < (?, ?, ?)
+  AND s.home_winner + s.away_winner = 1
+ORDER BY l.week DESC, l.set_number DESC, m.match_number DESC
+LIMIT ?
+"""
+
+ACE_SETS = """
+SELECT a.week, %(set)d, a.match_number, m.home_team, m.away_team,
+    %(home)d, a.%(side)s_race, a.%(other)s_player, a.%(other)s_race,
+    s.%(side)s_winner, s.forfeit, s.replay_hash, p.mapid
+FROM ace_matches a
+JOIN matches m ON m.week = a.week AND m.match_number = a.match_number
+JOIN set_results s ON s.week = a.week AND s.match_number = a.match_number
+  AND s.set_number = %(set)d
+LEFT JOIN maps p ON p.week = a.week AND p.set_number = %(set)d
+WHERE a.%(side)s_player = ? AND (a.week, %(set)d, a.match_number) < (?, ?, ?)
+  AND s.home_winner + s.away_winner = 1
+ORDER BY a.week DESC, a.match_number DESC
+LIMIT ?
+"""
+
+HISTORY = "SELECT * FROM (%s) UNION ALL SELECT * FROM (%s) UNION ALL SELECT * FROM (%s) ORDER BY 1 DESC, 2 DESC, 3 DESC LIMIT ?" % (
+    LINEUP_SETS,
+    ACE_SETS % dict(set=ACE_SET, home=1, side="home", other="away"),
+    ACE_SETS % dict(set=ACE_SET, home=0, side="away", other="home"))
+
+
+# Returns up to limit sets played before the given (week, set, match), and
+# the (week, set, match) to pass for the next page, or None if there is none.
+def get_sets(conn, player, before=FIRST_PAGE, limit=50):
+  params = (player,) + tuple(before) + (limit + 1,)
+  with contextlib.closing(conn.cursor()) as cursor:
+    cursor.execute(HISTORY, params * 3 + (limit + 1,))
+    sets = [ PlayedSet(*row) for row in cursor ]
+  if len(sets) <= limit:
+    return sets, None
+  sets = sets[:limit]
+  return sets, (sets[-1].week, sets[-1].set_number, sets[-1].match)
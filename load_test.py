@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+import cookielib
+import collections
+import urllib
+import urllib2
+import httplib
+import SocketServer
+import wsgiref.simple_server
+
+import ahgl_admin
+
+
+# Replays the webdriver_tests flows (login, enter lineup, enter result with
+# replay uploads) as many concurrent captains while viewers load the show
+# pages and replay packs, against a local server on a synthetic league.
+# Every captain submits its lineup at the same instant to mimic the lineup
+# deadline.
+
+RACES = "TZPR"
+WEEK = 1
+
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn,
+    wsgiref.simple_server.WSGIServer):
+  daemon_threads = True
+  request_queue_size = 512
+
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+  def log_message(self, *args):
+    pass
+
+
+class Stats(object):
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.latencies = collections.defaultdict(list)
+    self.errors = collections.Counter()
+    self.lock_failures = collections.Counter()
+
+  def record(self, op, seconds, ok):
+    with self.lock:
+      self.latencies[op].append(seconds)
+      if not ok:
+        self.errors[op] += 1
+
+  def record_lock_failure(self, endpoint):
+    with self.lock:
+      self.lock_failures[endpoint] += 1
+
+
+# Counts SQLITE_BUSY/"database is locked" failures, which reach here because
+# the app is run with PROPAGATE_EXCEPTIONS, whether they are raised by the
+# view or while a streamed page is being iterated.  Any other exception is
+# just an error response (or, once the headers are out, a cut-off one).
+class LockFailureCounter(object):
+
+  def __init__(self, app, stats):
+    self.app = app
+    self.stats = stats
+
+  def __call__(self, environ, start_response):
+    try:
+      app_iter = self.app(environ, start_response)
+    except Exception as err:
+      return self.fail(environ, start_response, err)
+    return self.iterate(environ, start_response, app_iter)
+
+  def iterate(self, environ, start_response, app_iter):
+    try:
+      for data in app_iter:
+        yield data
+    except Exception as err:
+      for data in self.fail(environ, start_response, err):
+        yield data
+    finally:
+      if hasattr(app_iter, "close"):
+        app_iter.close()
+
+  # Called while handling err; start_response re-raises it if the headers
+  # were already sent.
+  def fail(self, environ, start_response, err):
+    if (isinstance(err, sqlite3.OperationalError)
+        and ("locked" in str(err) or "busy" in str(err))):
+      self.stats.record_lock_failure(environ.get("PATH_INFO"))
+    start_response("500 Internal Server Error", [("Content-Type", "text/plain")],
+        sys.exc_info())
+    return [str(err)]
+
+
+def encode_multipart(fields, files):
+  boundary = "----ahgl-load-test-%x" % random.getrandbits(64)
+  parts = []
+  for name, value in fields:
+    parts.append("--%s\r\nContent-Disposition: form-data; name=\"%s\"\r\n\r\n%s\r\n"
+        % (boundary, name, value))
+  for name, filename, data in files:
+    parts.append("--%s\r\nContent-Disposition: form-data; name=\"%s\"; filename=\"%s\"\r\n"
+        "Content-Type: application/octet-stream\r\n\r\n%s\r\n"
+        % (boundary, name, filename, data))
+  parts.append("--%s--\r\n" % boundary)
+  return "multipart/form-data; boundary=%s" % boundary, "".join(parts)
+
+
+class Client(object):
+
+  def __init__(self, base_url, stats):
+    self.base_url = base_url
+    self.stats = stats
+    self.opener = urllib2.build_opener(
+        urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+
+  def request(self, op, path, data=None, headers={}, expect=None):
+    req = urllib2.Request(self.base_url + path, data, headers)
+    start = time.time()
+    ok = True
+    body = ""
+    try:
+      handle = self.opener.open(req)
+      try:
+        body = handle.read()
+      finally:
+        handle.close()
+    except (urllib2.URLError, httplib.HTTPException, IOError):
+      ok = False
+    if ok and expect is not None and expect not in body:
+      ok = False
+
+    self.stats.record(op, time.time() - start, ok)
+    return body
+
+
+def create_league(db_path, num_teams):
+  conn = ahgl_admin.open_db(db_path)
+  with open("./schema.sql") as handle:
+    conn.executescript(handle.read())
+  for mapid in range(1, 8):
+    conn.execute("INSERT INTO mapnames VALUES (?,?)", (mapid, "Map %d" % mapid))
+  for setnum in range(1, 5+1):
+    conn.execute("INSERT INTO maps VALUES (?,?,?)", (WEEK, setnum, setnum))
+  conn.execute("INSERT INTO accounts VALUES (NULL, 'admin', -1, 'admin-key')")
+  captains = []
+  for team in range(1, num_teams+1):
+    conn.execute("INSERT INTO teams VALUES (?,?,?)",
+        (team, "Team%d" % team, "Captain %d" % team))
+    auth_key = "captain-key-%d" % team
+    conn.execute("INSERT INTO accounts VALUES (NULL,?,?,?)",
+        ("captain%d@example.com" % team, team, auth_key))
+    players = []
+    for num in range(6):
+      cursor = conn.execute("INSERT INTO players VALUES (NULL,?,1,?,?)",
+          (team, "player%d_%d" % (team, num), str(100 + num)))
+      players.append(cursor.lastrowid)
+    captains.append((team, auth_key, players))
+  matches = []
+  for index in range(0, num_teams - 1, 2):
+    match = index // 2 + 1
+    home, away = index + 1, index + 2
+    refs = [ ((home + offset - 1) % num_teams) + 1 for offset in (2, 3) ]
+    conn.execute("INSERT INTO matches VALUES (?,?,?,?,?,?)",
+        (WEEK, match, home, away, refs[0], refs[1]))
+    matches.append((match, home, away))
+  conn.commit()
+  conn.close()
+  return captains, matches
+
+
+def run_captain(client, gates, team, auth_key, players, home_match, options):
+  ready, gate, lineups_in, results_gate = gates
+  client.request("login", "login/" + auth_key)
+  client.request("enter_lineup", "enter-lineup", expect="AHGL Lineup Entry")
+  ready.release()
+  gate.wait()
+
+  fields = [("week", WEEK), ("team", team), ("referee", "Ref%d" % team)]
+  for setnum, player in enumerate(random.sample(players, 4)):
+    fields.append(("player_%d" % (setnum+1), player))
+    fields.append(("race_%d" % (setnum+1), random.choice(RACES)))
+  client.request("submit_lineup", "submit-lineup", urllib.urlencode(fields),
+      expect="entered successfully")
+
+  lineups_in.release()
+  if home_match is None:
+    return
+
+  results_gate.wait()
+  client.request("enter_result", "enter-result?week=%d" % WEEK,
+      expect="AHGL Result Entry")
+  winner = random.choice(["home", "away"])
+  fields = [("week", WEEK), ("match", home_match)]
+  files = []
+  for setnum in range(1, 5+1):
+    fields.append(("winner_%d" % setnum, winner if setnum <= 3 else "none"))
+    if setnum <= 3:
+      files.append(("replay_%d" % setnum, "game%d.SC2Replay" % setnum,
+          os.urandom(options.replay_size)))
+  ctype, body = encode_multipart(fields, files)
+  client.request("submit_result", "submit-result", body,
+      {"Content-Type": ctype}, expect="entered successfully")
+
+
+def run_viewer(client, done):
+  pages = [
+      ("show_lineup", "show-lineup/%d" % WEEK),
+      ("show_result", "show-result/%d" % WEEK),
+      ("show_result_season", "show-result/season"),
+      ("view_rosters", "view-rosters"),
+      ("replay_pack", "replay-pack/%d/pack.zip" % WEEK),
+      ]
+  while not done.is_set():
+    op, path = random.choice(pages)
+    client.request(op, path)
+
+
+def percentile(values, fraction):
+  index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+  return values[index]
+
+
+def report(stats, elapsed):
+  print "%-20s %7s %7s %9s %9s %9s %9s" % (
+      "operation", "count", "errors", "p50 ms", "p90 ms", "p99 ms", "max ms")
+  total = errors = 0
+  for op in sorted(stats.latencies):
+    values = sorted(stats.latencies[op])
+    total += len(values)
+    errors += stats.errors[op]
+    print "%-20s %7d %7d %9.1f %9.1f %9.1f %9.1f" % (op, len(values),
+        stats.errors[op], percentile(values, 0.5) * 1000,
+        percentile(values, 0.9) * 1000, percentile(values, 0.99) * 1000,
+        values[-1] * 1000)
+  print
+  print "requests: %d in %.1fs (%.1f/s), error rate %.2f%%" % (
+      total, elapsed, total / elapsed, 100.0 * errors / max(total, 1))
+  print "database lock failures: %d" % sum(stats.lock_failures.values())
+  for endpoint, count in stats.lock_failures.most_common():
+    print "  %-30s %d" % (endpoint, count)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Concurrent captain/viewer load test against a local server.")
+  parser.add_argument("--teams", type=int, default=200,
+      help="number of teams, each with one simulated captain")
+  parser.add_argument("--viewers", type=int, default=100,
+      help="number of simulated viewers")
+  parser.add_argument("--replay-size", type=int, default=64 * 1024,
+      help="bytes per uploaded replay")
+  parser.add_argument("--read-snapshot-max-age", type=float, default=None,
+      help="serve read-only pages from a snapshot at most this many seconds old")
+  options = parser.parse_args()
+
+  data_dir = tempfile.mkdtemp()
+  httpd = None
+  try:
+    captains, matches = create_league(
+        os.path.join(data_dir, "ahgl.sq3"), options.teams)
+
+    stats = Stats()
+    app = ahgl_admin.app
+    app.config["DATA_DIR"] = data_dir
+    app.config.setdefault("SEASON", "load")
+    app.config["PROPAGATE_EXCEPTIONS"] = True
+    app.config["READ_SNAPSHOT_MAX_AGE"] = options.read_snapshot_max_age
+    app.secret_key = "load-test"
+    httpd = wsgiref.simple_server.make_server("localhost", 0,
+        LockFailureCounter(app.wsgi_app, stats),
+        server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    threading.Thread(target=httpd.serve_forever).start()
+    base_url = "http://localhost:%d/" % httpd.server_address[1]
+
+    home_matches = dict((home, match) for (match, home, away) in matches)
+    ready = threading.Semaphore(0)
+    gate = threading.Event()
+    lineups_in = threading.Semaphore(0)
+    results_gate = threading.Event()
+    gates = (ready, gate, lineups_in, results_gate)
+    done = threading.Event()
+    captain_threads = [ threading.Thread(target=run_captain, args=(
+        Client(base_url, stats), gates, team, auth_key, players,
+        home_matches.get(team), options))
+        for (team, auth_key, players) in captains ]
+    viewer_threads = [ threading.Thread(target=run_viewer,
+        args=(Client(base_url, stats), done))
+        for _ in range(options.viewers) ]
+
+    start = time.time()
+    for thread in captain_threads + viewer_threads:
+      thread.start()
+    # Let every captain log in and sit on the entry form, then release them.
+    for _ in captain_threads:
+      ready.acquire()
+    gate.set()
+    # Results are entered once every lineup is in, as after a match night.
+    for _ in captain_threads:
+      lineups_in.acquire()
+    results_gate.set()
+    for thread in captain_threads:
+      thread.join()
+    done.set()
+    for thread in viewer_threads:
+      thread.join()
+    report(stats, time.time() - start)
+  finally:
+    if httpd is not None:
+      httpd.shutdown()
+    shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+import os
+import sqlite3
+import argparse
+import contextlib
+
+import ahgl_admin
+
+
+# Ends a season: its schedule and results are copied to their own database
+# file, which the app only opens read-only (?season=<name>), and removed from
+# the current database, which keeps teams, players, map names and accounts.
+# The copy keeps no accounts, so the login keys don't outlive the season in
+# a file that gets backed up and passed around; it is vacuumed afterwards so
+# they aren't left in its free pages either.
+
+SEASON_TABLES = ["events", "ace_matches", "set_results", "referees", "lineup", "maps", "matches"]
+PRIVATE_TABLES = ["accounts"]
+
+# For VACUUM INTO.
+MIN_SQLITE_VERSION = (3, 27, 0)
+
+
+def archive_season(old_season, new_season):
+  ahgl_admin.app.config["SEASON"] = new_season
+  path = ahgl_admin.get_season_db_path(new_season)
+  past_path = ahgl_admin.get_season_db_path(old_season)
+
+  with contextlib.closing(sqlite3.connect(path, isolation_level=None)) as conn:
+    # Holding the write lock keeps results from landing between the copy
+    # and the delete, while still letting the copy (and viewers) read.
+    conn.execute("BEGIN IMMEDIATE")
+    copied = False
+    try:
+      with contextlib.closing(sqlite3.connect(path)) as reader:
+        reader.execute("VACUUM INTO ?", (past_path,))
+      copied = True
+      with contextlib.closing(sqlite3.connect(past_path, isolation_level=None)) as past:
+        for table in PRIVATE_TABLES:
+          past.execute("DELETE FROM %s" % table)
+        past.execute("VACUUM")
+      for table in SEASON_TABLES:
+        conn.execute("DELETE FROM %s" % table)
+      conn.execute("COMMIT")
+    except:
+      conn.execute("ROLLBACK")
+      if copied:
+        os.remove(past_path)
+      raise
+    conn.execute("VACUUM")
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Move a finished season out of the current database.")
+  parser.add_argument("data_dir")
+  parser.add_argument("old_season", help="name of the season that ended")
+  parser.add_argument("new_season", help="name of the season about to start")
+  options = parser.parse_args()
+
+  if options.old_season == options.new_season:
+    parser.error("old and new season must differ")
+  if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+    parser.error("SQLite %s or later is needed, but Python has %s"
+        % (".".join(map(str, MIN_SQLITE_VERSION)), sqlite3.sqlite_version))
+  ahgl_admin.app.config["DATA_DIR"] = options.data_dir
+  ahgl_admin.app.config["SEASON"] = options.new_season
+  if os.path.exists(ahgl_admin.get_season_db_path(options.old_season)):
+    parser.error("season %s is already archived" % options.old_season)
+  archive_season(options.old_season, options.new_season)
+  print "Season %s archived; set SEASON = %r in the app config." % (
+      options.old_season, options.new_season)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+import json
+import sqlite3
+import contextlib
+import collections
+
+import event_log
+
+
+# Elo ratings of every player, from each set played to a result (forfeits
+# and unplayed sets do not count).  Results are rated in the order they were
+# submitted, which is the event log's order, and the ratings table records
+# how far into the log it has got, so a submission only rates its own match.
+# rebuild() starts from scratch over every season and arrives at the same
+# numbers, since the same games go through the same arithmetic in the same
+# order.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ratings (
+  player INTEGER PRIMARY KEY,
+  rating REAL,
+  games INTEGER,
+  wins INTEGER
+);
+"""
+
+CONSUMER = "ratings"
+
+INITIAL_RATING = 1500.0
+K_FACTOR = 32.0
+
+Rating = collections.namedtuple("Rating", "player rating games wins")
+
+
+def ensure_schema(conn):
+  conn.executescript(SCHEMA)
+
+
+def has_table(conn):
+  with contextlib.closing(conn.cursor()) as cursor:
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'ratings'")
+    return list(cursor)[0][0] > 0
+
+
+# The (home player, away player, home won) of each rated set of a match.
+# Sets 1-4 are played by the lineups; set 5 is the ace match.
+def match_games(conn, week, match):
+  with contextlib.closing(conn.cursor()) as cursor:
+    cursor.execute(
+        "SELECT COALESCE(a.home_player, hl.player), COALESCE(a.away_player, al.player), s.home_winner "
+        "FROM set_results s "
+        "JOIN matches m ON m.week = s.week AND m.match_number = s.match_number "
+        "LEFT JOIN lineup hl ON hl.week = s.week AND hl.team = m.home_team AND hl.set_number = s.set_number "
+        "LEFT JOIN lineup al ON al.week = s.week AND al.team = m.away_team AND al.set_number = s.set_number "
+        "LEFT JOIN ace_matches a ON a.week = s.week AND a.match_number = s.match_number AND s.set_number = 5 "
+        "WHERE s.week = ? AND s.match_number = ? AND NOT s.forfeit "
+          "AND s.home_winner + s.away_winner = 1 "
+        "ORDER BY s.set_number"
+        , (week, match))
+    return [ (home, away, bool(home_won)) for (home, away, home_won) in cursor
+        if home is not None and away is not None ]
+
+
+def expected_score(rating, opponent):
+  return 1.0 / (1.0 + 10.0 ** ((opponent - rating) / 400.0))
+
+
+def rate(table, games):
+  for home, away, home_won in games:
+    home_rating = table.get(home) or Rating(home, INITIAL_RATING, 0, 0)
+    away_rating = table.get(away) or Rating(away, INITIAL_RATING, 0, 0)
+    change = K_FACTOR * ((1.0 if home_won else 0.0)
+        - expected_score(home_rating.rating, away_rating.rating))
+    table[home] = Rating(home, home_rating.rating + change,
+        home_rating.games + 1, home_rating.wins + home_won)
+    table[away] = Rating(away, away_rating.rating - change,
+        away_rating.games + 1, away_rating.wins + (not home_won))
+
+
+def load(conn, players=None):
+  with contextlib.closing(conn.cursor()) as cursor:
+    if players is None:
+      cursor.execute("SELECT player, rating, games, wins FROM ratings")
+    else:
+      players = sorted(players)
+      cursor.execute(
+          "SELECT player, rating, games, wins FROM ratings WHERE player IN (%s)"
+          % ",".join("?" * len(players)), players)
+    return dict((row[0], Rating(*row)) for row in cursor)
+
+
+def save(conn, table):
+  with contextlib.closing(conn.cursor()) as cursor:
+    cursor.executemany("INSERT OR REPLACE INTO ratings VALUES (?,?,?,?)",
+        sorted(table.itervalues()))
+
+
+# Rates the results logged since the watermark.  The caller commits, so
+# calling this in the submitting transaction keeps the two in step.
+def update(conn):
+  after = event_log.get_checkpoint(conn, CONSUMER)
+  events = event_log.read(conn, after)
+  if not events:
+    return 0
+  games = []
+  for event in events:
+    if event.kind == "result":
+      games.extend(match_games(conn, event.week, event.payload["match"]))
+  if games:
+    table = load(conn, set(player for game in games for player in game[:2]))
+    rate(table, games)
+    save(conn, table)
+  event_log.set_checkpoint(conn, CONSUMER, events[-1].seq)
+  return len(games)
+
+
+# The (week, match) of each result in a database, in submission order.
+# Season files from before the event log fall back to schedule order, which
+# is the order backfill would have logged them in.
+def result_order(conn):
+  with contextlib.closing(conn.cursor()) as cursor:
+    try:
+      cursor.execute("SELECT week, payload FROM events WHERE kind = 'result' ORDER BY seq")
+    except sqlite3.OperationalError:
+      cursor.execute("SELECT DISTINCT week, match_number FROM set_results ORDER BY week, match_number")
+      return list(cursor)
+    return [ (week, json.loads(payload)["match"]) for (week, payload) in cursor ]
+
+
+# Recomputes every rating from the past season files, oldest first, and
+# then the current database, which is locked against submissions meanwhile.
+def rebuild(conn, past_paths):
+  table = {}
+  for path in past_paths:
+    with contextlib.closing(sqlite3.connect(path)) as past:
+      for week, match in result_order(past):
+        rate(table, match_games(past, week, match))
+  ensure_schema(conn)
+  conn.execute("BEGIN IMMEDIATE")
+  try:
+    for week, match in result_order(conn):
+      rate(table, match_games(conn, week, match))
+    conn.execute("DELETE FROM ratings")
+    save(conn, table)
+    event_log.set_checkpoint(conn, CONSUMER, event_log.last_seq(conn))
+    conn.commit()
+  except:
+    conn.rollback()
+    raise
+  return len(table)
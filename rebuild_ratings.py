@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+import sqlite3
+import argparse
+import contextlib
+
+import ahgl_admin
+import ratings
+
+
+# Recomputes every player rating from all seasons' results, for when a
+# result has been corrected by hand.  Submissions wait while it runs.
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Recompute player ratings from every season's results.")
+  parser.add_argument("data_dir")
+  parser.add_argument("season", help="name of the current season")
+  options = parser.parse_args()
+
+  ahgl_admin.app.config["DATA_DIR"] = options.data_dir
+  ahgl_admin.app.config["SEASON"] = options.season
+  past_paths = [ ahgl_admin.get_season_db_path(season)
+      for season in ahgl_admin.get_past_seasons() ]
+  path = ahgl_admin.get_season_db_path(options.season)
+  with contextlib.closing(sqlite3.connect(path)) as conn:
+    print "%d players rated" % ratings.rebuild(conn, past_paths)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+import contextlib
+import sqlite3
+
+
+# Teams, players and map names change a few times a season, so they are
+# loaded once per process and shared read-only by every request.  Triggers
+# bump the "refdata" row of data_versions on any change, which is the only
+# query a request needs to make to know the snapshot is current.  They are
+# defined only here: ensure_schema() adds them on startup, to a database
+# just made from schema.sql as well as to one made before them.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS data_versions (
+  name TEXT PRIMARY KEY,
+  version INTEGER
+);
+
+INSERT OR IGNORE INTO data_versions VALUES ('refdata', 0);
+""" + "".join("""
+CREATE TRIGGER IF NOT EXISTS %(table)s_%(op)s AFTER %(op)s ON %(table)s BEGIN
+  UPDATE data_versions SET version = version + 1 WHERE name = 'refdata';
+END;
+""" % dict(table=table, op=op)
+    for table in ("teams", "players", "mapnames")
+    for op in ("insert", "update", "delete"))
+
+
+class Team(object):
+  __slots__ = ("id", "name", "captain_info")
+
+  def __init__(self, id, name, captain_info):
+    self.id = id
+    self.name = name
+    self.captain_info = captain_info
+
+
+class Player(object):
+  __slots__ = ("id", "team", "active", "name", "char_code")
+
+  def __init__(self, id, team, active, name, char_code):
+    self.id = id
+    self.team = team
+    self.active = active
+    self.name = name
+    self.char_code = char_code
+
+  @property
+  def full_name(self):
+    return self.name + "." + (self.char_code or "COWARD")
+
+
+class RefData(object):
+  __slots__ = ("version", "teams", "players", "mapnames", "rosters")
+
+  def __init__(self, version, teams, players, mapnames):
+    self.version = version
+    self.teams = teams
+    self.players = players
+    self.mapnames = mapnames
+    # Each team's players, by name.
+    self.rosters = {}
+    for player in sorted(players.itervalues(), key=lambda player: player.name):
+      self.rosters.setdefault(player.team, []).append(player)
+
+  def team_players(self, team, active_only=False):
+    return [ player for player in self.rosters.get(team, ())
+        if player.active or not active_only ]
+
+  # A player deleted since a lineup named them still shows, by id.
+  def get_player(self, id):
+    player = self.players.get(id)
+    if player is None:
+      player = Player(id, None, 0, "Player%d" % id, None)
+    return player
+
+
+def ensure_schema(conn):
+  conn.executescript(SCHEMA)
+
+
+def get_version(conn):
+  with contextlib.closing(conn.cursor()) as cursor:
+    try:
+      cursor.execute("SELECT version FROM data_versions WHERE name = 'refdata'")
+    except sqlite3.OperationalError:
+      # Database predates data_versions; nothing to key a snapshot on.
+      return None
+    rows = list(cursor)
+  return rows[0][0] if rows else None
+
+
+def load(conn, version):
+  with contextlib.closing(conn.cursor()) as cursor:
+    cursor.execute("SELECT id, name, captain_info FROM teams")
+    teams = dict((row[0], Team(*row)) for row in cursor)
+
+  with contextlib.closing(conn.cursor()) as cursor:
+    cursor.execute("SELECT id, team, active, name, char_code FROM players")
+    players = dict((row[0], Player(*row)) for row in cursor)
+
+  with contextlib.closing(conn.cursor()) as cursor:
+    cursor.execute("SELECT id, mapname FROM mapnames")
+    mapnames = dict(cursor)
+
+  return RefData(version, teams, players, mapnames)
+
+
+_snapshots = {}
+
+def get(conn, key):
+  version = get_version(conn)
+  snapshot = _snapshots.get(key)
+  if snapshot is None or version is None or snapshot.version != version:
+    snapshot = load(conn, version)
+    if version is not None:
+      _snapshots[key] = snapshot
+  return snapshot
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import imp
+import timeit
+import argparse
+import shutil
+import tempfile
+import subprocess
+import HTMLParser
+
+import ahgl_admin
+
+
+# Times the lineup/result week pages as served by the ahgl_admin.py of a
+# baseline revision (e.g. the last one to build them with string formatting
+# and cgi.escape, loaded from git) against the current ones, both as whole
+# requests through the test client over the same fixture data, and checks
+# that both produce the same text.  The current pages are timed with the
+# week block cache emptied before every request and with it warm.  Each
+# figure is the best of several runs, since a busy machine only ever adds.
+
+SQL_FILES = ['./schema.sql', './test_data.sql', './test_lineup.sql', './test_results.sql']
+WEEK = 1
+
+
+def load_baseline(rev):
+  source = subprocess.check_output(["git", "show", "%s:ahgl_admin.py" % rev])
+  module = imp.new_module("baseline_admin")
+  # Flask finds templates next to the module's file.
+  module.__file__ = os.path.abspath("baseline_admin.py")
+  sys.modules[module.__name__] = module
+  exec compile(source, "%s:ahgl_admin.py" % rev, "exec") in module.__dict__
+  return module
+
+
+def page_text(html):
+  if isinstance(html, str):
+    html = html.decode("utf-8")
+  text = re.sub(r"(?s)<script.*?</script>", " ", html)
+  text = re.sub(r"<[^>]*>", " ", text)
+  return " ".join(HTMLParser.HTMLParser().unescape(text).split())
+
+
+def time_per_call(func, number, repeat):
+  return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Time the week pages against a baseline revision's.")
+  parser.add_argument("baseline", help="git revision to compare against")
+  parser.add_argument("--iterations", type=int, default=1000, help="requests per run")
+  parser.add_argument("--repeat", type=int, default=5, help="runs, of which the fastest counts")
+  options = parser.parse_args()
+
+  rev = options.baseline
+  baseline = load_baseline(rev)
+  data_dir = tempfile.mkdtemp()
+  try:
+    db_conn = ahgl_admin.open_db(os.path.join(data_dir, "ahgl.sq3"))
+    for fname in SQL_FILES:
+      with open(fname) as handle:
+        db_conn.executescript(handle.read())
+    db_conn.commit()
+    db_conn.close()
+
+    for app in (baseline.app, ahgl_admin.app):
+      app.config["DATA_DIR"] = data_dir
+      app.config.setdefault("SEASON", "2")
+    ahgl_admin.app.config["ARCHIVE_IN_BACKGROUND"] = False
+    old_client = baseline.app.test_client()
+    new_client = ahgl_admin.app.test_client()
+
+    def uncached(url):
+      ahgl_admin.week_blocks.clear()
+      return new_client.get(url).data
+
+    number = options.iterations
+    for name, url in [
+        ("lineup", "/show-lineup/%d" % WEEK),
+        ("result", "/show-result/%d" % WEEK),
+        ]:
+      if page_text(old_client.get(url).data) != page_text(uncached(url)):
+        print "%s: page differs from %s" % (name, rev)
+        sys.exit(1)
+      old_time = time_per_call(lambda: old_client.get(url).data, number, options.repeat)
+      new_time = time_per_call(lambda: uncached(url), number, options.repeat)
+      cached_time = time_per_call(lambda: new_client.get(url).data, number, options.repeat)
+      print "%-7s %s %8.1fus  uncached %8.1fus  cached %8.1fus" % (
+          name, rev, old_time * 1e6, new_time * 1e6, cached_time * 1e6)
+  finally:
+    shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+import os
+import struct
+import zlib
+import errno
+import tempfile
+import zipfile
+import collections
+import itertools
+import multiprocessing
+import multiprocessing.pool
+
+
+# Every member gets the same timestamp (1980-01-01 00:00) so that the same
+# replays always produce a byte-identical archive.
+DOS_TIME = 0
+DOS_DATE = (1 << 5) | 1
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+
+FLAG_UTF8 = 1 << 11
+MADE_BY = (3 << 8) | 45
+EXTERNAL_ATTR = 0100644 << 16
+
+READ_SIZE = 1 << 16
+
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+END_RECORD = struct.Struct("<4s4H2LH")
+END_RECORD64 = struct.Struct("<4sQ2H2L4Q")
+END_LOCATOR64 = struct.Struct("<4sLQL")
+
+
+ZipMember = collections.namedtuple("ZipMember",
+    "name flags method crc compress_size file_size offset")
+
+
+# Each replay's deflate stream is made once and kept beside it in
+# <replay>.deflate, after a header with the zip method, CRC-32 and sizes.
+# Archives splice that stream (or, when deflating did not help, the replay
+# itself as a stored member) straight into the output without compressing
+# anything again.
+BLOB_SUFFIX = ".deflate"
+BLOB_HEADER = struct.Struct("<4sH3Q")
+BLOB_MAGIC = "AHZ1"
+
+BlobInfo = collections.namedtuple("BlobInfo",
+    "method crc file_size compress_size data_path data_offset")
+
+
+def get_blob_path(path):
+  return path + BLOB_SUFFIX
+
+
+def read_blob(path):
+  try:
+    handle = open(get_blob_path(path), "rb")
+  except IOError as err:
+    if err.errno != errno.ENOENT:
+      raise
+    return None
+  with handle:
+    header = handle.read(BLOB_HEADER.size)
+  if len(header) != BLOB_HEADER.size:
+    return None
+  magic, method, crc, file_size, compress_size = BLOB_HEADER.unpack(header)
+  if magic != BLOB_MAGIC or file_size != os.path.getsize(path):
+    return None
+  if method == METHOD_STORED:
+    return BlobInfo(method, crc, file_size, compress_size, path, 0)
+  return BlobInfo(method, crc, file_size, compress_size,
+      get_blob_path(path), BLOB_HEADER.size)
+
+
+def prepare_blob(path):
+  crc = 0
+  size = 0
+  compress_size = 0
+  compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+  blob_path = get_blob_path(path)
+  fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path) or ".",
+      prefix=os.path.basename(blob_path) + ".")
+  try:
+    with os.fdopen(fd, "wb") as out:
+      out.write("\0" * BLOB_HEADER.size)
+      with open(path, "rb") as handle:
+        while True:
+          data = handle.read(READ_SIZE)
+          if not data:
+            break
+          crc = zlib.crc32(data, crc)
+          size += len(data)
+          data = compressor.compress(data)
+          compress_size += len(data)
+          out.write(data)
+      data = compressor.flush()
+      compress_size += len(data)
+      out.write(data)
+      crc &= 0xFFFFFFFF
+      method = METHOD_DEFLATED
+      if compress_size >= size:
+        # Already compressed (as replays mostly are); store it as is.
+        method = METHOD_STORED
+        compress_size = size
+        out.truncate(BLOB_HEADER.size)
+      out.seek(0)
+      out.write(BLOB_HEADER.pack(BLOB_MAGIC, method, crc, size, compress_size))
+    os.rename(temp_path, blob_path)
+  except:
+    os.remove(temp_path)
+    raise
+  return read_blob(path)
+
+
+# Returns the BlobInfo of each path, in the order given, first making any
+# missing blobs.  Several are made concurrently on a pool of threads (zlib
+# releases the GIL while compressing) that lasts only as long as the call,
+# so nothing is shared between requests or forked from a threaded server.
+def get_blobs(paths, processes=None):
+  infos = [ read_blob(path) for path in paths ]
+  missing = sorted(set(path for path, info in zip(paths, infos) if info is None))
+  if len(missing) < 2 or processes == 1:
+    made = map(prepare_blob, missing)
+  else:
+    pool = multiprocessing.pool.ThreadPool(min(processes or multiprocessing.cpu_count(), len(missing)))
+    try:
+      made = pool.map(prepare_blob, missing)
+    finally:
+      pool.close()
+      pool.join()
+  made = dict(zip(missing, made))
+  return [ info or made[path] for path, info in zip(paths, infos) ]
+
+
+def copy_data(out, info):
+  with open(info.data_path, "rb") as handle:
+    handle.seek(info.data_offset)
+    remaining = info.compress_size
+    while remaining > 0:
+      data = handle.read(min(remaining, READ_SIZE))
+      if not data:
+        raise IOError("%s is shorter than its blob header says" % info.data_path)
+      out.write(data)
+      remaining -= len(data)
+
+
+def encode_name(name):
+  if isinstance(name, unicode):
+    try:
+      return name.encode("ascii"), 0
+    except UnicodeEncodeError:
+      return name.encode("utf-8"), FLAG_UTF8
+  return name, 0
+
+
+def local_header(member):
+  extra = ""
+  file_size = member.file_size
+  compress_size = member.compress_size
+  if file_size >= ZIP64_LIMIT or compress_size >= ZIP64_LIMIT:
+    extra = struct.pack("<2H2Q", 0x0001, 16, file_size, compress_size)
+    file_size = compress_size = ZIP64_LIMIT
+  return LOCAL_HEADER.pack("PK\003\004",
+      45 if extra else 20, member.flags, member.method, DOS_TIME, DOS_DATE,
+      member.crc, compress_size, file_size,
+      len(member.name), len(extra)) + member.name + extra
+
+
+def central_header(member):
+  fields = []
+  file_size = member.file_size
+  compress_size = member.compress_size
+  offset = member.offset
+  if file_size >= ZIP64_LIMIT:
+    fields.append(file_size)
+    file_size = ZIP64_LIMIT
+  if compress_size >= ZIP64_LIMIT:
+    fields.append(compress_size)
+    compress_size = ZIP64_LIMIT
+  if offset >= ZIP64_LIMIT:
+    fields.append(offset)
+    offset = ZIP64_LIMIT
+  extra = ""
+  if fields:
+    extra = struct.pack("<2H%dQ" % len(fields), 0x0001, 8 * len(fields), *fields)
+  return CENTRAL_HEADER.pack("PK\001\002",
+      MADE_BY, 45 if extra else 20, member.flags, member.method,
+      DOS_TIME, DOS_DATE, member.crc, compress_size, file_size,
+      len(member.name), len(extra), 0, 0, 0, EXTERNAL_ATTR,
+      offset) + member.name + extra
+
+
+def end_records(count, cd_offset, cd_size):
+  records = []
+  if (count >= ZIP64_COUNT_LIMIT or cd_offset >= ZIP64_LIMIT
+      or cd_size >= ZIP64_LIMIT):
+    end64_offset = cd_offset + cd_size
+    records.append(END_RECORD64.pack("PK\006\006",
+        END_RECORD64.size - 12, MADE_BY, 45, 0, 0,
+        count, count, cd_size, cd_offset))
+    records.append(END_LOCATOR64.pack("PK\006\007", 0, end64_offset, 1))
+    count = min(count, ZIP64_COUNT_LIMIT)
+    cd_offset = min(cd_offset, ZIP64_LIMIT)
+    cd_size = min(cd_size, ZIP64_LIMIT)
+  records.append(END_RECORD.pack("PK\005\006",
+      0, 0, count, count, cd_size, cd_offset, 0))
+  return "".join(records)
+
+
+# Entries are written in the order given, from their precompressed blobs.
+def write_members(out, offset, entries, processes=None):
+  members = []
+  infos = get_blobs([path for (arcname, path) in entries], processes)
+  for (arcname, path), info in itertools.izip(entries, infos):
+    name, flags = encode_name(arcname)
+    member = ZipMember(name, flags, info.method, info.crc,
+        info.compress_size, info.file_size, offset)
+    header = local_header(member)
+    out.write(header)
+    copy_data(out, info)
+    offset += len(header) + info.compress_size
+    members.append(member)
+  return members, offset
+
+
+def write_central_directory(out, offset, members):
+  cd_size = 0
+  for member in members:
+    header = central_header(member)
+    out.write(header)
+    cd_size += len(header)
+  out.write(end_records(len(members), offset, cd_size))
+
+
+def write_zip(out, entries, processes=None):
+  members, offset = write_members(out, 0, entries, processes)
+  write_central_directory(out, offset, members)
+  return members
+
+
+def read_members(handle):
+  zfile = zipfile.ZipFile(handle)
+  members = []
+  for info in zfile.infolist():
+    name, flags = encode_name(info.filename)
+    members.append(ZipMember(name, flags, info.compress_type, info.CRC,
+        info.compress_size, info.file_size, info.header_offset))
+  return members, zfile.start_dir
+
+
+def copy_prefix(out, handle, length):
+  handle.seek(0)
+  while length > 0:
+    data = handle.read(min(length, READ_SIZE))
+    if not data:
+      raise IOError("archive is shorter than its central directory says")
+    out.write(data)
+    length -= len(data)
+
+
+# Adds the entries whose names are not already in the archive at path.  The
+# existing members are copied byte for byte (never recompressed) into a new
+# file, the new members and central directory written after them, and the
+# new file renamed over the old one, so a download already reading the old
+# archive keeps reading a complete one.
+def append_zip(path, entries, processes=None):
+  try:
+    handle = open(path, "rb")
+  except IOError as err:
+    if err.errno != errno.ENOENT:
+      raise
+    handle = None
+
+  try:
+    members, offset = [], 0
+    if handle is not None:
+      try:
+        members, offset = read_members(handle)
+      except zipfile.BadZipfile:
+        # Empty, or cut short by a crash; start over.
+        members, offset = [], 0
+    present = set(member.name for member in members)
+    entries = [ (arcname, entry_path) for (arcname, entry_path) in entries
+        if encode_name(arcname)[0] not in present ]
+    if not entries and members:
+      return []
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+        prefix=os.path.basename(path) + ".")
+    try:
+      with os.fdopen(fd, "wb") as out:
+        if offset:
+          copy_prefix(out, handle, offset)
+        new_members, offset = write_members(out, offset, entries, processes)
+        write_central_directory(out, offset, members + new_members)
+      os.chmod(temp_path, 0644)
+      os.rename(temp_path, path)
+    except:
+      os.remove(temp_path)
+      raise
+    return new_members
+  finally:
+    if handle is not None:
+      handle.close()
@@ -52,6 +52,8 @@ CREATE TABLE lineup (
   PRIMARY KEY (week, team, set_number)
 );
 
+CREATE INDEX lineup_player ON lineup (player, week, set_number);
+
 CREATE TABLE referees (
   week INTEGER,
   team INTEGER,
@@ -69,6 +71,9 @@ CREATE TABLE ace_matches (
   PRIMARY KEY (week, match_number)
 );
 
+CREATE INDEX ace_matches_home_player ON ace_matches (home_player, week);
+CREATE INDEX ace_matches_away_player ON ace_matches (away_player, week);
+
 CREATE TABLE set_results (
   week INTEGER,
   match_number INTEGER,
@@ -79,3 +84,112 @@ CREATE TABLE set_results (
   replay_hash TEXT,
   PRIMARY KEY (week, match_number, set_number)
 );
+
+CREATE TABLE week_versions (
+  week INTEGER PRIMARY KEY,
+  version INTEGER
+);
+
+CREATE TRIGGER matches_insert_week AFTER INSERT ON matches BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week = NEW.week;
+END;
+
+CREATE TRIGGER matches_update_week AFTER UPDATE ON matches BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week IN (OLD.week, NEW.week);
+END;
+
+CREATE TRIGGER matches_delete_week AFTER DELETE ON matches BEGIN
+  UPDATE week_versions SET version = version + 1 WHERE week = OLD.week;
+END;
+
+CREATE TRIGGER maps_insert_week AFTER INSERT ON maps BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week = NEW.week;
+END;
+
+CREATE TRIGGER maps_update_week AFTER UPDATE ON maps BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week IN (OLD.week, NEW.week);
+END;
+
+CREATE TRIGGER maps_delete_week AFTER DELETE ON maps BEGIN
+  UPDATE week_versions SET version = version + 1 WHERE week = OLD.week;
+END;
+
+CREATE TRIGGER lineup_insert_week AFTER INSERT ON lineup BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week = NEW.week;
+END;
+
+CREATE TRIGGER lineup_update_week AFTER UPDATE ON lineup BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week IN (OLD.week, NEW.week);
+END;
+
+CREATE TRIGGER lineup_delete_week AFTER DELETE ON lineup BEGIN
+  UPDATE week_versions SET version = version + 1 WHERE week = OLD.week;
+END;
+
+CREATE TRIGGER referees_insert_week AFTER INSERT ON referees BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week = NEW.week;
+END;
+
+CREATE TRIGGER referees_update_week AFTER UPDATE ON referees BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week IN (OLD.week, NEW.week);
+END;
+
+CREATE TRIGGER referees_delete_week AFTER DELETE ON referees BEGIN
+  UPDATE week_versions SET version = version + 1 WHERE week = OLD.week;
+END;
+
+CREATE TRIGGER set_results_insert_week AFTER INSERT ON set_results BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week = NEW.week;
+END;
+
+CREATE TRIGGER set_results_update_week AFTER UPDATE ON set_results BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week IN (OLD.week, NEW.week);
+END;
+
+CREATE TRIGGER set_results_delete_week AFTER DELETE ON set_results BEGIN
+  UPDATE week_versions SET version = version + 1 WHERE week = OLD.week;
+END;
+
+CREATE TRIGGER ace_matches_insert_week AFTER INSERT ON ace_matches BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week = NEW.week;
+END;
+
+CREATE TRIGGER ace_matches_update_week AFTER UPDATE ON ace_matches BEGIN
+  INSERT OR IGNORE INTO week_versions VALUES (NEW.week, 0);
+  UPDATE week_versions SET version = version + 1 WHERE week IN (OLD.week, NEW.week);
+END;
+
+CREATE TRIGGER ace_matches_delete_week AFTER DELETE ON ace_matches BEGIN
+  UPDATE week_versions SET version = version + 1 WHERE week = OLD.week;
+END;
+
+CREATE TABLE events (
+  seq INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT,
+  week INTEGER,
+  payload TEXT,
+  created REAL
+);
+
+CREATE TABLE checkpoints (
+  consumer TEXT PRIMARY KEY,
+  seq INTEGER
+);
+
+CREATE TABLE ratings (
+  player INTEGER PRIMARY KEY,
+  rating REAL,
+  games INTEGER,
+  wins INTEGER
+);
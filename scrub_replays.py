@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import json
+import time
+import errno
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+
+import ahgl_admin
+import replay_zip
+
+
+# Checks the replay store against its names and the results that use it:
+#   corrupt   <sha1>.SC2Replay whose contents no longer hash to <sha1>
+#   dangling  set_results.replay_hash (in any season) with no file
+#   orphaned  replay that no result in any season refers to
+#   stale     compressed blob of a missing or changed replay, an upload
+#             left unfinished, or the temporary file of a write that never
+#             finished (a blob, archive or scrub state from mkstemp, or a
+#             database snapshot)
+# Hashing runs on a pool of worker processes, each reading in fixed-size
+# blocks and, given --rate, throttled to its share of that many MB/s.
+# Files whose size and mtime match the last pass that found them intact
+# are not read again unless --full is given.  Orphans and stale files only
+# count once they are older than --min-age, so an upload whose result is
+# still being entered, or a file still being written, is left alone.
+
+REPLAY_NAME = re.compile(r"^([0-9a-f]{40})\.SC2Replay$")
+STATE_FILE = "scrub_state.json"
+QUARANTINE_DIR = "quarantine"
+# What tempfile.mkstemp adds to the name of the file being replaced.
+TEMP_SUFFIX = r"\.[a-z0-9_]{6}"
+TEMP_NAME = re.compile(r"^(?:[0-9a-f]{40}\.SC2Replay%s|ahgl_replays_season_[a-zA-Z0-9]+"
+    r"(?:_player_[0-9]+)?\.zip|%s)%s$|^ahgl_snapshot\.sq3\.[0-9]+\.tmp$" % (
+    re.escape(replay_zip.BLOB_SUFFIX), re.escape(STATE_FILE), TEMP_SUFFIX))
+
+
+def hash_file(job):
+  path, rate = job
+  digest = hashlib.sha1()
+  start = time.time()
+  done = 0
+  try:
+    with open(path, "rb") as handle:
+      while True:
+        data = handle.read(replay_zip.READ_SIZE)
+        if not data:
+          break
+        digest.update(data)
+        done += len(data)
+        if rate:
+          ahead = done / rate - (time.time() - start)
+          if ahead > 0:
+            time.sleep(ahead)
+  except IOError as err:
+    if err.errno != errno.ENOENT:
+      raise
+    return path, None
+  return path, digest.hexdigest()
+
+
+def get_referenced(db_paths):
+  hashes = set()
+  for path in db_paths:
+    with contextlib.closing(sqlite3.connect(path)) as conn:
+      hashes.update(row[0] for row in conn.execute(
+          "SELECT DISTINCT replay_hash FROM set_results WHERE replay_hash IS NOT NULL"))
+  return hashes
+
+
+def load_state(path):
+  try:
+    with open(path) as handle:
+      return json.load(handle)
+  except IOError as err:
+    if err.errno != errno.ENOENT:
+      raise
+    return {}
+
+
+def save_state(path, state):
+  fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=STATE_FILE + ".")
+  try:
+    with os.fdopen(fd, "w") as handle:
+      json.dump(state, handle, sort_keys=True)
+    os.rename(temp_path, path)
+  except:
+    os.remove(temp_path)
+    raise
+
+
+def file_key(stat):
+  return [stat.st_size, stat.st_mtime]
+
+
+def quarantine(data_dir, path):
+  directory = os.path.join(data_dir, QUARANTINE_DIR)
+  try:
+    os.makedirs(directory)
+  except OSError as err:
+    if err.errno != errno.EEXIST:
+      raise
+  shutil.move(path, os.path.join(directory, os.path.basename(path)))
+
+
+def remove(path):
+  try:
+    os.remove(path)
+  except OSError as err:
+    if err.errno != errno.ENOENT:
+      raise
+
+
+def scrub(data_dir, db_paths, workers, rate, full, min_age, action, out=sys.stdout):
+  now = time.time()
+  state_path = os.path.join(data_dir, STATE_FILE)
+  state = {} if full else load_state(state_path)
+  referenced = get_referenced(db_paths)
+
+  replays = {}
+  blobs = []
+  temps = []
+  for fname in os.listdir(data_dir):
+    match = REPLAY_NAME.match(fname)
+    if match:
+      replays[match.group(1)] = os.stat(os.path.join(data_dir, fname))
+    elif fname.endswith(".SC2Replay" + replay_zip.BLOB_SUFFIX):
+      blobs.append(fname)
+    elif TEMP_NAME.match(fname):
+      temps.append(fname)
+
+  to_check = [ os.path.join(data_dir, rephash + ".SC2Replay")
+      for rephash, stat in sorted(replays.iteritems())
+      if state.get(rephash) != file_key(stat) ]
+  corrupt = []
+  new_state = dict((rephash, state[rephash]) for rephash in replays if rephash in state)
+  if to_check:
+    pool = multiprocessing.Pool(workers)
+    try:
+      jobs = [ (path, rate * (1 << 20) / workers if rate else None) for path in to_check ]
+      for path, digest in pool.imap_unordered(hash_file, jobs):
+        rephash = REPLAY_NAME.match(os.path.basename(path)).group(1)
+        if digest is None:
+          # Gone since the listing.
+          del replays[rephash]
+          new_state.pop(rephash, None)
+        elif digest != rephash:
+          corrupt.append(rephash)
+          new_state.pop(rephash, None)
+        else:
+          new_state[rephash] = file_key(replays[rephash])
+    finally:
+      pool.close()
+      pool.join()
+
+  dangling = sorted(referenced - set(replays))
+  orphaned = sorted(rephash for rephash, stat in replays.iteritems()
+      if rephash not in referenced and rephash not in corrupt
+        and now - stat.st_mtime >= min_age)
+
+  stale = []
+  for fname in sorted(blobs):
+    path = os.path.join(data_dir, fname)
+    replay_path = path[:-len(replay_zip.BLOB_SUFFIX)]
+    if (not os.path.exists(replay_path) or replay_zip.read_blob(replay_path) is None
+        or REPLAY_NAME.match(os.path.basename(replay_path)).group(1) in corrupt):
+      stale.append(path)
+  for fname in sorted(temps):
+    path = os.path.join(data_dir, fname)
+    try:
+      if now - os.path.getmtime(path) >= min_age:
+        stale.append(path)
+    except OSError as err:
+      # Renamed into place since the listing.
+      if err.errno != errno.ENOENT:
+        raise
+  upload_dir = os.path.join(data_dir, "uploads")
+  if os.path.isdir(upload_dir):
+    for fname in sorted(os.listdir(upload_dir)):
+      path = os.path.join(upload_dir, fname)
+      if now - os.path.getmtime(path) >= min_age:
+        stale.append(path)
+
+  print >>out, "checked %d of %d replays" % (len(to_check), len(replays))
+  for rephash in sorted(corrupt):
+    print >>out, "corrupt %s" % rephash
+  for rephash in dangling:
+    print >>out, "dangling %s" % rephash
+  for rephash in orphaned:
+    print >>out, "orphaned %s" % rephash
+  for path in stale:
+    print >>out, "stale %s" % os.path.relpath(path, data_dir)
+
+  if action != "report":
+    # Corrupt replays may still be referenced, so they are never deleted.
+    for rephash in sorted(corrupt):
+      quarantine(data_dir, os.path.join(data_dir, rephash + ".SC2Replay"))
+    for rephash in orphaned:
+      path = os.path.join(data_dir, rephash + ".SC2Replay")
+      if action == "quarantine":
+        quarantine(data_dir, path)
+      else:
+        remove(path)
+      remove(replay_zip.get_blob_path(path))
+      new_state.pop(rephash, None)
+    for path in stale:
+      remove(path)
+
+  save_state(state_path, new_state)
+  return not corrupt and not dangling
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Verify stored replays against their hashes and the results that use them.")
+  parser.add_argument("data_dir")
+  parser.add_argument("season", help="name of the current season")
+  parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+      help="hashing processes (default: one per core)")
+  parser.add_argument("--rate", type=float, help="total MB/s to read at most")
+  parser.add_argument("--full", action="store_true", help="rehash every replay")
+  parser.add_argument("--min-age", type=float, default=24 * 60 * 60,
+      help="seconds before an orphan or unfinished upload is acted on")
+  parser.add_argument("--action", choices=["report", "quarantine", "delete"], default="report",
+      help="what to do with orphaned replays: report them, move them to "
+        "DATA_DIR/%s, or delete them; the last two also quarantine corrupt "
+        "replays and delete stale files" % QUARANTINE_DIR)
+  options = parser.parse_args()
+
+  ahgl_admin.app.config["DATA_DIR"] = options.data_dir
+  ahgl_admin.app.config["SEASON"] = options.season
+  db_paths = [ ahgl_admin.get_season_db_path(season)
+      for season in ahgl_admin.get_past_seasons() + [options.season] ]
+  ok = scrub(options.data_dir, db_paths, max(1, options.workers), options.rate,
+      options.full, options.min_age, options.action)
+  sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+import re
+import sys
+import json
+import time
+import logging
+import logging.handlers
+import sqlite3
+import argparse
+import collections
+
+
+# Statement-level SQL profiling.  sqlite3 in Python 2 has no trace callback,
+# so connections are created with a cursor class that times each statement
+# from execute() until its rows are exhausted or the cursor moves on, while
+# the progress handler counts the VM instructions it ran.  Records are
+# written as JSON lines to a rotating log; "report" ranks them.
+
+PROGRESS_STEPS = 1000
+
+
+def normalize(sql):
+  sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+  sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+  sql = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(...)", sql)
+  return " ".join(sql.split())
+
+
+class Profiler(object):
+
+  def __init__(self, logger, slow_ms, route=lambda: None):
+    self.logger = logger
+    self.slow_ms = slow_ms
+    self.route = route
+
+  def record(self, conn, sql, params, seconds, rows, steps):
+    elapsed_ms = seconds * 1000
+    entry = dict(
+        sql = normalize(sql),
+        ms = round(elapsed_ms, 3),
+        rows = rows,
+        vm_steps = steps,
+        route = self.route(),
+        )
+    if elapsed_ms >= self.slow_ms:
+      entry["plan"] = self.explain(conn, sql, params)
+    self.logger.info(json.dumps(entry))
+
+  def explain(self, conn, sql, params):
+    if not re.match(r"\s*(SELECT|WITH)\b", sql, re.I):
+      return None
+    try:
+      cursor = sqlite3.Cursor(conn)
+      try:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [ row[-1] for row in cursor ]
+      finally:
+        cursor.close()
+    except sqlite3.Error as err:
+      return ["EXPLAIN failed: %s" % err]
+
+
+class ProfilingCursor(sqlite3.Cursor):
+
+  _sql = None
+
+  def _start(self, sql, params):
+    self._finish()
+    self._sql = sql
+    self._params = params
+    self._rows = 0
+    self._elapsed = 0.0
+    self.connection.vm_steps = 0
+
+  def _finish(self):
+    if self._sql is None:
+      return
+    conn = self.connection
+    conn.profiler.record(conn, self._sql, self._params,
+        self._elapsed, self._rows, conn.vm_steps * PROGRESS_STEPS)
+    self._sql = None
+
+  def _timed(self, func, *args):
+    start = time.time()
+    try:
+      return func(self, *args)
+    finally:
+      self._elapsed += time.time() - start
+
+  def execute(self, sql, params=()):
+    self._start(sql, params)
+    try:
+      self._timed(sqlite3.Cursor.execute, sql, params)
+    except:
+      self._finish()
+      raise
+    if self.description is None:
+      self._finish()
+    return self
+
+  def executemany(self, sql, seq_of_params):
+    self._start(sql, ())
+    try:
+      return self._timed(sqlite3.Cursor.executemany, sql, seq_of_params)
+    finally:
+      self._finish()
+
+  def next(self):
+    try:
+      row = self._timed(sqlite3.Cursor.next)
+    except StopIteration:
+      self._finish()
+      raise
+    self._rows += 1
+    return row
+
+  def fetchone(self):
+    row = self._timed(sqlite3.Cursor.fetchone)
+    if row is None:
+      self._finish()
+    else:
+      self._rows += 1
+    return row
+
+  def fetchmany(self, *args):
+    rows = self._timed(sqlite3.Cursor.fetchmany, *args)
+    self._rows += len(rows)
+    if not rows:
+      self._finish()
+    return rows
+
+  def fetchall(self):
+    rows = self._timed(sqlite3.Cursor.fetchall)
+    self._rows += len(rows)
+    self._finish()
+    return rows
+
+  def close(self):
+    self._finish()
+    sqlite3.Cursor.close(self)
+
+
+class ProfilingConnection(sqlite3.Connection):
+
+  profiler = None
+  # Set by time_budget.install; shares this connection's progress handler.
+  budget = None
+
+  def __init__(self, *args, **kwds):
+    sqlite3.Connection.__init__(self, *args, **kwds)
+    self.vm_steps = 0
+    self.set_progress_handler(self._progress, PROGRESS_STEPS)
+
+  def _progress(self):
+    self.vm_steps += 1
+    return self.budget.check() if self.budget is not None else 0
+
+  def cursor(self, factory=ProfilingCursor):
+    return sqlite3.Connection.cursor(self, factory)
+
+
+def connect(path, profiler):
+  conn = sqlite3.connect(path, factory=ProfilingConnection)
+  conn.profiler = profiler
+  return conn
+
+
+def make_logger(path, max_bytes, backup_count):
+  logger = logging.getLogger("ahgl.sql_profile")
+  logger.setLevel(logging.INFO)
+  logger.propagate = False
+  if not logger.handlers:
+    handler = logging.handlers.RotatingFileHandler(path,
+        maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+  return logger
+
+
+def read_log(paths):
+  for path in paths:
+    with open(path) as handle:
+      for line in handle:
+        try:
+          yield json.loads(line)
+        except ValueError:
+          continue
+
+
+def report(paths, limit, out=sys.stdout):
+  stats = collections.defaultdict(lambda: dict(
+      count=0, total_ms=0.0, max_ms=0.0, rows=0, routes=collections.Counter(), plan=None))
+  for entry in read_log(paths):
+    stat = stats[entry["sql"]]
+    stat["count"] += 1
+    stat["total_ms"] += entry["ms"]
+    stat["rows"] += entry["rows"]
+    stat["routes"][entry.get("route")] += 1
+    if entry["ms"] >= stat["max_ms"]:
+      stat["max_ms"] = entry["ms"]
+      stat["plan"] = entry.get("plan") or stat["plan"]
+
+  ranked = sorted(stats.items(), key=lambda item: -item[1]["total_ms"])
+  for sql, stat in ranked[:limit]:
+    print >>out, "%10.1f ms total  %6d calls  %8.2f ms avg  %8.2f ms max  %8.1f rows avg" % (
+        stat["total_ms"], stat["count"], stat["total_ms"] / stat["count"],
+        stat["max_ms"], float(stat["rows"]) / stat["count"])
+    print >>out, "    %s" % sql
+    print >>out, "    routes: %s" % ", ".join("%s (%d)" % (route, count)
+        for route, count in stat["routes"].most_common())
+    for line in stat["plan"] or []:
+      print >>out, "    plan: %s" % line
+    print >>out
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description="Rank profiled SQL statements by total time.")
+  parser.add_argument("logs", nargs="+",
+      help="profile log files, including rotated ones")
+  parser.add_argument("--limit", type=int, default=20)
+  options = parser.parse_args()
+  report(options.logs, options.limit)
+
+
+if __name__ == '__main__':
+  main()
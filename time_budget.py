@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+import time
+
+import sql_profile
+
+
+# Per-request time budgets.  A request's connection gets a progress handler
+# that SQLite calls every PROGRESS_STEPS VM instructions; once the deadline
+# has passed the handler returns non-zero, which makes SQLite abandon the
+# running statement with an "interrupted" OperationalError.  Any later
+# statement is abandoned the same way, so a request that overran in Python
+# stops at its next query.  The caller turns that into a 503 and rolls back,
+# which releases whatever lock the request held.
+
+PROGRESS_STEPS = sql_profile.PROGRESS_STEPS
+
+
+class Budget(object):
+
+  def __init__(self, seconds):
+    self.seconds = seconds
+    self.start = time.time()
+    self.deadline = self.start + seconds
+    self.exceeded = False
+
+  def elapsed(self):
+    return time.time() - self.start
+
+  def check(self):
+    if time.time() > self.deadline:
+      self.exceeded = True
+      return 1
+    return 0
+
+
+# Profiling connections already have a progress handler (SQLite allows only
+# one), which consults the budget itself.
+def install(conn, budget):
+  if isinstance(conn, sql_profile.ProfilingConnection):
+    conn.budget = budget
+  else:
+    conn.set_progress_handler(budget.check, PROGRESS_STEPS)
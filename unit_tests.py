@@ -0,0 +1,1133 @@
+#!/usr/bin/env python
+import os
+import re
+import json
+import time
+import logging
+import hashlib
+import tempfile
+import contextlib
+import shutil
+import unittest
+import socket
+import threading
+import zlib
+import sqlite3
+import zipfile
+import cStringIO
+import HTMLParser
+import werkzeug.datastructures
+
+import ahgl_admin
+import broadcast
+import cache
+import compress
+import event_log
+import event_server
+import export_season
+import history
+import load_test
+import new_season
+import ratings
+import refdata
+import replay_zip
+import scrub_replays
+import sql_profile
+import validation
+
+
+TEST_REPLAY_SHA1 = '4e1243bd22c66e76c2ba9eddc1f91394e57f9f83'
+
+
+# Runs requests through the Flask test client against a fresh database
+# made from the test data.
+class AppTestCase(unittest.TestCase):
+
+  sql_files = ['./schema.sql', './test_data.sql', './test_lineup.sql']
+
+  def setUp(self):
+    self.data_dir = tempfile.mkdtemp()
+    app = ahgl_admin.app
+    app.config['DATA_DIR'] = self.data_dir
+    app.config['SEASON'] = '2'
+    app.config['ARCHIVE_IN_BACKGROUND'] = False
+    app.secret_key = 'AHGL'
+    app._got_first_request = False
+    app.logger.setLevel(logging.CRITICAL)
+    ahgl_admin.week_blocks.clear()
+    ahgl_admin.metrics.clear()
+    self.db = ahgl_admin.open_db(os.path.join(self.data_dir, 'ahgl.sq3'))
+    for fname in self.sql_files:
+      with open(fname) as handle:
+        self.db.executescript(handle.read())
+    self.db.commit()
+    self.client = app.test_client()
+
+  def tearDown(self):
+    self.db.close()
+    shutil.rmtree(self.data_dir)
+
+  def login(self, team):
+    auth_key = self.db.execute(
+        "SELECT auth_key FROM accounts WHERE team = ?", (team,)).fetchone()[0]
+    self.client.get('/login/' + auth_key)
+
+  def submit_maps(self, week):
+    return self.client.post('/submit-maps', data=dict(week=str(week),
+        map_1='7', map_2='5', map_3='1', map_4='2', map_5='4'))
+
+  def submit_result(self, week, match, winners, replays={}):
+    data = dict(week=str(week), match=str(match))
+    for setnum, winner in enumerate(winners, 1):
+      data['winner_%d' % setnum] = winner
+    for setnum, replay in replays.iteritems():
+      data['replay_%d' % setnum] = (cStringIO.StringIO(replay), 'set.SC2Replay')
+    return self.client.post('/submit-result', data=data)
+
+
+class ArchiveTest(AppTestCase):
+
+  def setUp(self):
+    AppTestCase.setUp(self)
+    with open('./test_fake_replay.dat', 'rb') as handle:
+      self.replay = handle.read()
+    self.login(-1)
+    self.submit_maps(1)
+
+  def get_archived(self):
+    path = os.path.join(self.data_dir, 'ahgl_replays_season_2.zip')
+    return [ name.split('/')[1] for name in zipfile.ZipFile(path).namelist() ]
+
+  def test_set_without_lineup_is_left_out(self):
+    # Team 2 never entered a lineup for week 1, so match 2 can't be named.
+    resp = self.submit_result(1, 2, ['home', 'home', 'home', 'none', 'none'], {1: self.replay})
+    self.assertIn('successfully', resp.data)
+    resp = self.submit_result(1, 1, ['home', 'away', 'home', 'home', 'none'], {1: self.replay})
+    self.assertIn('successfully', resp.data)
+    self.assertFalse(os.path.exists(os.path.join(self.data_dir, 'ahgl_replays_season_2.zip')))
+    ahgl_admin.run_archive_pass()
+    self.assertEqual(self.get_archived(), ['Match-1_Twitter-Zynga'])
+    self.assertEqual(event_log.get_checkpoint(self.db, 'archives'), event_log.last_seq(self.db))
+
+  def test_player_archives_are_files(self):
+    resp = self.submit_result(1, 1, ['home', 'away', 'home', 'home', 'none'], {1: self.replay})
+    self.assertIn('successfully', resp.data)
+    player = self.db.execute(
+        "SELECT l.player FROM lineup l JOIN matches m ON m.week = l.week AND l.team = m.home_team "
+        "WHERE m.week = 1 AND m.match_number = 1 AND l.set_number = 1").fetchone()[0]
+    name = 'ahgl_replays_season_2_player_%d.zip' % player
+    self.assertNotIn('/archives/' + name, self.client.get('/view-rosters').data)
+    ahgl_admin.run_archive_pass()
+    self.assertIn('/archives/' + name, self.client.get('/view-rosters').data)
+
+    # Renamed, the player keeps the one copy of the replay.
+    self.db.execute("UPDATE players SET name = 'renamed' WHERE id = ?", (player,))
+    self.db.commit()
+    self.db.execute("DELETE FROM checkpoints")
+    self.db.commit()
+    ahgl_admin.run_archive_pass()
+
+    open_db = ahgl_admin.open_db
+    def fail(*args):
+      raise AssertionError("archives are sent without a database")
+    ahgl_admin.open_db = fail
+    try:
+      resp = self.client.get('/archives/' + name)
+      missing = self.client.get('/archives/ahgl_replays_season_2_player_999.zip')
+      other = self.client.get('/archives/ahgl.sq3')
+    finally:
+      ahgl_admin.open_db = open_db
+    self.assertEqual(resp.status_code, 200)
+    self.assertEqual(zipfile.ZipFile(cStringIO.StringIO(resp.data)).namelist(),
+        ['AHGL_S2_Player%d/Week1-Match1-Set1.SC2Replay' % player])
+    self.assertEqual(missing.status_code, 404)
+    self.assertEqual(other.status_code, 404)
+
+  def test_failed_pass_is_retried(self):
+    resp = self.submit_result(1, 1, ['home', 'away', 'home', 'home', 'none'], {1: self.replay})
+    self.assertIn('successfully', resp.data)
+    append_zip = replay_zip.append_zip
+    def fail(*args):
+      raise IOError("disk trouble")
+    replay_zip.append_zip = fail
+    try:
+      ahgl_admin.run_archive_pass()
+    finally:
+      replay_zip.append_zip = append_zip
+    self.assertEqual(event_log.get_checkpoint(self.db, 'archives'), 0)
+    self.assertEqual(ahgl_admin.metrics.get('archive_event_failures_total'), 1)
+
+    self.db.execute("INSERT INTO players VALUES (40, 7, 1, 'yelper', '1')")
+    self.db.execute("INSERT INTO lineup VALUES (1, 7, 1, 40, 'P')")
+    self.db.commit()
+    resp = self.submit_result(1, 3, ['home', 'home', 'home', 'none', 'none'], {1: self.replay})
+    self.assertIn('successfully', resp.data)
+    ahgl_admin.run_archive_pass()
+    self.assertEqual(self.get_archived(), ['Match-1_Twitter-Zynga', 'Match-3_Yelp-Amazon'])
+    self.assertEqual(event_log.get_checkpoint(self.db, 'archives'), event_log.last_seq(self.db))
+
+
+class ValidationTest(AppTestCase):
+
+  def get_errors(self, resp):
+    return [ HTMLParser.HTMLParser().unescape(error.decode('utf-8'))
+        for error in re.findall(r'<li>(.*?)</li>', resp.data) ]
+
+  def assertRejected(self, resp, *errors):
+    self.assertEqual(self.get_errors(resp), list(errors))
+
+  def post_lineup(self, **fields):
+    data = dict(week='1', team='7', referee='YelpRef',
+        player_1='25', race_1='P', player_2='26', race_2='Z',
+        player_3='27', race_3='T', player_4='28', race_4='R')
+    data.update(fields)
+    return self.client.post('/submit-lineup', data=data)
+
+  def post_result(self, **fields):
+    data = dict(week='1', match='1', winner_1='home', winner_2='away',
+        winner_3='home', winner_4='away', winner_5='home',
+        home_ace='1', away_ace='7', home_ace_race='P', away_ace_race='Z')
+    data.update(fields)
+    return self.client.post('/submit-result', data=data)
+
+  def setUp(self):
+    AppTestCase.setUp(self)
+    for player in range(25, 29):
+      self.db.execute("INSERT INTO players VALUES (?, 7, 1, ?, '1')", (player, 'yelper%d' % player))
+    self.db.execute("INSERT INTO accounts VALUES (6, 'local@yelp.com', 7, 'yelp')")
+    self.db.commit()
+    self.login(-1)
+
+  def test_form_reports_every_error_in_order(self):
+    form = validation.Form(werkzeug.datastructures.MultiDict([('a', 'x'), ('b', '1'), ('b', '2')]))
+    self.assertEqual(form.get_int('a', 'Bad a'), None)
+    self.assertEqual(form.get('b'), None)
+    self.assertEqual(form.get('c', 'No c.'), None)
+    form.expect('Too few', 'SELECT ?', (1,), lambda value: value > 1)
+    self.assertEqual(form.get_choice('a', 'yz', 'Bad choice'), None)
+    self.assertEqual(form.validate(self.db),
+        ['Bad a', "No value submitted for 'b'", 'No c.', 'Too few', 'Bad choice'])
+
+  def test_maps(self):
+    self.assertRejected(self.client.post('/submit-maps', data=dict(map_1='1')),
+        "No value submitted for 'week'", "No value submitted for 'map_2'",
+        "No value submitted for 'map_3'", "No value submitted for 'map_4'",
+        "No value submitted for 'map_5'")
+    self.assertRejected(self.client.post('/submit-maps', data=dict(week='one',
+        map_1='1', map_2='x', map_3='99', map_4='1', map_5='1')),
+        'Invalid week', 'Invalid map for set 2', 'Invalid map for set 3')
+    self.submit_maps(1)
+    self.assertRejected(self.submit_maps(1), 'Maps already submitted')
+
+  def test_lineup(self):
+    self.submit_maps(1)
+    self.assertRejected(self.post_lineup(), "Can't submit for another team")
+    self.login(7)
+    self.assertRejected(self.post_lineup(week='2'), 'Invalid week')
+    self.assertRejected(self.post_lineup(team='x'), 'Invalid team')
+    self.assertRejected(self.post_lineup(referee=''), 'No referee submitted')
+    self.assertRejected(self.post_lineup(player_1='1', player_2='y', player_3='28', race_4=''),
+        'Player 1 is not an eligible team member', 'Invalid value for player 2',
+        'Duplicate player for player 4', "No value submitted for 'race_4'")
+    self.assertRejected(self.post_lineup(race_1='X'), 'Invalid race for player 1')
+    self.assertIn('successfully', self.post_lineup().data)
+    self.assertRejected(self.post_lineup(), 'Lineup already submitted')
+
+  def test_result(self):
+    self.submit_maps(1)
+    self.assertRejected(self.post_result(match='9'), 'Invalid match',
+        'Home ace is on the wrong team.', 'Away ace is on the wrong team.')
+    self.assertRejected(self.post_result(winner_1='none'), 'Invalid winner for set 1')
+    self.assertRejected(self.post_result(home_ace='', away_ace='0'),
+        'No home ace specified.', 'No away ace specified.')
+    self.assertRejected(self.post_result(home_ace='x', away_ace='1'),
+        'Invalid ace specified.', 'Away ace is on the wrong team.')
+    self.assertRejected(self.post_result(home_ace='7'), 'Home ace is on the wrong team.')
+    self.assertRejected(self.post_result(home_ace_race='', away_ace_race='X'),
+        'No home ace race specified.', 'Invalid away ace race specified.')
+    self.assertRejected(self.post_result(replay_hash_2='0' * 40), 'Replay for set 2 was not uploaded')
+    self.assertIn('successfully', self.post_result().data)
+    self.assertRejected(self.post_result(), 'Result already submitted')
+
+
+class RequestBudgetTest(AppTestCase):
+
+  def tearDown(self):
+    ahgl_admin.app.config.pop('REQUEST_BUDGET', None)
+    ahgl_admin.app.config.pop('REQUEST_BUDGETS', None)
+    AppTestCase.tearDown(self)
+
+  def test_defaults(self):
+    get_budget = ahgl_admin.get_request_budget
+    self.assertEqual(get_budget('show_result_week'), 2.0)
+    self.assertEqual(get_budget('submit_result'), 10.0)
+    self.assertEqual(get_budget('get_replay_pack'), 30.0)
+    self.assertEqual(get_budget('upload_replay'), None)
+    self.assertEqual(get_budget('live_feed'), None)
+
+  def test_config_overrides(self):
+    ahgl_admin.app.config['REQUEST_BUDGET'] = 5
+    ahgl_admin.app.config['REQUEST_BUDGETS'] = {'upload_replay': 60, 'show_result_week': None}
+    get_budget = ahgl_admin.get_request_budget
+    self.assertEqual(get_budget('show_lineup_week'), 5)
+    self.assertEqual(get_budget('show_result_week'), None)
+    self.assertEqual(get_budget('upload_replay'), 60)
+    self.assertEqual(get_budget('get_replay_pack'), 30.0)
+
+
+class HistoryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = sqlite3.connect(':memory:')
+    for fname in ['./schema.sql', './test_data.sql', './test_lineup.sql']:
+      with open(fname) as handle:
+        self.conn.executescript(handle.read())
+    history.ensure_schema(self.conn)
+    self.conn.executemany("INSERT INTO maps VALUES (1, ?, ?)", [ (setnum, setnum) for setnum in range(1, 6) ])
+    # Player 1 plays set 1 of both match 1 (for Twitter) and match 2 (for
+    # Facebook), and the ace match of match 1.
+    self.conn.execute("UPDATE lineup SET player = 1 WHERE week = 1 AND team = 3 AND set_number = 1")
+    for match in (1, 2):
+      self.conn.executemany("INSERT INTO set_results VALUES (1, ?, ?, 1, 0, 0, NULL)",
+          [ (match, setnum) for setnum in range(1, 6) ])
+    self.conn.execute("INSERT INTO ace_matches VALUES (1, 1, 1, 7, 'P', 'Z')")
+
+  def tearDown(self):
+    self.conn.close()
+
+  def get_pages(self, limit):
+    keys = []
+    before = history.FIRST_PAGE
+    while before is not None:
+      sets, before = history.get_sets(self.conn, 1, before, limit)
+      self.assertTrue(len(sets) <= limit)
+      keys.extend((played.week, played.set_number, played.match) for played in sets)
+    return keys
+
+  def test_ties_across_pages(self):
+    self.assertEqual(self.get_pages(10), [(1, 5, 1), (1, 1, 2), (1, 1, 1)])
+    self.assertEqual(self.get_pages(1), self.get_pages(10))
+    self.assertEqual(self.get_pages(2), self.get_pages(10))
+
+  def test_cursor_format(self):
+    self.assertEqual(ahgl_admin.format_history_cursor((3, 2, 1)), '3-2-1')
+    self.assertEqual(ahgl_admin.parse_history_cursor('3-2-1'), (3, 2, 1))
+    self.assertEqual(ahgl_admin.parse_history_cursor('3-2'), (3, 2, 0))
+    self.assertEqual(ahgl_admin.parse_history_cursor('3-x'), None)
+    self.assertEqual(ahgl_admin.parse_history_cursor(None), history.FIRST_PAGE)
+
+
+class RatingsTest(AppTestCase):
+
+  def test_incremental_matches_rebuild(self):
+    for setnum, player in enumerate(range(25, 29), 1):
+      self.db.execute("INSERT INTO players VALUES (?, 7, 1, ?, '1')", (player, 'yelper%d' % player))
+      self.db.execute("INSERT INTO lineup VALUES (1, 7, ?, ?, 'T')", (setnum, player))
+    self.db.commit()
+    self.login(-1)
+    self.submit_maps(1)
+    # Match 1 goes to an ace match, and match 2 has no away lineup.
+    self.client.post('/submit-result', data=dict(week='1', match='1',
+        winner_1='home', winner_2='away', winner_3='away', winner_4='home', winner_5='away',
+        home_ace='2', away_ace='9', home_ace_race='Z', away_ace_race='T'))
+    self.submit_result(1, 3, ['away', 'away', 'home', 'away', 'none'])
+    self.submit_result(1, 2, ['home', 'home', 'home', 'none', 'none'])
+    incremental = ratings.load(self.db)
+    self.assertEqual(incremental[9].games, 2)
+    self.assertEqual(incremental[9].wins, 2)
+    self.assertEqual(incremental[19].games, 1)
+    self.assertEqual(sum(rating.games for rating in incremental.itervalues()), 2 * (5 + 4))
+    self.assertEqual(ratings.rebuild(self.db, []), len(incremental))
+    rebuilt = ratings.load(self.db)
+    self.assertEqual(sorted(rebuilt), sorted(incremental))
+    for player, rating in incremental.iteritems():
+      self.assertEqual(rebuilt[player][2:], rating[2:])
+      self.assertAlmostEqual(rebuilt[player].rating, rating.rating, places=9)
+
+
+class UploadTest(AppTestCase):
+
+  def setUp(self):
+    AppTestCase.setUp(self)
+    self.replay = 'not really a replay ' * 100
+    self.rephash = hashlib.sha1(self.replay).hexdigest()
+    self.url = '/replay-upload/' + self.rephash
+
+  def put(self, offset, data, total=None):
+    return self.client.put('%s?offset=%d&total=%d' % (self.url, offset, total or len(self.replay)),
+        data=data, content_type='application/octet-stream')
+
+  def get_part_path(self, rephash):
+    return os.path.join(self.data_dir, 'uploads', rephash + '.part')
+
+  def test_requires_login(self):
+    self.assertEqual(self.client.get(self.url).status_code, 403)
+    self.assertEqual(self.put(0, self.replay).status_code, 403)
+    self.assertEqual(self.client.post('/replay-check', data=dict(hash=self.rephash)).status_code, 403)
+
+  def test_upload_in_chunks(self):
+    self.login(1)
+    resp = self.client.post('/replay-check', data=dict(hash=self.rephash))
+    self.assertEqual(json.loads(resp.data)['missing'], [self.rephash])
+    self.assertEqual(json.loads(self.put(0, self.replay[:1000]).data),
+        dict(offset=1000, complete=False))
+    self.assertEqual(self.put(0, self.replay[:1000]).status_code, 409)
+    self.assertEqual(json.loads(self.put(1000, self.replay[1000:]).data),
+        dict(offset=len(self.replay), complete=True))
+    with open(os.path.join(self.data_dir, self.rephash + '.SC2Replay'), 'rb') as handle:
+      self.assertEqual(handle.read(), self.replay)
+
+  def test_chunk_past_total_is_refused(self):
+    self.login(1)
+    self.assertEqual(self.put(0, self.replay, total=10).status_code, 400)
+    self.assertFalse(os.path.exists(self.get_part_path(self.rephash)))
+
+  def test_stale_uploads_are_pruned(self):
+    self.login(1)
+    os.makedirs(os.path.join(self.data_dir, 'uploads'))
+    stale = self.get_part_path('0' * 40)
+    fresh = self.get_part_path('1' * 40)
+    for path in (stale, fresh):
+      with open(path, 'wb') as handle:
+        handle.write('partial')
+    os.utime(stale, (0, 0))
+    ahgl_admin.app.config['MAX_PENDING_UPLOADS'] = 1
+    try:
+      self.assertEqual(self.put(0, self.replay).status_code, 503)
+      self.assertFalse(os.path.exists(stale))
+      os.remove(fresh)
+      self.assertEqual(self.put(0, self.replay).status_code, 200)
+    finally:
+      del ahgl_admin.app.config['MAX_PENDING_UPLOADS']
+
+
+# Databases made before a table was added to schema.sql get it on startup.
+class UpgradeTest(AppTestCase):
+
+  def get_version(self, table, key):
+    return self.db.execute("SELECT version FROM %s WHERE %s" % (table, key)).fetchone()[0]
+
+  def test_data_versions(self):
+    # schema.sql leaves the table and its triggers to refdata.
+    self.assertEqual(self.db.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE name = 'data_versions'").fetchone()[0], 0)
+    self.client.get('/')
+    self.client.get('/')
+    self.assertEqual(self.get_version('data_versions', "name = 'refdata'"), 0)
+    self.db.execute("UPDATE teams SET name = 'Twitter' WHERE id = 1")
+    self.db.execute("DELETE FROM mapnames WHERE id = 7")
+    self.db.commit()
+    self.assertEqual(self.get_version('data_versions', "name = 'refdata'"), 2)
+
+  def test_week_versions(self):
+    self.db.executescript("DROP TABLE week_versions; DROP TRIGGER maps_insert_week;")
+    self.client.get('/')
+    self.client.get('/')
+    self.assertEqual(self.db.execute("SELECT COUNT(*) FROM week_versions").fetchone()[0], 0)
+    self.login(-1)
+    self.submit_maps(2)
+    self.assertEqual(self.get_version('week_versions', "week = 2"), 5)
+    self.db.execute("UPDATE lineup SET race = 'Z' WHERE week = 1 AND team = 1 AND set_number = 1")
+    self.db.commit()
+    self.assertEqual(self.get_version('week_versions', "week = 1"), 1)
+
+
+class RefDataTest(AppTestCase):
+
+  sql_files = AppTestCase.sql_files + ['./test_results.sql']
+
+  def test_deleted_player_still_shows(self):
+    self.db.execute("DELETE FROM players WHERE id IN (1, 7)")
+    self.db.commit()
+    for url in ['/show-lineup/1', '/show-result/1']:
+      response = self.client.get(url)
+      self.assertEqual(response.status_code, 200)
+      self.assertIn('Player7', response.data)
+
+  def test_team_players(self):
+    players = dict((pid, refdata.Player(pid, team, active, name, None))
+        for (pid, team, active, name) in [
+            (1, 6, 1, 'b'), (2, 6, 0, 'a'), (3, 8, 1, 'c'), (4, 6, 1, 'c')])
+    snapshot = refdata.RefData(1, {}, players, {})
+    self.assertEqual([ player.id for player in snapshot.team_players(6) ], [2, 1, 4])
+    self.assertEqual([ player.id for player in snapshot.team_players(6, active_only=True) ], [1, 4])
+    self.assertEqual(snapshot.team_players(9), [])
+    self.assertEqual(snapshot.get_player(3), players[3])
+    self.assertEqual(snapshot.get_player(5).full_name, 'Player5.COWARD')
+
+
+class SqlProfileTest(unittest.TestCase):
+
+  class Logger(object):
+
+    def __init__(self):
+      self.entries = []
+
+    def info(self, line):
+      self.entries.append(json.loads(line))
+
+  def connect(self, slow_ms):
+    self.logger = self.Logger()
+    profiler = sql_profile.Profiler(self.logger, slow_ms, route=lambda: 'show_lineup')
+    conn = sql_profile.connect(':memory:', profiler)
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, name TEXT)")
+    cursor.executemany("INSERT INTO t VALUES (?,?)", [ (num, 'n%d' % num) for num in range(5) ])
+    del self.logger.entries[:]
+    return conn, cursor
+
+  def test_statements_are_recorded(self):
+    conn, cursor = self.connect(slow_ms=1e9)
+    rows = list(cursor.execute("SELECT name FROM t WHERE id > 1 AND name != 'n4'"))
+    self.assertEqual(len(rows), 2)
+    cursor.execute("SELECT name FROM t WHERE id IN (1, 2, 3)")
+    self.assertEqual(cursor.fetchone(), (u'n1',))
+    # A statement left unfinished counts once the cursor moves on.
+    self.assertEqual(len(self.logger.entries), 1)
+    cursor.execute("UPDATE t SET name = ? WHERE id = ?", ('x', 0))
+    cursor.close()
+    conn.close()
+    self.assertEqual([ (entry['sql'], entry['rows'], entry['route'])
+        for entry in self.logger.entries ], [
+            ("SELECT name FROM t WHERE id > ? AND name != ?", 2, 'show_lineup'),
+            ("SELECT name FROM t WHERE id IN (...)", 1, 'show_lineup'),
+            ("UPDATE t SET name = ? WHERE id = ?", 0, 'show_lineup'),
+            ])
+    for entry in self.logger.entries:
+      self.assertTrue(entry['ms'] >= 0)
+      self.assertEqual(entry['vm_steps'] % sql_profile.PROGRESS_STEPS, 0)
+      self.assertNotIn('plan', entry)
+
+  def test_slow_queries_are_explained(self):
+    conn, cursor = self.connect(slow_ms=0)
+    cursor.execute("SELECT name FROM t WHERE id = 3").fetchall()
+    cursor.execute("DELETE FROM t WHERE id = 3")
+    conn.close()
+    select, delete = self.logger.entries
+    self.assertEqual(len(select['plan']), 1)
+    self.assertIn('INTEGER PRIMARY KEY', select['plan'][0])
+    self.assertEqual(delete['plan'], None)
+
+  def test_report_ranks_by_total_time(self):
+    log_dir = tempfile.mkdtemp()
+    try:
+      paths = [ os.path.join(log_dir, name) for name in ['sql_profile.log', 'sql_profile.log.1'] ]
+      entries = [
+          [dict(sql='SELECT a', ms=5.0, rows=1, route='x'),
+           dict(sql='SELECT b', ms=4.0, rows=10, route='x', plan=['SCAN b'])],
+          [dict(sql='SELECT b', ms=3.0, rows=20, route='y'),
+           dict(sql='SELECT b', ms=0.5, rows=0, route='y'),
+           dict(sql='SELECT c', ms=1.0, rows=0, route='x')],
+          ]
+      for path, lines in zip(paths, entries):
+        with open(path, 'w') as handle:
+          for entry in lines:
+            handle.write(json.dumps(entry) + '\n')
+          handle.write('{"cut short\n')
+      out = cStringIO.StringIO()
+      sql_profile.report(paths, 2, out)
+    finally:
+      shutil.rmtree(log_dir)
+    lines = out.getvalue().splitlines()
+    self.assertEqual([ line.strip() for line in lines if line.startswith('    SELECT') ],
+        ['SELECT b', 'SELECT a'])
+    self.assertEqual(lines[0].split(), ['7.5', 'ms', 'total', '3', 'calls', '2.50',
+        'ms', 'avg', '4.00', 'ms', 'max', '10.0', 'rows', 'avg'])
+    self.assertEqual(lines[2:4], ['    routes: y (2), x (1)', '    plan: SCAN b'])
+
+
+# Read-only pages are served from a copy of the database, refreshed once it
+# is older than READ_SNAPSHOT_MAX_AGE.
+class SnapshotTest(AppTestCase):
+
+  def setUp(self):
+    AppTestCase.setUp(self)
+    ahgl_admin.app.config['READ_SNAPSHOT_MAX_AGE'] = 60
+    self.snapshot_path = os.path.join(self.data_dir, 'ahgl_snapshot.sq3')
+
+  def tearDown(self):
+    del ahgl_admin.app.config['READ_SNAPSHOT_MAX_AGE']
+    AppTestCase.tearDown(self)
+
+  def rename_player(self, conn, name):
+    conn.execute("UPDATE players SET name = ? WHERE id = 7", (name,))
+
+  def age_snapshot(self):
+    then = time.time() - 61
+    os.utime(self.snapshot_path, (then, then))
+
+  def test_pages_read_the_snapshot(self):
+    response = self.client.get('/view-rosters')
+    self.assertIn('ShamWOW', response.data)
+    self.assertTrue(0 <= float(response.headers['X-Snapshot-Age']) < 5)
+    self.assertTrue(os.path.exists(self.snapshot_path))
+    self.assertEqual(ahgl_admin.metrics['snapshot_refreshes_total'], 1)
+    # A committed change shows only once the snapshot is refreshed.
+    self.rename_player(self.db, 'ShamWOWed')
+    self.db.commit()
+    response = self.client.get('/view-rosters')
+    self.assertIn('ShamWOW.', response.data)
+    self.assertEqual(ahgl_admin.metrics['snapshot_refreshes_total'], 1)
+    self.age_snapshot()
+    response = self.client.get('/view-rosters')
+    self.assertIn('ShamWOWed.', response.data)
+    self.assertTrue(float(response.headers['X-Snapshot-Age']) < 5)
+    self.assertEqual(ahgl_admin.metrics['snapshot_refreshes_total'], 2)
+    # Pages that write use the primary, and get no snapshot age.
+    self.login(-1)
+    response = self.submit_maps(2)
+    self.assertNotIn('X-Snapshot-Age', response.headers)
+
+  def test_snapshot_never_has_uncommitted_writes(self):
+    self.client.get('/view-rosters')
+    self.age_snapshot()
+    self.db.execute("BEGIN")
+    self.rename_player(self.db, 'Uncommitted')
+    response = self.client.get('/view-rosters')
+    self.assertEqual(ahgl_admin.metrics['snapshot_refreshes_total'], 2)
+    self.assertIn('ShamWOW.', response.data)
+    self.assertNotIn('Uncommitted', response.data)
+    self.db.rollback()
+
+
+class ExportTest(AppTestCase):
+
+  sql_files = AppTestCase.sql_files + ['./test_results.sql']
+
+  def export(self):
+    return export_season.export(os.path.join(self.data_dir, 'ahgl.sq3'), self.data_dir, '2',
+        self.out_dir)
+
+  def setUp(self):
+    AppTestCase.setUp(self)
+    self.out_dir = os.path.join(self.data_dir, 'export')
+    self.client.get('/')
+
+  def test_export_is_incremental(self):
+    weeks = [ row[0] for row in self.db.execute("SELECT DISTINCT week FROM set_results ORDER BY week") ]
+    self.assertEqual(self.export(), (weeks, []))
+    path = os.path.join(self.out_dir, 'week_%03d.json.gz' % weeks[0])
+    rows = sum((batch['week'] for batch in export_season.read_part(path)), [])
+    self.assertEqual(set(rows), set([weeks[0]]))
+    self.assertEqual(self.export(), ([], []))
+    self.db.execute("UPDATE set_results SET forfeit = 1 WHERE week = ?", (weeks[0],))
+    self.db.commit()
+    self.assertEqual(self.export(), ([weeks[0]], []))
+
+  def test_weeks_without_results_are_removed(self):
+    weeks = self.export()[0]
+    with open(os.path.join(self.out_dir, 'week_999.json.gz'), 'wb') as handle:
+      handle.write('stray')
+    self.db.execute("DELETE FROM set_results WHERE week = ?", (weeks[-1],))
+    self.db.commit()
+    self.assertEqual(self.export(), ([], [weeks[-1]]))
+    manifest = export_season.load_manifest(self.out_dir)
+    self.assertEqual(sorted(manifest['parts']), [ str(week) for week in weeks[:-1] ])
+    self.assertEqual(sorted(fname for fname in os.listdir(self.out_dir) if fname != 'manifest.json'),
+        [ 'week_%03d.json.gz' % week for week in weeks[:-1] ])
+
+
+class NewSeasonTest(AppTestCase):
+
+  def test_archive_has_no_login_keys(self):
+    self.login(-1)
+    self.submit_maps(1)
+    self.db.close()
+    new_season.archive_season('2', '3')
+    past_path = os.path.join(self.data_dir, 'ahgl_season_2.sq3')
+    with open(past_path, 'rb') as handle:
+      self.assertNotIn('34ddbd51701efa370aba7d7a9d05cf5ac43ba82c', handle.read())
+    past = sqlite3.connect(past_path)
+    self.assertEqual(past.execute("SELECT COUNT(*) FROM accounts").fetchone(), (0,))
+    self.assertEqual(past.execute("SELECT COUNT(*) FROM maps").fetchone(), (5,))
+    past.close()
+    self.db = ahgl_admin.open_db(ahgl_admin.get_season_db_path('3'))
+    self.assertEqual(self.db.execute("SELECT COUNT(*) FROM accounts").fetchone(), (5,))
+    self.assertEqual(self.db.execute("SELECT COUNT(*) FROM maps").fetchone(), (0,))
+
+
+class ReplayZipTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.replay = os.path.join(self.dir, 'replay.SC2Replay')
+    shutil.copy('./test_fake_replay.dat', self.replay)
+    self.text = os.path.join(self.dir, 'text.SC2Replay')
+    with open(self.text, 'wb') as handle:
+      handle.write('gg ' * 1000)
+    self.zip_path = os.path.join(self.dir, 'replays.zip')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_blob_header(self):
+    info = replay_zip.prepare_blob(self.text)
+    self.assertEqual(info.method, replay_zip.METHOD_DEFLATED)
+    self.assertEqual(info.file_size, 3000)
+    self.assertEqual(info.crc, zlib.crc32('gg ' * 1000) & 0xFFFFFFFF)
+    self.assertEqual(info.data_offset, replay_zip.BLOB_HEADER.size)
+    with open(replay_zip.get_blob_path(self.text), 'rb') as handle:
+      self.assertEqual(handle.read(4), replay_zip.BLOB_MAGIC)
+    self.assertEqual(replay_zip.read_blob(self.text), info)
+    # A replay that changed under its blob is compressed again.
+    with open(self.text, 'ab') as handle:
+      handle.write('gl hf')
+    self.assertEqual(replay_zip.read_blob(self.text), None)
+    self.assertEqual(replay_zip.get_blobs([self.text])[0].file_size, 3005)
+
+  def test_blobs_made_concurrently(self):
+    paths = []
+    for num in range(4):
+      path = os.path.join(self.dir, '%d.SC2Replay' % num)
+      with open(path, 'wb') as handle:
+        handle.write('set %d ' % num * 500)
+      paths.append(path)
+    infos = replay_zip.get_blobs(paths + paths[:1], processes=3)
+    self.assertEqual([ info.file_size for info in infos ], [3000] * 5)
+    self.assertEqual(infos, [ replay_zip.read_blob(path) for path in paths + paths[:1] ])
+
+  def test_round_trip(self):
+    with open(self.zip_path, 'wb') as out:
+      replay_zip.write_zip(out, [(u'r\xe9play.SC2Replay', self.replay), ('text', self.text)])
+    zfile = zipfile.ZipFile(self.zip_path)
+    self.assertEqual(zfile.testzip(), None)
+    self.assertEqual(zfile.namelist(), [u'r\xe9play.SC2Replay', 'text'])
+    self.assertEqual(zfile.read('text'), 'gg ' * 1000)
+
+  def test_zip64_round_trip(self):
+    count = replay_zip.ZIP64_COUNT_LIMIT + 1
+    with open(self.zip_path, 'wb') as out:
+      replay_zip.write_zip(out, [ ('%05d' % num, self.text) for num in range(count) ])
+    with open(self.zip_path, 'rb') as handle:
+      handle.seek(-replay_zip.END_RECORD.size, 2)
+      self.assertEqual(replay_zip.END_RECORD.unpack(handle.read())[3], 0xFFFF)
+    zfile = zipfile.ZipFile(self.zip_path)
+    self.assertEqual(len(zfile.infolist()), count)
+    self.assertEqual(zfile.read('%05d' % (count - 1)), 'gg ' * 1000)
+
+  def test_append(self):
+    replay_zip.append_zip(self.zip_path, [('a', self.replay)])
+    old = open(self.zip_path, 'rb')
+    added = replay_zip.append_zip(self.zip_path, [('a', self.text), ('b', self.text)])
+    self.assertEqual([ member.name for member in added ], ['b'])
+    self.assertEqual(replay_zip.append_zip(self.zip_path, [('b', self.text)]), [])
+    zfile = zipfile.ZipFile(self.zip_path)
+    self.assertEqual(zfile.testzip(), None)
+    self.assertEqual(zfile.namelist(), ['a', 'b'])
+    with open(self.replay, 'rb') as handle:
+      self.assertEqual(zfile.read('a'), handle.read())
+    # Whoever was reading the archive still has the one they opened.
+    with old:
+      self.assertEqual(zipfile.ZipFile(old).namelist(), ['a'])
+    self.assertEqual([ fname for fname in os.listdir(self.dir) if fname.startswith('replays.zip') ],
+        ['replays.zip'])
+
+  def test_append_replaces_damaged_archive(self):
+    with open(self.zip_path, 'wb') as handle:
+      handle.write('PK\003\004 cut short')
+    replay_zip.append_zip(self.zip_path, [('a', self.text)])
+    self.assertEqual(zipfile.ZipFile(self.zip_path).namelist(), ['a'])
+
+
+class ScrubTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.db_path = os.path.join(self.dir, 'ahgl.sq3')
+    with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+      conn.execute("CREATE TABLE set_results (replay_hash TEXT)")
+      conn.commit()
+    self.old = time.time() - 2 * 60 * 60
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def add_replay(self, data, referenced=True, mtime=None, name=None):
+    rephash = name or hashlib.sha1(data).hexdigest()
+    path = os.path.join(self.dir, rephash + '.SC2Replay')
+    with open(path, 'wb') as handle:
+      handle.write(data)
+    os.utime(path, (mtime or self.old, mtime or self.old))
+    if referenced:
+      self.reference(rephash)
+    return rephash
+
+  def reference(self, rephash):
+    with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+      conn.execute("INSERT INTO set_results VALUES (?)", (rephash,))
+      conn.commit()
+
+  def touch(self, name, mtime=None):
+    path = os.path.join(self.dir, name)
+    with open(path, 'wb') as handle:
+      handle.write('partial')
+    os.utime(path, (mtime or self.old, mtime or self.old))
+
+  def scrub(self, action='report', full=False):
+    out = cStringIO.StringIO()
+    ok = scrub_replays.scrub(self.dir, [self.db_path], 1, None, full, 60 * 60, action, out)
+    return ok, out.getvalue().splitlines()
+
+  def test_finds_each_kind(self):
+    kept = self.add_replay('kept')
+    replay_zip.prepare_blob(os.path.join(self.dir, kept + '.SC2Replay'))
+    corrupt = self.add_replay('changed on disk', name=hashlib.sha1('original').hexdigest())
+    orphan = self.add_replay('orphan', referenced=False)
+    self.add_replay('new orphan', referenced=False, mtime=time.time())
+    dangling = hashlib.sha1('never uploaded').hexdigest()
+    self.reference(dangling)
+    gone = hashlib.sha1('gone').hexdigest()
+    self.touch(gone + '.SC2Replay.deflate')
+    self.touch(kept + '.SC2Replay.deflate.ab12_z')
+    self.touch('ahgl_replays_season_2_player_5.zip.x9y8z7')
+    self.touch('scrub_state.json.q1w2e3')
+    self.touch('ahgl_snapshot.sq3.4242.tmp')
+    self.touch('ahgl_replays_season_2.zip.a1b2c3', mtime=time.time())
+    ok, lines = self.scrub()
+    self.assertFalse(ok)
+    self.assertEqual(lines, [
+        'checked 4 of 4 replays',
+        'corrupt %s' % corrupt,
+        'dangling %s' % dangling,
+        'orphaned %s' % orphan,
+        'stale %s.SC2Replay.deflate' % gone,
+        'stale %s.SC2Replay.deflate.ab12_z' % kept,
+        'stale ahgl_replays_season_2_player_5.zip.x9y8z7',
+        'stale ahgl_snapshot.sq3.4242.tmp',
+        'stale scrub_state.json.q1w2e3',
+        ])
+    # Reporting leaves everything where it was.
+    self.assertTrue(os.path.exists(os.path.join(self.dir, orphan + '.SC2Replay')))
+    self.assertTrue(os.path.exists(os.path.join(self.dir, 'ahgl_snapshot.sq3.4242.tmp')))
+
+  def test_delete_leaves_referenced_replays(self):
+    kept = self.add_replay('kept')
+    replay_zip.prepare_blob(os.path.join(self.dir, kept + '.SC2Replay'))
+    corrupt = self.add_replay('changed on disk', name=hashlib.sha1('original').hexdigest())
+    orphan = self.add_replay('orphan', referenced=False)
+    replay_zip.prepare_blob(os.path.join(self.dir, orphan + '.SC2Replay'))
+    self.touch('scrub_state.json.q1w2e3')
+    self.scrub('delete')
+    self.assertEqual(sorted(os.listdir(self.dir)), sorted([
+        'ahgl.sq3', kept + '.SC2Replay', kept + '.SC2Replay.deflate',
+        'quarantine', 'scrub_state.json']))
+    # The corrupt replay is still referenced, so it is moved aside, not deleted.
+    self.assertEqual(os.listdir(os.path.join(self.dir, 'quarantine')), [corrupt + '.SC2Replay'])
+    ok, lines = self.scrub('delete')
+    self.assertEqual(lines, ['checked 0 of 1 replays', 'dangling %s' % corrupt])
+
+  def test_unchanged_replays_are_not_read_again(self):
+    first = self.add_replay('first')
+    self.add_replay('second')
+    self.assertEqual(self.scrub(), (True, ['checked 2 of 2 replays']))
+    with open(os.path.join(self.dir, 'scrub_state.json')) as handle:
+      self.assertEqual(sorted(json.load(handle)), sorted([first, hashlib.sha1('second').hexdigest()]))
+    self.assertEqual(self.scrub(), (True, ['checked 0 of 2 replays']))
+    # A replay whose size or mtime changed is read again, and so is every
+    # replay with --full.
+    path = os.path.join(self.dir, first + '.SC2Replay')
+    with open(path, 'ab') as handle:
+      handle.write(' and more')
+    self.assertEqual(self.scrub(), (False, ['checked 1 of 2 replays', 'corrupt %s' % first]))
+    self.assertEqual(self.scrub(full=True)[1][0], 'checked 2 of 2 replays')
+
+
+class CompressTest(unittest.TestCase):
+
+  def setUp(self):
+    self.body = ['<p>%d</p>' % num for num in range(200)]
+    self.ctype = 'text/html; charset=utf-8'
+    self.extra = []
+    self.calls = 0
+    self.cache = cache.LRUCache(8)
+    self.middleware = compress.CompressMiddleware(self.app, self.cache)
+
+  def app(self, environ, start_response):
+    self.calls += 1
+    start_response('200 OK', [('Content-Type', self.ctype)] + self.extra)
+    return list(self.body)
+
+  def get(self, accept=None):
+    response = []
+    def start_response(status, headers, exc_info=None):
+      response[:] = [status, dict(headers)]
+    environ = {} if accept is None else {'HTTP_ACCEPT_ENCODING': accept}
+    body = ''.join(self.middleware(environ, start_response))
+    return response[1], body
+
+  def test_choose_encoding(self):
+    self.assertEqual(compress.choose_encoding(None), None)
+    self.assertEqual(compress.choose_encoding('identity'), None)
+    self.assertEqual(compress.choose_encoding('deflate, gzip;q=0.5'), 'gzip')
+    self.assertEqual(compress.choose_encoding('gzip;q=0, *;q=1'),
+        'br' if compress.brotli is not None else None)
+    self.assertEqual(compress.choose_encoding('GZIP;q=bad'), None)
+    self.assertEqual(compress.choose_encoding('*'),
+        'br' if compress.brotli is not None else 'gzip')
+
+  def test_gzip(self):
+    headers, body = self.get('gzip')
+    self.assertEqual(headers['Content-Encoding'], 'gzip')
+    self.assertEqual(headers['Vary'], 'Accept-Encoding')
+    self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), ''.join(self.body))
+
+  def test_vary_when_not_compressed(self):
+    headers, body = self.get()
+    self.assertNotIn('Content-Encoding', headers)
+    self.assertEqual(headers['Vary'], 'Accept-Encoding')
+    self.body = ['short']
+    self.extra = [('Content-Length', '5'), ('Vary', 'Cookie')]
+    headers, body = self.get('gzip')
+    self.assertEqual(body, 'short')
+    self.assertNotIn('Content-Encoding', headers)
+    self.assertEqual(headers['Vary'], 'Cookie, Accept-Encoding')
+
+  def test_binary_passes_through(self):
+    self.ctype = 'application/zip'
+    for accept in (None, 'gzip'):
+      headers, body = self.get(accept)
+      self.assertEqual(body, ''.join(self.body))
+      self.assertNotIn('Vary', headers)
+      self.assertNotIn('Content-Encoding', headers)
+
+  def test_cache_key(self):
+    self.extra = [(compress.CACHE_KEY_HEADER, 'week-1')]
+    first = self.get('gzip')
+    second = self.get('gzip')
+    self.assertEqual(first[1], second[1])
+    self.assertEqual(second[0]['Content-Length'], str(len(second[1])))
+    self.assertNotIn(compress.CACHE_KEY_HEADER, second[0])
+    self.assertEqual(self.cache.get(('compressed', 'week-1', 'gzip')), second[1])
+    headers, body = self.get()
+    self.assertNotIn(compress.CACHE_KEY_HEADER, headers)
+    self.assertEqual(body, ''.join(self.body))
+
+
+class LockFailureCounterTest(unittest.TestCase):
+
+  def run_app(self, app):
+    stats = load_test.Stats()
+    calls = []
+    def start_response(status, headers, exc_info=None):
+      calls.append((status, exc_info))
+    body = ''.join(load_test.LockFailureCounter(app, stats)({'PATH_INFO': '/x'}, start_response))
+    return stats, calls, body
+
+  def test_failure_in_view(self):
+    def app(environ, start_response):
+      raise sqlite3.OperationalError('database is locked')
+    stats, calls, body = self.run_app(app)
+    self.assertEqual(stats.lock_failures, {'/x': 1})
+    self.assertEqual(calls[0][0], '500 Internal Server Error')
+    self.assertEqual(calls[0][1][0], sqlite3.OperationalError)
+    self.assertEqual(body, 'database is locked')
+
+  def test_failure_in_body(self):
+    def app(environ, start_response):
+      start_response('200 OK', [])
+      yield 'partial'
+      raise sqlite3.OperationalError('database is locked')
+    stats, calls, body = self.run_app(app)
+    self.assertEqual(stats.lock_failures, {'/x': 1})
+    self.assertEqual([ status for status, exc_info in calls ], ['200 OK', '500 Internal Server Error'])
+    self.assertEqual(calls[1][1][0], sqlite3.OperationalError)
+
+
+class EventLogTest(unittest.TestCase):
+
+  SEASON_TABLES = ['maps', 'referees', 'lineup', 'set_results', 'ace_matches']
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'ahgl.sq3')
+    self.conn = sqlite3.connect(self.path)
+    for fname in ['./schema.sql', './test_data.sql', './test_lineup.sql', './test_results.sql']:
+      with open(fname) as handle:
+        self.conn.executescript(handle.read())
+    self.conn.commit()
+
+  def tearDown(self):
+    self.conn.close()
+    shutil.rmtree(self.dir)
+
+  def get_rows(self, conn):
+    return dict((table, sorted(conn.execute("SELECT * FROM %s" % table)))
+        for table in self.SEASON_TABLES)
+
+  def test_backfill_then_replay(self):
+    logged = event_log.backfill(self.conn)
+    self.assertTrue(logged > 0)
+    self.assertEqual(event_log.backfill(self.conn), 0)
+    kinds = [ event.kind for event in event_log.read(self.conn) ]
+    self.assertEqual(kinds[0], 'maps')
+    self.assertEqual(len(kinds), logged)
+
+    dest_path = os.path.join(self.dir, 'mirror.sq3')
+    self.assertEqual(event_log.replay(self.path, dest_path), logged)
+    self.assertEqual(event_log.replay(self.path, dest_path), 0)
+    dest = sqlite3.connect(dest_path)
+    try:
+      self.assertEqual(self.get_rows(dest), self.get_rows(self.conn))
+      self.assertEqual(event_log.last_seq(dest), event_log.last_seq(self.conn))
+      self.assertEqual(dest.execute("SELECT COUNT(*) FROM accounts").fetchone()[0], 0)
+    finally:
+      dest.close()
+
+  def test_sync_removes_rows_with_nulls(self):
+    dest_path = os.path.join(self.dir, 'mirror.sq3')
+    event_log.replay(self.path, dest_path)
+    self.conn.execute("INSERT INTO matches VALUES (9, 1, 1, 2, 3, NULL)")
+    self.conn.commit()
+    event_log.replay(self.path, dest_path)
+    self.conn.execute("UPDATE matches SET backup_ref_team = 4 WHERE week = 9")
+    self.conn.execute("INSERT INTO matches VALUES (9, 2, 5, 6, 7, NULL)")
+    self.conn.commit()
+    event_log.replay(self.path, dest_path)
+    self.conn.execute("DELETE FROM matches WHERE week = 9")
+    self.conn.execute("UPDATE players SET char_code = NULL WHERE id = 1")
+    self.conn.commit()
+    event_log.replay(self.path, dest_path)
+    dest = sqlite3.connect(dest_path)
+    try:
+      for table in ['matches', 'players']:
+        self.assertEqual(sorted(dest.execute("SELECT * FROM %s" % table)),
+            sorted(self.conn.execute("SELECT * FROM %s" % table)))
+    finally:
+      dest.close()
+
+  def test_checkpoints(self):
+    event_log.backfill(self.conn)
+    self.assertEqual(event_log.get_checkpoint(self.conn, 'reader'), 0)
+    out = cStringIO.StringIO()
+    event_log.tail(self.path, 0, 'reader', False, 0, out)
+    lines = out.getvalue().splitlines()
+    self.assertEqual(len(lines), event_log.last_seq(self.conn))
+    self.assertEqual(json.loads(lines[-1])['seq'], event_log.last_seq(self.conn))
+    self.assertEqual(event_log.get_checkpoint(self.conn, 'reader'), event_log.last_seq(self.conn))
+    self.assertEqual(event_log.get_checkpoint(self.conn, 'other'), 0)
+    out = cStringIO.StringIO()
+    event_log.tail(self.path, 0, 'reader', False, 0, out)
+    self.assertEqual(out.getvalue(), '')
+
+
+class BroadcastTest(unittest.TestCase):
+
+  def test_subscribers_are_capped(self):
+    live = broadcast.Broadcaster(max_subscribers=2)
+    self.assertTrue(live.subscribe())
+    self.assertTrue(live.subscribe())
+    self.assertFalse(live.subscribe())
+    live.unsubscribe()
+    self.assertTrue(live.subscribe())
+
+  def test_closing_subscription_gives_place_back(self):
+    live = broadcast.Broadcaster(max_subscribers=1)
+    live.subscribe()
+    sub = broadcast.Subscription(live, 0, None)
+    sub.close()
+    sub.close()
+    self.assertEqual(live.subscribers, 0)
+
+  def test_stream_filters_week(self):
+    live = broadcast.Broadcaster()
+    live.publish(1, "maps", 1, {})
+    live.publish(2, "result", 2, {"match": 3})
+    body = broadcast.stream(live, 0, 2)
+    self.assertEqual(body.next(), "retry: 5000\n\n")
+    self.assertEqual(body.next(),
+        'id: 2\nevent: result\ndata: {"match": 3, "week": 2}\n\n')
+
+  def test_tick_sends_heartbeat(self):
+    live = broadcast.Broadcaster()
+    body = broadcast.stream(live, 0, None)
+    body.next()
+    ticker = threading.Timer(0.05, live.tick)
+    ticker.start()
+    self.assertEqual(body.next(), ": heartbeat\n\n")
+    ticker.join()
+
+  def test_lagging_subscriber_is_reset(self):
+    live = broadcast.Broadcaster(history=2)
+    for event_id in range(1, 5):
+      live.publish(event_id, "maps", 1, {})
+    self.assertEqual(live.since(1), None)
+    self.assertEqual([ event[0] for event in live.since(2) ], [3, 4])
+    body = broadcast.stream(live, 1, None)
+    body.next()
+    self.assertEqual(body.next(), "id: 4\nevent: reset\ndata: {}\n\n")
+
+
+class EventServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.live = broadcast.Broadcaster()
+    self.server = event_server.FeedServer(('127.0.0.1', 0), self.live)
+    self.clients = []
+
+  def tearDown(self):
+    for client in self.clients:
+      client.close()
+    self.server.close_all()
+
+  def connect(self, path, last_id=None):
+    client = socket.create_connection(self.server.socket.getsockname())
+    client.settimeout(0.01)
+    self.clients.append(client)
+    headers = 'Last-Event-ID: %d\r\n' % last_id if last_id is not None else ''
+    client.sendall('GET %s HTTP/1.1\r\nHost: x\r\n%s\r\n' % (path, headers))
+    return client
+
+  def receive(self, client):
+    data = ''
+    for _ in range(20):
+      self.server.poll(0.01)
+      try:
+        chunk = client.recv(65536)
+      except socket.timeout:
+        if data:
+          break
+        continue
+      if not chunk:
+        break
+      data += chunk
+    return data
+
+  def test_subscribers_get_their_week(self):
+    self.live.publish(1, 'maps', 1, {})
+    self.live.publish(2, u'result', 2, {'match': 3})
+    client = self.connect('/events?week=2', 0)
+    data = self.receive(client)
+    self.assertTrue(data.startswith('HTTP/1.1 200 OK\r\n'))
+    self.assertIn('Content-Type: text/event-stream\r\n', data)
+    self.assertTrue(data.endswith('retry: 5000\n\n'
+        'id: 2\nevent: result\ndata: {"match": 3, "week": 2}\n\n'))
+
+    self.live.publish(3, 'lineup', 2, {'team': 1})
+    self.live.publish(4, 'lineup', 1, {'team': 2})
+    self.server.send_events()
+    self.assertEqual(self.receive(client),
+        'id: 3\nevent: lineup\ndata: {"team": 1, "week": 2}\n\n')
+    self.server.heartbeat()
+    self.assertEqual(self.receive(client), ': heartbeat\n\n')
+
+  def test_many_idle_subscribers_on_one_thread(self):
+    clients = [ self.connect('/events') for _ in range(20) ]
+    for client in clients:
+      self.receive(client)
+    self.assertEqual(len(self.server.subscribers), 20)
+    self.live.publish(1, 'maps', 1, {})
+    self.server.send_events()
+    for client in clients:
+      self.assertIn('id: 1\nevent: maps\n', self.receive(client))
+    clients[0].close()
+    self.server.poll(0.1)
+    self.assertEqual(len(self.server.subscribers), 19)
+
+  def test_other_paths_are_not_found(self):
+    client = self.connect('/show-lineup/1')
+    self.assertTrue(self.receive(client).startswith('HTTP/1.1 404 Not Found\r\n'))
+    self.assertEqual(len(self.server.subscribers), 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+import contextlib
+
+
+# Form validation for the submit handlers.  Field rules parse the posted
+# values and register the database lookups they depend on; validate() then
+# resolves every lookup as a scalar subquery of a single SELECT and returns
+# all errors, in field order, before the handler writes anything.
+
+RACES = list("TZPR")
+
+
+class Form(object):
+
+  def __init__(self, postdata):
+    self.postdata = postdata
+    self._lookups = []
+    self._checks = []
+
+  def error(self, message):
+    self._checks.append((None, None, message))
+
+  # Registers a scalar query whose value must satisfy test.
+  def expect(self, message, sql, params, test=bool):
+    self._lookups.append((sql, tuple(params)))
+    self._checks.append((len(self._lookups) - 1, test, message))
+
+  # missing is the error for an absent or empty field, by default one
+  # naming the field.
+  def get(self, field, missing=None):
+    values = self.postdata.getlist(field)
+    if len(values) != 1 or not values[0]:
+      self.error(missing or "No value submitted for '%s'" % field)
+      return None
+    return values[0]
+
+  def get_int(self, field, message, missing=None):
+    value = self.get(field, missing)
+    if value is None:
+      return None
+    try:
+      return int(value)
+    except ValueError:
+      self.error(message)
+      return None
+
+  def get_choice(self, field, choices, message, missing=None):
+    value = self.get(field, missing)
+    if value is not None and value not in choices:
+      self.error(message)
+      return None
+    return value
+
+  def validate(self, conn):
+    values = []
+    if self._lookups:
+      sql = "SELECT " + ", ".join("(%s)" % lookup[0] for lookup in self._lookups)
+      params = sum((lookup[1] for lookup in self._lookups), ())
+      with contextlib.closing(conn.cursor()) as cursor:
+        cursor.execute(sql, params)
+        values = list(cursor)[0]
+    return [ message for (index, test, message) in self._checks
+        if index is None or not test(values[index]) ]
+
+
+def is_zero(count):
+  return count == 0
+
+
+def week(form, field="week"):
+  return form.get_int(field, "Invalid week")
+
+
+def scheduled_week(form, field="week"):
+  week_number = week(form, field)
+  if week_number is not None:
+    form.expect("Invalid week",
+        "SELECT COUNT(*) FROM maps WHERE week = ?", (week_number,))
+  return week_number
+
+
+def captain_team(form, account, field="team"):
+  team = form.get_int(field, "Invalid team")
+  if team is not None:
+    form.expect("Invalid team",
+        "SELECT COUNT(*) FROM teams WHERE id = ?", (team,))
+    form.expect("Can't submit for another team",
+        "SELECT team FROM accounts WHERE id = ?", (account,),
+        lambda account_team: account_team == team)
+  return team
+
+
+def match(form, week_number, field="match"):
+  match_number = form.get_int(field, "Invalid match")
+  if week_number is not None and match_number is not None:
+    form.expect("Invalid match",
+        "SELECT COUNT(*) FROM matches WHERE week = ? AND match_number = ?",
+        (week_number, match_number), lambda count: count == 1)
+  return match_number
+
+
+def map_id(form, field, message):
+  mapid = form.get_int(field, message)
+  if mapid is not None:
+    form.expect(message,
+        "SELECT COUNT(*) FROM mapnames WHERE id = ?", (mapid,))
+  return mapid
+
+
+def race(form, field, message, missing=None):
+  return form.get_choice(field, RACES, message, missing)
+
+
+def team_player(form, field, team, messages):
+  invalid, ineligible = messages
+  player = form.get_int(field, invalid)
+  if player is not None and team is not None:
+    form.expect(ineligible,
+        "SELECT COUNT(*) FROM players WHERE id = ? AND team = ? AND active = 1",
+        (player, team))
+  return player
+
+
+# A player on the home or away team of the given match.  The entry forms
+# post 0 for "none selected".
+def match_player(form, field, side, week_number, match_number, messages):
+  missing, invalid, wrong_team = messages
+  player = form.get_int(field, invalid, missing)
+  if player == 0:
+    form.error(missing)
+    return None
+  if player is not None and week_number is not None and match_number is not None:
+    form.expect(wrong_team,
+        "SELECT COUNT(*) FROM players p JOIN matches m ON p.team = m.%s_team "
+        "WHERE p.id = ? AND m.week = ? AND m.match_number = ?"
+        % {"home": "home", "away": "away"}[side],
+        (player, week_number, match_number))
+  return player
@@ -10,6 +10,7 @@ import unittest
 import urllib2
 import zipfile
 import cStringIO
+import SocketServer
 import wsgiref.simple_server
 import selenium.webdriver
 from selenium.webdriver.support.ui import WebDriverWait
@@ -32,6 +33,11 @@ def get_test_replay_file():
 
 TEST_REPLAY_SHA1 = '4e1243bd22c66e76c2ba9eddc1f91394e57f9f83'
 
+# Week pages keep a live feed connection open, which would block a
+# single-threaded server.
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+  daemon_threads = True
+
 class AhglAdminSiteBrowserTest(unittest.TestCase):
 
   def setUp(self):
@@ -41,7 +47,8 @@ class AhglAdminSiteBrowserTest(unittest.TestCase):
     ahgl_admin.app.config['DATA_DIR'] = self.data_dir
     ahgl_admin.app.config['SEASON'] = '2'
     ahgl_admin.app.secret_key = 'AHGL'
-    self.httpd = wsgiref.simple_server.make_server('', 0, ahgl_admin.app.wsgi_app)
+    self.httpd = wsgiref.simple_server.make_server('', 0, ahgl_admin.app.wsgi_app,
+        server_class=ThreadingWSGIServer)
     self.base_url = 'http://localhost:%d/' % self.httpd.server_address[1]
     threading.Thread(target=self.httpd.serve_forever).start()
     print self.data_dir  # TODO: drop